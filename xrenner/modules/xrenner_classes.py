@@ -7,13 +7,239 @@ Author: Amir Zeldes
 import sys, re
 from math import log
 from collections import OrderedDict, defaultdict
+from array import array
+from bisect import bisect_left
+from operator import attrgetter
+
+# Bit flags for the POS and dependency function filters from the model configuration which a token matches,
+# see ParsedToken.flags. Filter results are memoized per POS tag or function label in LabelFlags objects.
+MARK_HEAD_POS = 1 << 0
+PRONOUN_POS = 1 << 1
+PROPER_POS = 1 << 2
+VERB_HEAD_POS = 1 << 3
+NON_EXTEND_POS = 1 << 4
+LEMMA_MATCH_POS = 1 << 5
+MARK_FORBIDDEN_FUNC = 1 << 6
+MOD_FUNC = 1 << 7
+POSSESSIVE_FUNC = 1 << 8
+DET_FUNC = 1 << 9
+COORD_FUNC = 1 << 10
+NON_LINK_FUNC = 1 << 11
+STOP_FUNC = 1 << 12
+APPOSITION_FUNC = 1 << 13
+CONJUNCT_FUNC = 1 << 14
+NON_ESSENTIAL_MOD_FUNC = 1 << 15
+
+POS_FLAG_FILTERS = {"mark_head_pos": MARK_HEAD_POS, "pronoun_pos": PRONOUN_POS, "proper_pos": PROPER_POS,
+					"verb_head_pos": VERB_HEAD_POS, "non_extend_pos": NON_EXTEND_POS, "lemma_match_pos": LEMMA_MATCH_POS}
+FUNC_FLAG_FILTERS = {"mark_forbidden_func": MARK_FORBIDDEN_FUNC, "mod_func": MOD_FUNC, "possessive_func": POSSESSIVE_FUNC,
+					 "det_func": DET_FUNC, "coord_func": COORD_FUNC, "non_link_func": NON_LINK_FUNC, "stop_func": STOP_FUNC,
+					 "apposition_func": APPOSITION_FUNC, "conjunct_func": CONJUNCT_FUNC,
+					 "non_essential_mod_func": NON_ESSENTIAL_MOD_FUNC}
+
+
+class LabelFlags(dict):
+	"""
+	Memo from POS tags or function labels to the bit flags of the filters whose regex matches them. Labels come
+	from small closed sets, so each filter is run at most once per distinct label.
+	"""
+
+	def __init__(self, filters, flag_filters):
+		"""
+		:param filters: the model's filters dictionary from config.ini
+		:param flag_filters: dictionary from filter names to the bit flag set for labels the filter matches
+		"""
+		super(LabelFlags, self).__init__()
+		self.filters = filters
+		self.flag_filters = flag_filters
+
+	def __missing__(self, label):
+		flags = 0
+		for name, flag in self.flag_filters.items():
+			pattern = self.filters[name]
+			if hasattr(pattern, "match") and pattern.match(label) is not None:
+				flags |= flag
+		self[label] = flags
+		return flags
+
+
+class MarkHeadTable(dict):
+	"""
+	Memo from (POS tag, function label) pairs to whether a token with them can head a markable, either by the
+	mark_head_pos and mark_forbidden_func filters, or by the pos_func_heads setting. The pos_func_heads string
+	is compiled once into its positive pos+func pairs, negative pos!func pairs and the POS tags that have any
+	negative pair, which are allowed with all other functions.
+	"""
+
+	def __init__(self, pos_func_heads_string, pos_flags, func_flags):
+		"""
+		:param pos_func_heads_string: semicolon separated pos+func and pos!func combinations from config.ini
+		:param pos_flags: LabelFlags memo for POS filters
+		:param func_flags: LabelFlags memo for function filters
+		"""
+		super(MarkHeadTable, self).__init__()
+		self.pos_flags = pos_flags
+		self.func_flags = func_flags
+		self.positive = set()
+		self.negative = set()
+		self.negated_pos = set()
+		for combo in pos_func_heads_string.split(";"):
+			if "+" in combo:
+				self.positive.add(combo)
+			if "!" in combo:
+				self.negative.add(combo)
+				self.negated_pos.update(combo[:i] for i, char in enumerate(combo) if char == "!")
+
+	def pos_func_combo(self, pos, func):
+		"""
+		:return: bool, whether the pos_func_heads setting allows this combination to head a markable
+		"""
+		if pos + "+" + func in self.positive:
+			return True
+		elif pos + "!" + func in self.negative:
+			return False
+		return pos in self.negated_pos
+
+	def __missing__(self, key):
+		pos, func = key
+		is_head = bool(self.pos_flags[pos] & MARK_HEAD_POS and not self.func_flags[func] & MARK_FORBIDDEN_FUNC) or \
+				  self.pos_func_combo(pos, func)
+		self[key] = is_head
+		return is_head
+
+
+class LRUCache(object):
+	"""
+	Bounded memo which evicts the least recently used entry once it is full, and counts hits and misses
+	"""
+
+	def __init__(self, size):
+		self.size = size
+		self.entries = OrderedDict()
+		self.hits = 0
+		self.misses = 0
+
+	def get(self, key, default=None):
+		if key in self.entries:
+			self.hits += 1
+			value = self.entries.pop(key)
+			self.entries[key] = value  # Move to most recently used position
+			return value
+		self.misses += 1
+		return default
+
+	def put(self, key, value):
+		if key in self.entries:
+			del self.entries[key]
+		elif len(self.entries) >= self.size:
+			self.entries.popitem(last=False)
+		self.entries[key] = value
+
+	def clear(self):
+		self.entries.clear()
+		self.hits = 0
+		self.misses = 0
+
+	def __len__(self):
+		return len(self.entries)
+
+	def hit_rate(self):
+		"""
+		:return: proportion of lookups answered from the cache, 0.0 if there were no lookups
+		"""
+		lookups = self.hits + self.misses
+		return self.hits / float(lookups) if lookups > 0 else 0.0
+
+
+class TokenTable(object):
+	"""
+	Document level columnar table of integer token data. Row n holds the head, sentence number and interned POS
+	and function label codes of the token with id n, and row 0 belongs to the artificial root token. ParsedToken
+	objects are views over their row, so integer ids and heads are available without int/str conversions.
+	"""
+
+	def __init__(self):
+		self.heads = array('i')
+		self.sent_nums = array('i')
+		self.pos_codes = array('i')
+		self.func_codes = array('i')
+		self.labels = []  # POS and function labels by code
+		self.codes = {}  # Codes by POS or function label
+
+	def code(self, label):
+		"""
+		:param label: a POS tag or dependency function string
+		:return: integer code of the label, which is interned on first use
+		"""
+		if label not in self.codes:
+			self.codes[label] = len(self.labels)
+			self.labels.append(label)
+		return self.codes[label]
+
+	def add(self, head, sent_num, pos, func):
+		"""
+		Adds a row for the next token in the document
 
-class ParsedToken:
-	def __init__(self, tok_id, text, lemma, pos, morph, head, func, sentence, modifiers, child_funcs, child_strings, lex, quoted=False, head2="_", func2="_"):
+		:return: the row index, which is the token's integer id
+		"""
+		self.heads.append(int(head))
+		self.sent_nums.append(sent_num)
+		self.pos_codes.append(self.code(pos))
+		self.func_codes.append(self.code(func))
+		return len(self.heads) - 1
+
+	def __len__(self):
+		return len(self.heads)
+
+
+class TokenWindow(object):
+	"""
+	Read-only view of the document token list up to a given end position, which behaves like the list prefix
+	tokens[:end] without copying it. Only slices copy tokens, and only the ones they select, so a view ending
+	after the current sentence costs nothing in proportion to the document length.
+	"""
+	__slots__ = ["tokens", "end"]
+
+	def __init__(self, tokens, end):
+		self.tokens = tokens
+		self.end = min(end, len(tokens))
+
+	def __len__(self):
+		return self.end
+
+	def __getitem__(self, key):
+		if isinstance(key, slice):
+			start, stop, step = key.indices(self.end)
+			if step == 1:
+				return self.tokens[start:stop]
+			return [self.tokens[i] for i in range(start, stop, step)]
+		if key < 0:
+			key += self.end
+		if key < 0 or key >= self.end:
+			raise IndexError("token index out of range")
+		return self.tokens[key]
+
+	def __iter__(self):
+		tokens = self.tokens
+		for i in range(self.end):
+			yield tokens[i]
+
+
+class ParsedToken(object):
+
+	__slots__ = ["table", "index", "id", "text", "text_lower", "_pos", "lemma", "morph", "_head", "original_head", "_func",
+				 "head2", "func2", "sentence", "modifiers", "child_funcs", "child_strings", "quoted", "coordinate", "head_text",
+				 "head_pos", "lex", "lemma_freq", "negated", "neg_parent", "sent_position", "doc_position", "seq_pred", "_flags"]
+
+	def __init__(self, tok_id, text, lemma, pos, morph, head, func, sentence, modifiers, child_funcs, child_strings, lex, quoted=False, head2="_", func2="_", table=None):
+		if table is None:  # Standalone token, not part of a document
+			table = TokenTable()
+		self.table = table
+		self.index = table.add(head, sentence.sent_num, pos, func)  # Row in the token table, i.e. integer token id
 		self.id = tok_id
 		self.text = text.strip()
 		self.text_lower = text.lower()
-		self.pos = pos
+		self._pos = pos
 		if lemma != "_" and lemma != "--":
 			self.lemma = lemma.strip()
 		else:
@@ -22,9 +248,9 @@ class ParsedToken:
 		if morph != "_" and morph != "--" and morph != "":
 			self.morph = lex.process_morph(self)
 
-		self.head = head
+		self._head = head
 		self.original_head = head
-		self.func = func
+		self._func = func
 		self.head2 = head2
 		self.func2 = func2
 		self.sentence = sentence
@@ -38,15 +264,87 @@ class ParsedToken:
 		self.lemma_freq = 0.0
 		self.negated = False
 		self.neg_parent = False
+		self._flags = None
+
+	# Head, POS and function are kept in sync with the document's token table
+
+	@property
+	def head(self):
+		return self._head
+
+	@head.setter
+	def head(self, head):
+		self._head = head
+		self.table.heads[self.index] = int(head)
+
+	@property
+	def head_index(self):
+		return self.table.heads[self.index]
+
+	@property
+	def pos(self):
+		return self._pos
+
+	@pos.setter
+	def pos(self, pos):
+		self._pos = pos
+		self._flags = None
+		self.table.pos_codes[self.index] = self.table.code(pos)
+
+	@property
+	def func(self):
+		return self._func
+
+	@func.setter
+	def func(self, func):
+		self._func = func
+		self._flags = None
+		self.table.func_codes[self.index] = self.table.code(func)
+
+	@property
+	def flags(self):
+		"""
+		Bit flags of the POS and function filters matched by this token, e.g. tok.flags & PRONOUN_POS
+		"""
+		if self._flags is None:
+			self._flags = self.lex.pos_flags[self._pos] | self.lex.func_flags[self._func]
+		return self._flags
 
 	def __repr__(self):
 		return str(self.text) + " (" + str(self.pos) + "/" + str(self.lemma) + ") " + "<-" + str(self.func) + "- " + str(self.head_text)
 
-class Markable:
+class Markable(object):
+
+	__slots__ = ["id", "head", "form", "definiteness", "start", "end", "text", "core_text", "first", "last", "entity",
+				 "subclass", "infstat", "agree", "agree_certainty", "sentence", "antecedent", "coref_type", "group",
+				 "non_antecdent_groups", "entity_certainty", "isa_partner_head", "alt_agree", "alt_entities",
+				 "alt_subclasses", "cardinality", "submarks", "coordinate", "length", "mod_count", "entity_dep_scores",
+				 "entity_sim_dep_scores", "lex_dep_scores", "lex_sim_dep_scores", "isa", "isa_dir", "matching_rule",
+				 "_child_func_string", "mod_entity"]
 
 	# Properties refering to markable head, not markable itself
-	tok_props = {"negated", "neg_parent", "pos", "lemma", "morph", "func", "quoted", "modifiers", "child_funcs", "child_strings",
-	 "agree", "doc_position", "sent_position", "head_text", "head_pos", "lemma_freq", "sentence"}
+	negated = property(attrgetter("head.negated"))
+	neg_parent = property(attrgetter("head.neg_parent"))
+	pos = property(attrgetter("head.pos"))
+	lemma = property(attrgetter("head.lemma"))
+	morph = property(attrgetter("head.morph"))
+	func = property(attrgetter("head.func"))
+	flags = property(attrgetter("head.flags"))
+	quoted = property(attrgetter("head.quoted"))
+	modifiers = property(attrgetter("head.modifiers"))
+	child_funcs = property(attrgetter("head.child_funcs"))
+	child_strings = property(attrgetter("head.child_strings"))
+	doc_position = property(attrgetter("head.doc_position"))
+	sent_position = property(attrgetter("head.sent_position"))
+	head_text = property(attrgetter("head.head_text"))
+	head_pos = property(attrgetter("head.head_pos"))
+	lemma_freq = property(attrgetter("head.lemma_freq"))
+
+	# Properties refering to the markable's sentence
+	mood = property(attrgetter("sentence.mood"))
+	speaker = property(attrgetter("sentence.speaker"))
+	sent_num = property(attrgetter("sentence.sent_num"))
+	s_type = property(attrgetter("sentence.s_type"))
 
 	def __init__(self, mark_id, head, form, definiteness, start, end, text, core_text, entity, entity_certainty, subclass, infstat, agree, sentence,
 				 antecedent, coref_type, group, alt_entities, alt_subclasses, alt_agree, cardinality=0, submarks=[], coordinate=False, agree_certainty=""):
@@ -90,6 +388,8 @@ class Markable:
 		self.entity_sim_dep_scores = defaultdict(int)
 		self.lex_dep_scores = defaultdict(int)
 		self.lex_sim_dep_scores = defaultdict(int)
+		self._child_func_string = None
+		self.mod_entity = None  # Modifier based entity guess and atomicity, set by recognize_entity_by_mod
 
 	def has_child_func(self, func):
 		if "*" in func: # func substring, do not delimit function
@@ -243,7 +543,7 @@ class Markable:
 			out_dict["d_sametext"] = int(anaphor.text == antecedent.text)
 			out_dict["d_samelemma"] = int(anaphor.lemma == antecedent.lemma)
 
-			out_dict["d_doclen"] = int(anaphor.head.lex.token_count)
+			out_dict["d_doclen"] = lex.doc_stats.token_count
 
 
 			# Check if one markable head is the dependency parent of the other
@@ -263,31 +563,28 @@ class Markable:
 
 		return out_dict
 
-	def __getattr__(self, item):
-		# Convenience methods to access head token and containing sentence
-		if item in self.tok_props:
-			return getattr(self.head,item)
-		elif item == "text_lower":
-			if self.coordinate:  # If this is a coordinate markable return lower case core_text
-				return self.core_text.lower()
-			else:  # Otherwise return lower text of head token
-				return getattr(self.head, item)
-		elif item in ["mood", "speaker", "sent_num", "s_type"]:
-			return getattr(self.sentence,item)
-		elif item == "child_func_string":
-			# Check for cached child_func_string
-			if "child_func_string" not in self.__dict__:  # Convenience property to store semi-colon separated child funcs of head token
-				# Assemble if not yet cached
-				if len(self.head.child_funcs) > 1:
-					self.child_func_string = ";" + ";".join(self.head.child_funcs) + ";"
-				else:
-					self.child_func_string = "_"
-			return self.child_func_string
-		else:
-			raise AttributeError("No attribute: " + str(item))
+	@property
+	def text_lower(self):
+		if self.coordinate:  # If this is a coordinate markable return lower case core_text
+			return self.core_text.lower()
+		else:  # Otherwise return lower text of head token
+			return self.head.text_lower
+
+	@property
+	def child_func_string(self):
+		# Convenience property to store semi-colon separated child funcs of head token, assembled on first access
+		if self._child_func_string is None:
+			if len(self.head.child_funcs) > 1:
+				self._child_func_string = ";" + ";".join(self.head.child_funcs) + ";"
+			else:
+				self._child_func_string = "_"
+		return self._child_func_string
+
 
+class Sentence(object):
+
+	__slots__ = ["sent_num", "start_offset", "mood", "speaker", "token_count", "s_type", "length", "text"]
 
-class Sentence:
 	def __init__(self, sent_num, start_offset, mood="", speaker=""):
 		self.sent_num = sent_num
 		self.start_offset = start_offset
@@ -302,19 +599,186 @@ class Sentence:
 		return "S" + str(self.sent_num) + " from T" + str(self.start_offset + 1) + ", mood: " + mood  + ", speaker: " + speaker + ", type: " + self.s_type
 
 
-def get_descendants(parent, children_dict, seen_tokens, sent_num, conll_tokens):
-	my_descendants = []
-	my_descendants += children_dict[parent]
-	for child in children_dict[parent]:
-		if child in seen_tokens:
-			if sys.version_info[0] < 3:
-				sys.stderr.write("\nCycle detected in syntax tree in " + conll_tokens[int(parent)].lex.docname + " in sentence " + str(sent_num) + " (child of token: '" + conll_tokens[int(parent)].text.encode("utf8") + "')\n")
-			else:
-				sys.stderr.write("\nCycle detected in syntax tree in " + conll_tokens[int(parent)].lex.docname + " in sentence " + str(sent_num) + " (child of token: '" + conll_tokens[int(parent)].text + "')\n")
-			sys.exit("Exiting due to invalid input\n")
-		else:
-			seen_tokens += [child]
-	for child in children_dict[parent]:
-		if child in children_dict:
-			my_descendants += get_descendants(child, children_dict, seen_tokens, sent_num, conll_tokens)
-	return my_descendants
+class DocStats(object):
+	"""
+	Document level frequency tables and lengths, used for document features of markables. Token based statistics are
+	collected in the single pass which reads the input, markable based ones as each markable is analyzed.
+	"""
+
+	__slots__ = ["lemma_counts", "head_counts", "entity_counts", "token_count", "sentence_lengths"]
+
+	def __init__(self):
+		self.lemma_counts = defaultdict(int)  # Lemmas of all words, excluding multiword token lines
+		self.head_counts = defaultdict(int)  # Head lemmas of markables
+		self.entity_counts = defaultdict(int)  # Entity types of markables, as first assigned
+		self.token_count = 0  # Number of words, excluding multiword token lines
+		self.sentence_lengths = []
+
+	def lemma_freq(self, lemma):
+		"""
+		:param lemma: a token's lemma
+		:return: number of words in the document with this lemma in the input, or 0.0 if there are none
+		"""
+		return self.lemma_counts.get(lemma, 0.0)
+
+	def add_markable(self, mark):
+		self.head_counts[mark.lemma] += 1
+		self.entity_counts[mark.entity] += 1
+
+
+# Markable properties which coref rules can require to be identical with the anaphor's ('text=$1'), and which are
+# not changed once the markable is created, so markables can be indexed by them. Entity and subclass are excluded,
+# since they are changed by propagation during coreference resolution.
+INDEXED_MARKABLE_PROPS = ("text", "text_lower", "lemma")
+
+
+class MarkableIndex(object):
+	"""
+	Inverted index of the markables in a document, from the values of INDEXED_MARKABLE_PROPS to the positions of the
+	markables with that value in the document's list of markables. Markables are added in the same order as they are
+	appended to that list, so that candidates sharing a value with an anaphor can be retrieved for a rule's search
+	window without examining every markable in the window.
+	"""
+
+	__slots__ = ["positions", "size"]
+
+	def __init__(self):
+		self.positions = dict((prop, defaultdict(list)) for prop in INDEXED_MARKABLE_PROPS)
+		self.size = 0
+
+	def add_markable(self, mark):
+		for prop in INDEXED_MARKABLE_PROPS:
+			self.positions[prop][str(getattr(mark, prop))].append(self.size)
+		self.size += 1
+
+	def lookup(self, prop, value, window_start=0):
+		"""
+		:param prop: one of INDEXED_MARKABLE_PROPS
+		:param value: the value as a string, as compared by coref rule constraints
+		:param window_start: position of the first markable to include
+		:return: ascending list of positions of markables at or after window_start with this value
+		"""
+		positions = self.positions[prop].get(value)
+		if positions is None:
+			return []
+		return positions[bisect_left(positions, window_start):]
+
+
+class SubtreeIndex(object):
+	"""
+	Index of the descendants of the tokens in one sentence, built with a single iterative depth first traversal
+	of the children dictionary. Each subtree occupies a contiguous range of the traversal order, and the lowest and
+	highest token index of each subtree are recorded while the traversal unwinds, so the token span of a head's
+	descendants is available without collecting them. Descendants can be excluded from a head's subtree, e.g. to
+	form a markable for the first conjunct of a coordination.
+	"""
+
+	__slots__ = ["order", "ranges", "spans", "excluded"]
+
+	def __init__(self, children=None, keys=(), sent_num=None, conll_tokens=None):
+		"""
+		:param children: dictionary from token ids to lists of child token ids
+		:param keys: ids of the tokens in the sentence which appear in children
+		:param sent_num: the sentence number, used to report cycles
+		:param conll_tokens: the document token list, used to report cycles
+		"""
+		self.order = []  # Token ids in traversal order
+		self.ranges = {}  # Token id to start and end position of its descendants in order
+		self.spans = {}  # Token id to lowest and highest token index among its descendants, or None if it has none
+		self.excluded = {}  # Token id to set of ids removed from its descendants
+
+		if children is None:
+			return
+
+		# Traverse from tokens which are not the child of another token in the sentence first, so that each subtree
+		# is traversed only once, then from any remaining tokens, which can only be reached through a cycle
+		dependents = set()
+		for key in keys:
+			dependents.update(children[key])
+		roots = [key for key in keys if key not in dependents]
+		roots += [key for key in keys if key in dependents]
+		for root in roots:
+			if root not in self.ranges:
+				self.traverse(root, children, sent_num, conll_tokens)
+
+	def traverse(self, root, children, sent_num, conll_tokens):
+		order = self.order
+		ranges = self.ranges
+		spans = self.spans
+		seen = set()
+		stack = [[root, iter(children[root]), len(order), None, None]]
+		while stack:
+			frame = stack[-1]
+			child = next(frame[1], None)
+			if child is None:
+				stack.pop()
+				node, _, start, low, high = frame
+				ranges[node] = (start, len(order))
+				spans[node] = None if low is None else (low, high)
+				if stack:  # Add this subtree to the parent's span
+					parent = stack[-1]
+					if low is not None:
+						if parent[3] is None or low < parent[3]:
+							parent[3] = low
+						if parent[4] is None or high > parent[4]:
+							parent[4] = high
+				continue
+			if child in seen:
+				parent = frame[0]
+				if sys.version_info[0] < 3:
+					sys.stderr.write("\nCycle detected in syntax tree in " + conll_tokens[int(parent)].lex.docname + " in sentence " + str(sent_num) + " (child of token: '" + conll_tokens[int(parent)].text.encode("utf8") + "')\n")
+				else:
+					sys.stderr.write("\nCycle detected in syntax tree in " + conll_tokens[int(parent)].lex.docname + " in sentence " + str(sent_num) + " (child of token: '" + conll_tokens[int(parent)].text + "')\n")
+				sys.exit("Exiting due to invalid input\n")
+			seen.add(child)
+			order.append(child)
+			index = int(child)
+			if frame[3] is None or index < frame[3]:
+				frame[3] = index
+			if frame[4] is None or index > frame[4]:
+				frame[4] = index
+			if child in children:
+				stack.append([child, iter(children[child]), len(order), None, None])
+
+	def __contains__(self, tok_id):
+		return tok_id in self.ranges
+
+	def __getitem__(self, tok_id):
+		"""
+		:param tok_id: id of an indexed token
+		:return: list of the ids of the token's descendants, without any excluded ones
+		"""
+		start, end = self.ranges[tok_id]
+		if tok_id in self.excluded:
+			excluded = self.excluded[tok_id]
+			return [desc for desc in self.order[start:end] if desc not in excluded]
+		return self.order[start:end]
+
+	def span(self, tok_id):
+		"""
+		:param tok_id: id of an indexed token
+		:return: tuple of the lowest and highest token index among the token's descendants, or None if it has none
+		"""
+		if tok_id in self.excluded:
+			descendants = [int(desc) for desc in self[tok_id]]
+			if len(descendants) == 0:
+				return None
+			return min(descendants), max(descendants)
+		return self.spans[tok_id]
+
+	def exclude(self, tok_id, desc_id, subtree=False):
+		"""
+		Removes a token, and optionally its own descendants, from the descendants of tok_id
+
+		:param tok_id: id of an indexed token
+		:param desc_id: id of the descendant to remove
+		:param subtree: whether to also remove the descendants of desc_id
+		:return: void
+		"""
+		if tok_id not in self.ranges:
+			return
+		if tok_id not in self.excluded:
+			self.excluded[tok_id] = set()
+		self.excluded[tok_id].add(desc_id)
+		if subtree and desc_id in self.ranges:
+			self.excluded[tok_id].update(self[desc_id])
@@ -1,7 +1,7 @@
 import re
 from .xrenner_marker import remove_suffix_tokens
 from .xrenner_propagate import *
-from .xrenner_classes import Markable, ParsedToken
+from .xrenner_classes import Markable, ParsedToken, PROPER_POS, DET_FUNC
 from collections import OrderedDict
 
 """
@@ -81,7 +81,7 @@ def modifiers_compatible(markable, candidate, lex, allow_force_proper_mod_match=
 			second_mark = candidate
 		first_mods = (comp_mod.text for comp_mod in first_mark.head.modifiers)
 		for mod in second_mark.head.modifiers:
-			if lex.filters["det_func"].match(mod.func) is None:  # Exclude determiners from this check
+			if not mod.flags & DET_FUNC:  # Exclude determiners from this check
 				if mod.text not in first_mods:
 					if lex.filters["use_new_modifier_exceptions"]:
 						if mod.text not in lex.exceptional_new_modifiers:
@@ -109,10 +109,10 @@ def modifiers_compatible(markable, candidate, lex, allow_force_proper_mod_match=
 						return False
 			# Check that the two markables do not have non-identical proper noun modifiers
 			if proper_mod_must_match:
-				if lex.filters["proper_pos"].match(mod.pos):
+				if mod.flags & PROPER_POS:
 					candidate_proper_mod_texts = []
 					for mod2 in candidate.head.modifiers:
-						if lex.filters["proper_pos"].match(mod2.pos):
+						if mod2.flags & PROPER_POS:
 							candidate_proper_mod_texts.append(mod2.text)
 					if mod.text not in candidate_proper_mod_texts and len(candidate_proper_mod_texts) > 0:
 						return False
@@ -121,11 +121,11 @@ def modifiers_compatible(markable, candidate, lex, allow_force_proper_mod_match=
 	# e.g. 'Georgetown University' is incompatible with 'Boston University' even if those entities are not in lexicon
 	for mod in markable.head.modifiers:
 		if mod.text in lex.entities and (mod.text.istitle() or not lex.filters["cap_names"]):
-			if re.sub('\t.*', "", lex.entities[mod.text][0]) == lex.filters["place_def_entity"]:
+			if lex.entities[mod.text][0].entity == lex.filters["place_def_entity"]:
 				for candidate_mod in candidate.head.modifiers:
 					if candidate_mod.text != mod.text:
 						if candidate_mod.text in lex.entities and (candidate_mod.text.istitle() or not lex.filters["cap_names"]):
-							if re.sub('\t.*', "", lex.entities[candidate_mod.text][0]) == lex.filters["place_def_entity"]:
+							if lex.entities[candidate_mod.text][0].entity == lex.filters["place_def_entity"]:
 								markable.non_antecdent_groups.add(candidate.group)
 								return False
 
@@ -1,7 +1,9 @@
+import sys
 from .xrenner_marker import *
 from .xrenner_compatible import *
 from .xrenner_propagate import *
-from .xrenner_rule import CorefRule, ConstraintMatcher
+from .xrenner_rule import CorefRule, CorefRuleSet, ConstraintMatcher
+from .xrenner_classes import LEMMA_MATCH_POS
 
 """
 Coreference resolution module. Iterates through markables to find possible matches based on rules.
@@ -24,41 +26,77 @@ def find_antecedent(markable, previous_markables, lex, restrict_rule=""):
 	# DEBUG point
 	if markable.text == lex.debug["ana"]:
 		a=5
+		for rule, constraint in lex.coref_rules.eliminating_constraints(markable, lex, restrict_rule):
+			if constraint is None:
+				sys.stderr.write("Rule " + str(rule.rule_num) + " (" + str(rule) + ") applies to anaphor '" + markable.text + "'\n")
+			else:
+				sys.stderr.write("Rule " + str(rule.rule_num) + " (" + str(rule) + ") eliminated for anaphor '" + markable.text + "' by constraint " + str(constraint) + "\n")
 	candidate = None
 	matching_rule = None
-	for i, rule in enumerate(lex.coref_rules):
-		# If this call of find_antecedent is limited to certain rules, check that the restriction is in the rule
-		if restrict_rule == "" or restrict_rule in rule.ana_spec:
-			if coref_rule_applies(lex, rule.ana_constraints, markable):
-				candidate = search_prev_markables(markable, previous_markables, rule, lex)
-				if candidate is not None:
-					matching_rule = rule.propagation
-					break
+	window_starts = {}  # Position of the first candidate within each rule distance from the markable's sentence
+	# Rules are limited to those containing restrict_rule if specified, and whose anaphor constraints match
+	for rule in lex.coref_rules.applicable_rules(markable, lex, restrict_rule):
+		if rule.max_distance not in window_starts:
+			window_starts[rule.max_distance] = find_sentence_start(previous_markables, markable.sent_num - rule.max_distance)
+		candidate = search_prev_markables(markable, previous_markables, rule, lex, window_starts[rule.max_distance])
+		if candidate is not None:
+			matching_rule = rule.propagation
+			break
 
 	return candidate, matching_rule
 
 
-def search_prev_markables(markable, previous_markables, rule, lex):
+def find_sentence_start(markables, sent_num):
+	"""
+	Finds the position of the first markable in a sentence or later by binary search, since markables are
+	appended to the document's list in sentence order
+
+	:param markables: list of Markable objects in sentence order
+	:param sent_num: sentence number to look for
+	:return: index of the first markable whose sentence number is at least sent_num, or len(markables) if there is none
+	"""
+	low = 0
+	high = len(markables)
+	while low < high:
+		middle = (low + high) // 2
+		if markables[middle].sentence.sent_num < sent_num:
+			low = middle + 1
+		else:
+			high = middle
+	return low
+
+
+def search_prev_markables(markable, previous_markables, rule, lex, window_start=None):
 	"""
 	Search for antecedent to specified markable using a specified rule
 	
 	:param markable: The markable object to find an antecedent for
 	:param previous_markables: The list of know markables up to and including the current sentence; markables beyond current markable but in its sentence are included for cataphora.
+	:param rule: the CorefRule to check, including antecedent constraints, maximum distance and propagation
 	:param ante_constraints: A list of ContraintMatcher objects describing the antecedent
 	:param ante_spec: The antecedent specification part of the coref rule being checked, as a string
 	:param lex: the LexData object with gazetteer information and model settings
 	:param max_dist: Maximum distance in sentences for the antecedent search (0 for search within sentence)
 	:param propagate: Whether to progpagate features upon match and in which direction
+	:param window_start: position of the first markable in previous_markables within the rule's maximum distance, found by find_sentence_start if not given
 	:return: the selected candidate Markable object
 	"""
 
 	ante_constraints, ante_spec, rule_num, max_dist, propagate, clf_name = rule.ante_constraints, rule.ante_spec, rule.rule_num, rule.max_distance, rule.propagation, rule.clf_name
 
+	if window_start is None:
+		window_start = find_sentence_start(previous_markables, markable.sent_num - max_dist)
+
+	# Only markables within max_dist sentences can be candidates
 	candidate_set = set([])
-	if ante_spec.find("lookahead") > -1:
-		referents_to_loop = previous_markables
+	if rule.index_prop is not None and lex.markable_index.size == len(previous_markables):
+		# Only markables sharing the rule's indexed property with the anaphor can satisfy its constraints
+		positions = lex.markable_index.lookup(rule.index_prop, str(getattr(markable, rule.index_prop)), window_start)
+		referents_to_loop = [previous_markables[position] for position in positions]
 	else:
-		referents_to_loop = reversed(previous_markables)
+		referents_to_loop = previous_markables[window_start:]
+	if ante_spec.find("lookahead") == -1:
+		referents_to_loop = reversed(referents_to_loop)
 	for candidate in referents_to_loop:  # loop through previous markables backwards
 
 		#DEBUG breakpoint:
@@ -66,60 +104,56 @@ def search_prev_markables(markable, previous_markables, rule, lex):
 			a = 5
 			if candidate.text == lex.debug["ante"]:
 				b=6
-		if markable.sentence.sent_num - candidate.sentence.sent_num <= max_dist:
-			if ((int(markable.head.id) > int(candidate.head.id) and
-			ante_spec.find("lookahead") == -1) or (int(markable.head.id) < int(candidate.head.id) and ante_spec.find("lookahead") > -1)):
-				if candidate.group not in markable.non_antecdent_groups:
-					if coref_rule_applies(lex, ante_constraints, candidate, markable):
-						if not lex.filters["no_overlap"] or not markables_overlap(markable, candidate, lex):
-							if markable.form == "pronoun":
-								if agree_compatible(markable, candidate, lex) or (ante_spec.find("anyagree") > -1 and group_agree_compatible(markable,candidate,previous_markables,lex)):
-									if entities_compatible(markable, candidate, lex) and cardinality_compatible(markable, candidate, lex):
-										if speaker_compatible(markable,candidate,previous_markables):
-											candidate_set.add(candidate)
-							elif markable.text == candidate.text or (len(markable.text) > 4 and (candidate.text.lower() == markable.text.lower())):
-								#propagate_entity(markable, candidate, propagate)
-								candidate_set.add(candidate)
-								#return candidate
-							elif markable.text + "|" + candidate.text in lex.coref and entities_compatible(
-									markable, candidate, lex) and agree_compatible(markable, candidate, lex):
+		if ((markable.head.index > candidate.head.index and
+		ante_spec.find("lookahead") == -1) or (markable.head.index < candidate.head.index and ante_spec.find("lookahead") > -1)):
+			if candidate.group not in markable.non_antecdent_groups:
+				if coref_rule_applies(lex, ante_constraints, candidate, markable):
+					if not lex.filters["no_overlap"] or not markables_overlap(markable, candidate, lex):
+						if markable.form == "pronoun":
+							if agree_compatible(markable, candidate, lex) or (ante_spec.find("anyagree") > -1 and group_agree_compatible(markable,candidate,previous_markables,lex)):
+								if entities_compatible(markable, candidate, lex) and cardinality_compatible(markable, candidate, lex):
+									if speaker_compatible(markable,candidate,previous_markables):
+										candidate_set.add(candidate)
+						elif markable.text == candidate.text or (len(markable.text) > 4 and (candidate.text.lower() == markable.text.lower())):
+							#propagate_entity(markable, candidate, propagate)
+							candidate_set.add(candidate)
+							#return candidate
+						elif markable.text + "|" + candidate.text in lex.coref and entities_compatible(
+								markable, candidate, lex) and agree_compatible(markable, candidate, lex):
+							candidate_set.add(candidate)
+							#return candidate
+						elif markable.core_text + "|" + candidate.core_text in lex.coref and entities_compatible(
+								markable, candidate, lex) and agree_compatible(markable, candidate, lex):
+							candidate_set.add(candidate)
+							#return candidate
+						elif markable.entity == candidate.entity and agree_compatible(markable, candidate, lex) and (markable.head.text == candidate.head.text or
+						(len(markable.head.text) > 3 and (candidate.head.text.lower() == markable.head.text.lower())) or
+						(markable.core_text.count(" ") > 2 and (markable.core_text.lower() == candidate.core_text.lower())) or
+						(markable.head.lemma == candidate.head.lemma and markable.head.flags & LEMMA_MATCH_POS
+						and candidate.head.flags & LEMMA_MATCH_POS)):
+							if modifiers_compatible(markable, candidate, lex) and modifiers_compatible(candidate, markable, lex):
 								candidate_set.add(candidate)
-								#return candidate
-							elif markable.core_text + "|" + candidate.core_text in lex.coref and entities_compatible(
-									markable, candidate, lex) and agree_compatible(markable, candidate, lex):
+						elif (markable.entity == candidate.entity or len(set(markable.alt_entities) & set(candidate.alt_entities))>0) and isa(markable, candidate, lex):
+							candidate.isa = True  # This is an 'isa' candidate
+							candidate_set.add(candidate)
+						elif agree_compatible(markable,candidate,lex) and ((markable.head.text == candidate.head.text) or (markable.head.lemma == candidate.head.lemma and
+						markable.head.flags & LEMMA_MATCH_POS and candidate.head.flags & LEMMA_MATCH_POS)):
+							if merge_entities(markable, candidate, previous_markables, lex):
 								candidate_set.add(candidate)
-								#return candidate
-							elif markable.entity == candidate.entity and agree_compatible(markable, candidate, lex) and (markable.head.text == candidate.head.text or
-							(len(markable.head.text) > 3 and (candidate.head.text.lower() == markable.head.text.lower())) or
-							(markable.core_text.count(" ") > 2 and (markable.core_text.lower() == candidate.core_text.lower())) or
-							(markable.head.lemma == candidate.head.lemma and lex.filters["lemma_match_pos"].match(markable.head.pos) is not None
-							and lex.filters["lemma_match_pos"].match(candidate.head.pos) is not None)):
-								if modifiers_compatible(markable, candidate, lex) and modifiers_compatible(candidate, markable, lex):
-									candidate_set.add(candidate)
-							elif (markable.entity == candidate.entity or len(set(markable.alt_entities) & set(candidate.alt_entities))>0) and isa(markable, candidate, lex):
+						elif entities_compatible(markable, candidate, lex) and isa(markable, candidate, lex):
+							if merge_entities(markable, candidate, previous_markables, lex):
 								candidate.isa = True  # This is an 'isa' candidate
 								candidate_set.add(candidate)
-							elif agree_compatible(markable,candidate,lex) and ((markable.head.text == candidate.head.text) or (markable.head.lemma == candidate.head.lemma and
-							lex.filters["lemma_match_pos"].match(markable.head.pos) is not None and lex.filters["lemma_match_pos"].match(candidate.head.pos) is not None)):
-								if merge_entities(markable, candidate, previous_markables, lex):
-									candidate_set.add(candidate)
-							elif entities_compatible(markable, candidate, lex) and isa(markable, candidate, lex):
-								if merge_entities(markable, candidate, previous_markables, lex):
-									candidate.isa = True  # This is an 'isa' candidate
-									candidate_set.add(candidate)
-						elif lex.filters["match_acronyms"] and markable.head.text.isupper() or candidate.head.text.isupper():
-								if acronym_match(markable, candidate, lex) or acronym_match(candidate, markable, lex):
-									if modifiers_compatible(markable, candidate, lex) and modifiers_compatible(candidate, markable, lex):
-										if merge_entities(markable, candidate, previous_markables, lex):
-											candidate_set.add(candidate)
-						if ante_spec.find("anytext") > -1:
-								if (ante_spec.find("anyagree") > -1 and group_agree_compatible(markable,candidate,previous_markables,lex)) or agree_compatible(markable, candidate, lex):
-									if (ante_spec.find("anycardinality") > -1 or cardinality_compatible(markable,candidate,lex)):
-										if (ante_spec.find("anyentity") > -1 or entities_compatible(markable,candidate,lex)):
-											candidate_set.add(candidate)
-		elif ante_spec.find("lookahead") == -1:
-			# Reached back too far according to max_dist, stop looking
-			break
+					elif lex.filters["match_acronyms"] and markable.head.text.isupper() or candidate.head.text.isupper():
+							if acronym_match(markable, candidate, lex) or acronym_match(candidate, markable, lex):
+								if modifiers_compatible(markable, candidate, lex) and modifiers_compatible(candidate, markable, lex):
+									if merge_entities(markable, candidate, previous_markables, lex):
+										candidate_set.add(candidate)
+					if ante_spec.find("anytext") > -1:
+							if (ante_spec.find("anyagree") > -1 and group_agree_compatible(markable,candidate,previous_markables,lex)) or agree_compatible(markable, candidate, lex):
+								if (ante_spec.find("anycardinality") > -1 or cardinality_compatible(markable,candidate,lex)):
+									if (ante_spec.find("anyentity") > -1 or entities_compatible(markable,candidate,lex)):
+										candidate_set.add(candidate)
 
 	if len(candidate_set) > 0:
 		candidates_to_remove = set([])
@@ -2,16 +2,21 @@
 
 import gc
 import os
+import hashlib
 from os import listdir
 from os.path import isfile, join
 import re
 import sys, io
-from collections import defaultdict
-from .xrenner_rule import CorefRule
+from collections import defaultdict, namedtuple
+from .xrenner_rule import CorefRule, CorefRuleSet, ConstraintProfile
+from .xrenner_lexstore import MappedTable, write_store, read_store_key
+from .xrenner_classes import DocStats, MarkableIndex, LabelFlags, MarkHeadTable, LRUCache, POS_FLAG_FILTERS, FUNC_FLAG_FILTERS
 
 if sys.version_info[0] < 3:
 	# Python 2
 	PY2 = True
+	import cPickle as pickle
+	intern_string = intern
 	from ConfigParser import ConfigParser, NoSectionError
 	def unicode_split_reader(f):
 		return [line.replace("\n","").replace('\\"','"').split('\t') for line in f.read().strip().split("\n")]
@@ -19,15 +24,182 @@ if sys.version_info[0] < 3:
 else:
 	# Python 3
 	PY2 = False
+	import pickle
+	intern_string = sys.intern
 	from configparser import NoSectionError, RawConfigParser as ConfigParser
 	import csv
 
+# Version of the compiled model cache format; increment when the structure of cached LexData attributes changes
+CACHE_FORMAT = 6
+
+# Maximum number of (text, function, parent) combinations whose entity options are kept, see lookup_entity_text
+ENTITY_CASCADE_CACHE_SIZE = 50000
+# Maximum number of head strings whose affix based entity distributions are kept, see get_entity_by_affix
+AFFIX_CACHE_SIZE = 20000
+
 """
 LexData class - container object for lexical information, gazetteers etc.
 
 Author: Amir Zeldes
 """
 
+
+# Pre-parsed gazetteer entry from entities.tab or entity_heads.tab, with the 'subclass/agree' column split up
+EntityRecord = namedtuple("EntityRecord", ["entity", "subclass", "agree", "freq"])
+
+
+# Merged entry for one string from all gazetteers used to resolve entities, names and atoms; None for gazetteers
+# which do not contain the string, otherwise the gazetteer's value (True for last names and atoms)
+GazetteerEntry = namedtuple("GazetteerEntry", ["entities", "entity_heads", "name", "first_name", "last_name", "atom"])
+EMPTY_GAZETTEER_ENTRY = GazetteerEntry(None, None, None, None, None, None)
+
+
+def entity_records(value):
+	"""
+	Restores EntityRecord tuples in an entities or entity_heads entry read from a lexicon store
+	"""
+	return [EntityRecord(*record) for record in value]
+
+
+def gazetteer_entry(value):
+	"""
+	Restores a GazetteerEntry with its EntityRecord tuples read from a lexicon store
+	"""
+	entities, entity_heads = value[0:2]
+	return GazetteerEntry(entity_records(entities) if entities is not None else None,
+						  entity_records(entity_heads) if entity_heads is not None else None, *value[2:])
+
+
+def int_dict():
+	return defaultdict(int)
+
+
+def str_dict():
+	return defaultdict(str)
+
+
+def nested_str_dict():
+	return defaultdict(str_dict)
+
+
+def nested_str_defaultdict(value):
+	"""
+	Restores the nested defaultdict structure of a 'quadruple_numeric' table entry read from a lexicon store
+	"""
+	return defaultdict(str_dict, ((key, defaultdict(str, val)) for key, val in value.items()))
+
+
+class PhraseTrie(object):
+	"""
+	Token level trie over multi-token phrases, such as stop list entries or affix tokens. Each token's text is
+	fed to the trie as its space separated pieces, so walking the tokens of a span is equivalent to looking up
+	the span's space joined text, but lookups stop as soon as no phrase can continue the span. Tries with
+	reverse=True hold phrases from right to left, for spans which grow leftwards.
+	"""
+
+	END = None  # Key of the phrase value stored in the node where a phrase ends; never a token piece
+
+	def __init__(self, phrases, reverse=False):
+		"""
+		:param phrases: dictionary from phrases to values, or set of phrases (whose value is then True)
+		:param reverse: whether to store phrases from right to left
+		"""
+		self.reverse = reverse
+		self.root = {}
+		for phrase in phrases:
+			if len(phrase) == 0 or phrase != phrase.strip():  # Stripped lookup strings can never match these
+				continue
+			pieces = phrase.split(" ")
+			if reverse:
+				pieces.reverse()
+			node = self.root
+			for piece in pieces:
+				if piece not in node:
+					node[piece] = {}
+				node = node[piece]
+			node[PhraseTrie.END] = phrases[phrase] if isinstance(phrases, dict) else True
+
+	def step(self, node, text):
+		"""
+		:param node: the node reached so far, initially the root
+		:param text: text of the next token
+		:return: the node reached after the token's text, or None if no phrase continues with it
+		"""
+		if " " not in text:
+			return node.get(text)
+		pieces = text.split(" ")
+		if self.reverse:
+			pieces.reverse()
+		for piece in pieces:
+			node = node.get(piece)
+			if node is None:
+				return None
+		return node
+
+
+class AffixTrie(object):
+	"""
+	Character trie over the affixes in LexData.morph, whose nodes hold the entity probability distribution of the
+	affix ending there, normalized once at construction. Tries with reverse=True hold affixes from right to left,
+	for looking up suffixes of a word by walking backwards from its last character.
+	"""
+
+	END = None  # Key of the distribution stored in the node where an affix ends; never a character
+
+	def __init__(self, morph, reverse=True):
+		"""
+		:param morph: dictionary from affixes to dictionaries mapping entity classes to type frequencies
+		:param reverse: whether to store affixes from right to left
+		"""
+		self.reverse = reverse
+		self.root = {}
+		for affix, options in morph.items():
+			candidates = 0
+			probs = {}
+			for key, value in options.items():
+				candidates += value
+				probs[key.split("/")[0]] = float(value)
+			for entity in probs:
+				probs[entity] = probs[entity] / candidates
+			node = self.root
+			for char in (reversed(affix) if reverse else affix):
+				if char not in node:
+					node[char] = {}
+				node = node[char]
+			node[AffixTrie.END] = probs
+
+	def lookup(self, text, affix_max):
+		"""
+		Finds the entity distribution for a word based on its affixes. Between one and affix_max characters of the word
+		are left out of the affix, and at least two are kept: in suffix tries the longest matching suffix is used,
+		in prefix tries the shortest matching prefix.
+
+		:param text: the word to look up
+		:param affix_max: maximum number of characters of the word left out of the affix
+		:return: dictionary from entity classes to probabilities, which must not be modified, or an empty dictionary
+		"""
+		length = len(text)
+		max_left_out = min(affix_max, length - 2)
+		node = self.root
+		if self.reverse:
+			found = None
+			for depth in range(1, length):
+				node = node.get(text[length - depth])
+				if node is None:
+					break
+				if depth >= length - max_left_out and AffixTrie.END in node:
+					found = node[AffixTrie.END]
+			return found if found is not None else {}
+		else:
+			for depth in range(1, max_left_out + 1):
+				node = node.get(text[depth - 1])
+				if node is None:
+					break
+				if AffixTrie.END in node:
+					return node[AffixTrie.END]
+			return {}
+
+
 class LexData:
 	"""
 	Class to hold lexical information from gazetteers and training data.
@@ -35,12 +207,48 @@ class LexData:
 	configuration files.
 	"""
 
-	def __init__(self, model, xrenner, override=None, rule_based=False, no_seq=False):
+	# Attributes which are not part of the compiled model and are never written to the model cache
+	uncached_attrs = {"model", "docname", "dump", "dump_headers", "xrenner", "entity_oracle", "oracle_counters",
+					  "doc_stats", "markable_index", "model_files", "cache_file", "cache_key", "table_cache",
+					  "sequencer", "pos_flags", "func_flags", "mark_heads",
+					  "entity_cascade_cache", "affix_entity_cache", "morph_trie", "constraint_order_file", "constraint_profile"}
+
+	# Large gazetteer tables which can be served from a memory-mapped lexicon store, with the wrapper applied
+	# to values read from the store and the factory for missing keys, restoring defaultdict behavior
+	mapped_tables = {"entities": (entity_records, None), "entity_heads": (entity_records, None), "similar": (None, None),
+					 "isa": (None, None), "entity_deps": (nested_str_defaultdict, nested_str_dict),
+					 "lex_deps": (nested_str_defaultdict, nested_str_dict), "gazetteer_index": (gazetteer_entry, None)}
+
+	# Optional gazetteers which are only read from the model when first accessed, mapping attribute names
+	# to the model file, read_delim mode (or None for a dedicated reader) and a factory for models without the file
+	lazy_files = {"entity_deps": ("entity_deps.tab", "quadruple_numeric", dict),
+				  "lex_deps": ("lex_deps.tab", "quadruple_numeric", dict),
+				  "hasa": ("hasa.tab", "triple_numeric", lambda: defaultdict(int_dict)),
+				  "coref": ("coref.tab", "normal", dict),
+				  "numbers": ("numbers.tab", "double", dict),
+				  "affix_tokens": ("affix_tokens.tab", "normal", dict),
+				  "antonyms": ("antonyms.tab", None, dict),
+				  "isa": ("isa.tab", None, dict),
+				  "similar": ("similar.tab", "double_with_sep", dict),
+				  "nominalizations": ("nominalizations.tab", "triple_numeric", dict),
+				  "freqs": ("freqs.tab", "double_numeric", int_dict)}
+
+	# Token level phrase tries, compiled on first access from the gazetteer named in the tuple, with a flag for
+	# tries which hold phrases from right to left
+	phrase_tries = {"stop_trie": ("stop_list", False),
+					"affix_trie": ("affix_tokens", False),
+					"affix_trie_rev": ("affix_tokens", True),
+					"mod_trie": ("entity_mods", False)}
+
+	def __init__(self, model, xrenner, override=None, rule_based=False, no_seq=False, no_cache=False, mmap_lex=False):
 		"""
 		:param model: model - string name of the model to read from models/
 		:param override: override - optional name of a section to use in models/override.ini
 		:param rule_based: do not use machine learning classifiers for coreference resolution
 		:param no_seq: do not use machine learning sequence taggers for entity resolution
+		:param no_cache: do not read or write the compiled model cache (.xrc and .xrt files next to the model)
+		:param mmap_lex: serve large gazetteers from a read-only memory-mapped lexicon store (.xrl file next to
+			the model), which is shared between processes instead of copied into each one
 		"""
 		gc.disable()
 		self.model = model
@@ -53,8 +261,8 @@ class LexData:
 		self.xrenner = xrenner
 		self.entity_oracle = None  # Holds external entity predictions to use instead of system predictions
 		self.oracle_counters = [0,0,0]
-		self.lemma_freqs = defaultdict(float)  # Holds proportional frequency of each lemma in document
-		self.token_count = 0  # Holds copy of token count for document from Xrenner object
+		self.doc_stats = DocStats()  # Frequencies and lengths for the current document, replaced by Xrenner.read_parse
+		self.markable_index = MarkableIndex()  # Positions of the current document's markables by text and lemma
 
 		# Lookup model path
 
@@ -99,6 +307,56 @@ class LexData:
 				raise IOError("Could not open model file " + model_path)
 
 
+		# Read compiled lexical data from the model cache if it is up to date, otherwise compile and cache it
+		self.cache_file = None
+		self.cache_key = None
+		self.table_cache = not no_cache  # Whether optional gazetteers are cached when first read
+		if not no_cache or mmap_lex:  # The lexicon store is validated using the same key as the cache
+			self.cache_file = self.get_cache_file(model_path, override, rule_based, mmap_lex)
+			self.cache_key = self.get_cache_key(model_path, override, rule_based)
+		if no_cache or not self.read_cache():
+			self.compile_model(override, rule_based)
+			if mmap_lex:
+				self.map_tables()
+			if not no_cache:
+				self.write_cache()
+
+		# Check antecedent constraints in the order found by a previous profiling run, if any
+		self.constraint_order_file = self.get_constraint_order_file(model_path)
+		self.constraint_profile = None
+		self.read_constraint_order()
+
+		# Memos of POS and function filter results as token bit flags, and of markable head eligibility
+		self.pos_flags = LabelFlags(self.filters, POS_FLAG_FILTERS)
+		self.func_flags = LabelFlags(self.filters, FUNC_FLAG_FILTERS)
+		self.mark_heads = MarkHeadTable(self.filters["pos_func_heads"], self.pos_flags, self.func_flags)
+		# Entity options of looked up texts, kept across documents and replaced together with this object on reload
+		self.entity_cascade_cache = LRUCache(ENTITY_CASCADE_CACHE_SIZE)
+		self.affix_entity_cache = LRUCache(AFFIX_CACHE_SIZE)
+
+		# Load sequence classifier if specified
+		self.sequencer = None
+		if "sequencer" in self.filters and not no_seq:
+			if len(self.filters["sequencer"]) > 0:
+				from .xrenner_sequence import Sequencer
+				if self.filters["sequencer"] in self.model_files:  # Sequencer model is in model directory
+					model_file = self.model_files[self.filters["sequencer"]]
+					self.sequencer = Sequencer(model_path=self.filters["sequencer"],pickle=model_file)
+				else:
+					self.sequencer = Sequencer(model_path=self.filters["sequencer"])
+				if "sequencer_override_thresh" not in self.filters:
+					self.filters["sequencer_override_thresh"] = 1.0  # By default, prefer KB entries to sequencer
+
+		gc.enable()
+
+	def compile_model(self, override=None, rule_based=False):
+		"""
+		Reads all configuration files and gazetteers from the model and compiles derived lexical data
+
+		:param override: optional name of a section to use in models/override.ini
+		:param rule_based: do not use machine learning classifiers for coreference resolution
+		:return: void
+		"""
 		self.entity_sums = defaultdict(int)
 
 		# Get configuration
@@ -119,24 +377,15 @@ class LexData:
 		self.open_close_punct = self.read_delim(self.model_files['open_close_punct.tab']) if "open_close_punct.tab" in self.model_files else {}
 		self.open_close_punct_rev = dict((v, k) for k, v in self.open_close_punct.items())
 		self.entity_mods = self.read_delim(self.model_files['entity_mods.tab'], 'triple', 'mod_atoms') if "entity_mods.tab" in self.model_files else {}
-		self.entity_deps = self.read_delim(self.model_files['entity_deps.tab'], 'quadruple_numeric') if "entity_deps.tab" in self.model_files else {}
-		self.lex_deps = self.read_delim(self.model_files['lex_deps.tab'], 'quadruple_numeric') if "lex_deps.tab" in self.model_files else {}
-		self.hasa = self.read_delim(self.model_files['hasa.tab'], 'triple_numeric') if "hasa.tab" in self.model_files else defaultdict(lambda: defaultdict(int))
-		self.coref = self.read_delim(self.model_files['coref.tab']) if "coref.tab" in self.model_files else {}
-		self.numbers = self.read_delim(self.model_files['numbers.tab'], 'double') if "numbers.tab" in self.model_files else {}
-		self.affix_tokens = self.read_delim(self.model_files['affix_tokens.tab']) if "affix_tokens.tab" in self.model_files else {}
-		self.antonyms = self.read_antonyms() if "antonyms.tab" in self.model_files else {}
-		self.isa = self.read_isa() if "isa.tab" in self.model_files else {}
-		self.similar = self.read_delim(self.model_files['similar.tab'], 'double_with_sep') if "similar.tab" in self.model_files else {}
-		self.nominalizations = self.read_delim(self.model_files['nominalizations.tab'], 'triple_numeric') if "nominalizations.tab" in self.model_files else {}
+		# Further optional gazetteers in lazy_files are read on first access, see __getattr__
 		self.debug = self.read_delim(self.model_files['debug.tab']) if "debug.tab" in self.model_files else {"ana":"","ante":"","ablations":""}
-		self.freqs = self.read_delim(self.model_files['freqs.tab'],'double_numeric') if "freqs.tab" in self.model_files else defaultdict(int)
 		additional_atoms = self.read_delim(self.model_files['atoms.tab'], 'double') if "atoms.tab" in self.model_files else {}
 
 		# Compile atom and first + last name data
 		self.atoms = self.get_atoms()
 		self.atoms.update(additional_atoms)
 		self.first_names, self.last_names = self.get_first_last_names(self.names)
+		self.gazetteer_index = self.get_gazetteer_index()
 
 		if self.filters["no_new_modifiers"] and self.filters["use_new_modifier_exceptions"]:
 			self.exceptional_new_modifiers = self.read_delim(self.model_files['new_modifiers.tab'], 'double') if "new_modifiers.tab" in self.model_files else {}
@@ -162,27 +411,304 @@ class LexData:
 		self.incompatible_mod_pairs = set([])
 		self.incompatible_isa_pairs = set([])
 
-		# Load sequence classifier if specified
-		self.sequencer = None
-		if "sequencer" in self.filters and not no_seq:
-			if len(self.filters["sequencer"]) > 0:
-				from .xrenner_sequence import Sequencer
-				if self.filters["sequencer"] in self.model_files:  # Sequencer model is in model directory
-					model_file = self.model_files[self.filters["sequencer"]]
-					self.sequencer = Sequencer(model_path=self.filters["sequencer"],pickle=model_file)
-				else:
-					self.sequencer = Sequencer(model_path=self.filters["sequencer"])
-				if "sequencer_override_thresh" not in self.filters:
-					self.filters["sequencer_override_thresh"] = 1.0  # By default, prefer KB entries to sequencer
+	def __getattr__(self, name):
+		# Only invoked for attributes not set on the instance, i.e. optional gazetteers which have not been read yet
+		# and phrase and affix tries which have not been compiled yet
+		if name in LexData.lazy_files:
+			value = self.read_lazy_file(name)
+			setattr(self, name, value)
+			return value
+		elif name == "morph_trie":
+			value = AffixTrie(self.morph, self.filters["morph_direction"] != "prefix")
+			setattr(self, name, value)
+			return value
+		elif name in LexData.phrase_tries:
+			source, reverse = LexData.phrase_tries[name]
+			value = PhraseTrie(getattr(self, source), reverse)
+			setattr(self, name, value)
+			return value
+		raise AttributeError(name)
+
+	def read_lazy_file(self, name):
+		"""
+		Reads an optional gazetteer listed in lazy_files from its table cache file, a sidecar .xrt file next to the
+		compiled model cache file, or if that is missing or out of date, from the model, then writing the table cache
 
-		gc.enable()
+		:param name: attribute name of the gazetteer
+		:return: compiled lexical data for the gazetteer, or an empty default if the model does not include the file
+		"""
+		filename, mode, default_factory = self.lazy_files[name]
+		if filename not in self.model_files:
+			return default_factory()
+		table_file = self.cache_file[:-4] + "." + name + ".xrt" if self.table_cache else None
+		if table_file is not None:
+			value = self.read_cache_file(table_file)
+			if value is not None:
+				return value
+		if name == "antonyms":
+			value = self.read_antonyms()
+		elif name == "isa":
+			value = self.read_isa()
+		else:
+			value = self.read_delim(self.model_files[filename], mode)
+		if table_file is not None:
+			self.write_cache_file(table_file, value)
+		return value
+
+	def read_lazy_files(self):
+		"""
+		Reads all optional gazetteers which have not been read yet, e.g. before forking processes sharing this object
+
+		:return: void
+		"""
+		for name in self.lazy_files:
+			getattr(self, name)
+
+	def get_load_report(self):
+		"""
+		Lists which optional gazetteers have been read so far, either on demand or from the model cache, and how
+		often entity lookups were answered from the entity lookup cache
+
+		:return: report string with one line for read and one line for unread model files, and entity lookup cache statistics
+		"""
+		read = [self.lazy_files[name][0] for name in sorted(self.lazy_files) if name in self.__dict__]
+		unread = [self.lazy_files[name][0] for name in sorted(self.lazy_files) if name not in self.__dict__]
+		cache = self.entity_cascade_cache
+		return "Optional model files read: " + (", ".join(read) if len(read) > 0 else "none") + "\n" + \
+			   "Optional model files not needed: " + (", ".join(unread) if len(unread) > 0 else "none") + "\n" + \
+			   "Entity lookup cache: " + str(cache.hits) + " hits, " + str(cache.misses) + " misses (" + \
+			   str(round(100 * cache.hit_rate(), 1)) + "% hit rate)\n"
+
+	def lookup(self, text):
+		"""
+		Gets the entries for a string from all gazetteers used to resolve entities, names and atoms at once
+
+		:param text: string to look up, e.g. a markable's text or one of its normalized variants
+		:return: :class:`GazetteerEntry` for the string
+		"""
+		return self.gazetteer_index.get(text, EMPTY_GAZETTEER_ENTRY)
+
+	def get_gazetteer_index(self):
+		"""
+		Merges the entries of every string in the gazetteers used to resolve entities, names and atoms, so that
+		all of them are found with a single lookup
+
+		:return: dictionary from strings to :class:`GazetteerEntry` tuples
+		"""
+		entities = self.entities
+		entity_heads = self.entity_heads
+		names = self.names
+		first_names = self.first_names
+		last_names = self.last_names
+		atoms = self.atoms
+		index = {}
+		for gazetteer in [entities, entity_heads, names, first_names, last_names, atoms]:
+			for text in gazetteer:
+				if text not in index:
+					index[text] = GazetteerEntry(entities[text] if text in entities else None,
+												 entity_heads[text] if text in entity_heads else None,
+												 names[text] if text in names else None,
+												 first_names[text] if text in first_names else None,
+												 True if text in last_names else None,
+												 True if text in atoms else None)
+		return index
+
+	@staticmethod
+	def get_cache_file(model_path, override=None, rule_based=False, mmap_lex=False):
+		"""
+		Gets the path of the compiled model cache file, a sidecar .xrc file next to the model directory or .xrm file
+
+		:param model_path: path to the model directory or .xrm file
+		:param override: optional name of a section in override.ini, which receives its own cache file
+		:param rule_based: whether classifiers are disabled, which receives its own cache file
+		:param mmap_lex: whether gazetteers are memory-mapped, which receives its own cache file
+		:return: path of the .xrc file
+		"""
+		cache_file = model_path.rstrip(os.sep)
+		if cache_file.endswith(".xrm"):
+			cache_file = cache_file[:-4]
+		if override:
+			cache_file += "." + override
+		if rule_based:
+			cache_file += ".rb"
+		if mmap_lex:
+			cache_file += ".mm"
+		return cache_file + ".xrc"
+
+	@staticmethod
+	def get_constraint_order_file(model_path):
+		"""
+		Gets the path of the antecedent constraint order file, a sidecar .xro file next to the model directory or .xrm file
+
+		:param model_path: path to the model directory or .xrm file
+		:return: path of the .xro file
+		"""
+		order_file = model_path.rstrip(os.sep)
+		if order_file.endswith(".xrm"):
+			order_file = order_file[:-4]
+		return order_file + ".xro"
+
+	def read_constraint_order(self):
+		"""
+		Reorders the antecedent constraints of coref rules as specified in the constraint order file, if it exists.
+		Lines for rules whose antecedent spec has changed since the file was written are ignored with a warning.
+
+		:return: void
+		"""
+		if not os.path.isfile(self.constraint_order_file):
+			return
+		orders = {}
+		try:
+			with io.open(self.constraint_order_file, 'r', encoding="utf8") as f:
+				for line in f:
+					if line.startswith("#") or "\t" not in line:
+						continue
+					fields = line.rstrip("\n").split("\t")
+					orders[int(fields[0])] = (fields[1], [int(i) for i in fields[2].split(",")])
+		except (IOError, ValueError, IndexError):
+			sys.stderr.write("Could not read constraint order file " + self.constraint_order_file + ", using default order\n")
+			return
+		matched = set([])
+		for rule in self.speaker_rules + self.non_speaker_rules:
+			if rule.rule_num in orders:
+				ante_spec, order = orders[rule.rule_num]
+				if ante_spec == rule.ante_spec:
+					rule.order_constraints(order)
+					matched.add(rule.rule_num)
+		unmatched = len(orders) - len(matched)
+		if unmatched > 0:
+			sys.stderr.write("! Ignoring " + str(unmatched) + " entries in constraint order file " + self.constraint_order_file +
+							 " which do not match coref_rules.tab; run with --profile to update it\n")
+
+	def profile_constraints(self):
+		"""
+		Starts recording the selectivity and cost of antecedent constraints for write_constraint_order
+
+		:return: the :class:`ConstraintProfile` object
+		"""
+		if self.constraint_profile is None:
+			self.constraint_profile = ConstraintProfile(self.speaker_rules + self.non_speaker_rules)
+		return self.constraint_profile
+
+	def write_constraint_order(self):
+		"""
+		Writes the best antecedent constraint order found by profiling to the constraint order file, which is used
+		whenever the model is loaded
+
+		:return: path of the .xro file
+		"""
+		self.constraint_profile.write(self.constraint_order_file)
+		return self.constraint_order_file
+
+	def get_cache_key(self, model_path, override=None, rule_based=False):
+		"""
+		Computes a content hash of all model files and the settings that affect compiled lexical data
+
+		:param model_path: path to the model directory or .xrm file
+		:param override: optional name of a section in override.ini
+		:param rule_based: whether classifiers are disabled
+		:return: hexadecimal digest string
+		"""
+		key = hashlib.sha1()
+		settings = [str(CACHE_FORMAT), str(sys.version_info[0]), str(override), str(rule_based)]
+		key.update("|".join(settings).encode("utf8"))
+		if os.path.isdir(model_path):
+			for filename in sorted(self.model_files):
+				key.update(filename.encode("utf8"))
+				with open(model_path + filename, 'rb') as f:
+					key.update(f.read())
+		else:
+			with open(model_path, 'rb') as f:
+				key.update(f.read())
+		return key.hexdigest()
+
+	def map_tables(self):
+		"""
+		Replaces the large gazetteer tables in mapped_tables with read-only views of a memory-mapped lexicon
+		store, a sidecar .xrl file next to the compiled model cache file. The store is only rewritten if it
+		does not match the current model. If it cannot be written, the tables are kept in memory.
+
+		:return: void
+		"""
+		store_file = self.cache_file[:-4] + ".xrl"
+		try:
+			if read_store_key(store_file) != self.cache_key:
+				write_store(store_file, self.cache_key, dict((name, getattr(self, name)) for name in self.mapped_tables))
+			for name, (wrapper, default_factory) in self.mapped_tables.items():
+				setattr(self, name, MappedTable(store_file, name, self.cache_key, wrapper, default_factory))
+		except (IOError, OSError) as e:
+			sys.stderr.write("i Could not use lexicon store " + store_file + " (" + str(e) + "), keeping gazetteers in memory\n")
+
+	def read_cache(self):
+		"""
+		Reads compiled lexical data from the model cache file if its key matches the current model files
+
+		:return: bool - True if the cache was up to date and has been read
+		"""
+		cached = self.read_cache_file(self.cache_file)
+		if cached is None:
+			return False
+		self.__dict__.update(cached)
+		return True
+
+	def write_cache(self):
+		"""
+		Writes compiled lexical data to the model cache file. Optional gazetteers are cached separately when
+		first read, see read_lazy_file.
+
+		:return: void
+		"""
+		cached = dict((key, val) for key, val in self.__dict__.items() if key not in self.uncached_attrs)
+		self.write_cache_file(self.cache_file, cached)
+
+	def read_cache_file(self, cache_file):
+		"""
+		Reads data from a cache file if its key matches the current model files
+
+		:param cache_file: path of the model cache file or of a gazetteer's table cache file
+		:return: the cached data, or None if the file is missing, out of date or unreadable
+		"""
+		if not os.path.isfile(cache_file):
+			return None
+		try:
+			with open(cache_file, 'rb') as f:
+				if pickle.load(f) != self.cache_key:  # Model files or settings changed since cache was written
+					return None
+				return pickle.load(f)
+		except Exception:  # Corrupt or incompatible cache, recompile from model files
+			return None
+
+	def write_cache_file(self, cache_file, data):
+		"""
+		Writes data to a cache file together with the current cache key. Failure to write (e.g. due to a read-only
+		model location) is not an error, the data is then simply compiled again on the next load.
+
+		:param cache_file: path of the model cache file or of a gazetteer's table cache file
+		:param data: picklable compiled lexical data
+		:return: void
+		"""
+		temp_file = cache_file + "." + str(os.getpid())
+		try:
+			with open(temp_file, 'wb') as f:
+				pickle.dump(self.cache_key, f, pickle.HIGHEST_PROTOCOL)
+				pickle.dump(data, f, pickle.HIGHEST_PROTOCOL)
+			if PY2:
+				if os.path.exists(cache_file):
+					os.remove(cache_file)
+				os.rename(temp_file, cache_file)
+			else:
+				os.replace(temp_file, cache_file)  # Atomic, so concurrent readers never see a partial file
+		except Exception:
+			if os.path.exists(temp_file):
+				os.remove(temp_file)
 
 	def read_delim(self, filename, mode="normal", atom_list_name="atoms", add_to_sums=False, sep=","):
 		"""
 		Generic file reader for lexical data in model directory
 
 		:param filename: string - name of the file
-		:param mode: double, triple, quadruple, quadruple_numeric, triple_numeric or low reading mode
+		:param mode: double, triple, quadruple, quadruple_numeric, triple_numeric or low reading mode; quadruple
+			produces lists of EntityRecord tuples
 		:param atom_list_name: list of atoms to use for triple reader mode
 		:param add_to_sums: whether to sum numbers from multiple instances of the same key
 		:param sep: separator for double_with_sep mode
@@ -224,7 +750,7 @@ class LexData:
 				return out_dict
 			elif mode == "quadruple":
 				out_dict = {}
-				for rows in reader:
+				for line_num, rows in enumerate(reader, 1):
 					if not rows[0].startswith('#'):
 						if rows[2].endswith('@'):
 							rows[2] = rows[2][0:-1]
@@ -233,10 +759,18 @@ class LexData:
 							self.entity_sums[rows[1]] += 1
 						if len(rows) < 4:
 							rows.append("0")
+						try:
+							freq = int(rows[3].strip())
+						except ValueError:
+							sys.stderr.write("! Invalid frequency '" + rows[3] + "' in " + getattr(csvfile, "name", "model file") +
+											 " line " + str(line_num) + ", using 0\n")
+							freq = 0
+						subclass, _, agree = rows[2].partition("/")
+						record = EntityRecord(intern_string(rows[1]), intern_string(subclass), intern_string(agree), freq)
 						if rows[0] in out_dict:
-							out_dict[rows[0]].append(rows[1] + "\t" + rows[2] + "\t" + rows[3])
+							out_dict[rows[0]].append(record)
 						else:
-							out_dict[rows[0]] = [rows[1] + "\t" + rows[2] + "\t" + rows[3]]
+							out_dict[rows[0]] = [record]
 				return out_dict
 			elif mode == "double_numeric":
 				out_dict = defaultdict(int)
@@ -245,13 +779,13 @@ class LexData:
 						out_dict[row[0]] = int(row[1])
 				return out_dict
 			elif mode == "triple_numeric":
-				out_dict = defaultdict(lambda: defaultdict(int))
+				out_dict = defaultdict(int_dict)
 				for row in reader:
 					if not row[0].startswith("#"):
 						out_dict[row[0]][row[1]] = int(row[2])
 				return out_dict
 			elif mode == "quadruple_numeric":
-				out_dict = defaultdict(lambda: defaultdict(lambda: defaultdict(str)))
+				out_dict = defaultdict(nested_str_dict)
 				for row in reader:
 					if not row[0].startswith("#"):
 						out_dict[row[0]][row[1]][row[2]] = int(row[3])
@@ -280,7 +814,7 @@ class LexData:
 				self.filters["default_atomic_named_entities"] = ",".join([self.filters["place_def_entity"],self.filters["person_def_entity"],self.filters["organization_def_entity"],self.filters["object_def_entity"]])
 			atomic_types = self.filters["default_atomic_named_entities"].split(",")
 			for atomic_type in atomic_types:
-				to_add = dict((key, value[0]) for key, value in self.entities.items() if value[0].startswith(atomic_type+"\t"))
+				to_add = dict((key, value[0]) for key, value in self.entities.items() if value[0].entity == atomic_type)
 				atoms.update(to_add)
 		return atoms
 
@@ -510,7 +1044,7 @@ class LexData:
 		one also including rules to use when speaker info is available.
 
 		:param rule_list: textual list of rules
-		:return: two separate lists of compiled CorefRule objects with and without speaker specifications
+		:return: two separate CorefRuleSet lists of compiled CorefRule objects with and without speaker specifications
 		"""
 
 		rule_num = 0
@@ -562,7 +1096,7 @@ class LexData:
 					clf = Classifier(clf[0], clf[1], clf[2])
 					self.classifiers[rule.clf_name] = clf
 
-		return speaker_rules, non_speaker_rules
+		return CorefRuleSet(speaker_rules), CorefRuleSet(non_speaker_rules)
 
 	def parse_rm_nested_entities(self):
 		rm_string = self.filters["remove_nested_entities"]
@@ -588,15 +1122,14 @@ class LexData:
 					entity_list = self.entity_heads[head]
 					if substring in morph:
 						for entity in entity_list:
-							entity_class = entity.split("\t")[0]
+							entity_class = entity.entity
 							if entity_class in morph[substring]:
 								morph[substring][entity_class] += 1
 							else:
 								morph[substring][entity_class] = 1
 					else:
 						for entity in entity_list:
-							entity_class = entity.split("\t")[0]
-							morph[substring] = {entity_class:1}
+							morph[substring] = {entity.entity:1}
 		return morph
 
 	def read_oracle(self, oracle_file, as_text=False):
@@ -0,0 +1,246 @@
+"""
+modules/xrenner_lexstore.py
+
+Read-only memory-mapped store for large gazetteer tables
+  * Writes several dictionary tables into a single file of hash tables with marshalled values
+  * Exposes each table as a read-only Mapping, so LexData lookups work unchanged
+  * Pages of the store are shared by all processes mapping the same file, unlike Python dicts, whose
+    reference count updates break copy-on-write sharing after forking
+
+Author: Amir Zeldes
+"""
+
+import os, sys, io, mmap, marshal, struct
+from zlib import crc32
+
+try:
+	from collections.abc import Mapping
+except ImportError:  # Python 2
+	from collections import Mapping
+
+PY2 = sys.version_info[0] < 3
+
+MAGIC = b"XRLEX001"
+HEADER = struct.Struct("<8s40sI")  # magic, cache key (hex SHA1), number of tables
+TABLE = struct.Struct("<32sQQQ")  # table name, offset of slot array, number of slots, number of entries
+SLOT = struct.Struct("<IQ")  # key hash, record offset (0 for an empty slot)
+RECORD = struct.Struct("<II")  # key length, value length; followed by UTF-8 key and marshalled value
+
+# Open store files by path, so all tables from one file share a single memory map
+_stores = {}
+
+# Maximum number of decoded values each process keeps per table for frequently repeated lookups
+DECODED_CACHE_SIZE = 4096
+
+
+def plain(value):
+	"""
+	Converts defaultdicts, namedtuples and other container subclasses into plain types which can be marshalled
+
+	:param value: a value from a gazetteer table
+	:return: the value with all nested containers converted to plain dicts, lists and tuples
+	"""
+	if isinstance(value, dict):
+		return dict((key, plain(val)) for key, val in value.items())
+	elif isinstance(value, list):
+		return [plain(val) for val in value]
+	elif isinstance(value, tuple):
+		return tuple(plain(val) for val in value)
+	return value
+
+
+def encode_key(key):
+	if PY2 and isinstance(key, str):
+		return key
+	return key.encode("utf8")
+
+
+def write_store(path, store_key, tables):
+	"""
+	Writes dictionary tables to a memory mappable store file
+
+	:param path: path of the store file to write
+	:param store_key: 40 character key identifying the model data the tables were compiled from
+	:param tables: dictionary from table names to dictionaries with string keys
+	:return: void
+	"""
+	names = sorted(tables)
+	directory_size = HEADER.size + TABLE.size * len(names)
+	out = io.BytesIO()
+	out.write(b"\0" * directory_size)
+	directory = []
+	for name in names:
+		table = tables[name]
+		num_slots = 2 * len(table) + 1  # Keep load factor at most 0.5 for short probe sequences
+		slots = [(0, 0)] * num_slots
+		slots_offset = out.tell()
+		out.write(b"\0" * (SLOT.size * num_slots))
+		for key, value in table.items():
+			key = encode_key(key)
+			value = marshal.dumps(plain(value))
+			key_hash = crc32(key) & 0xffffffff
+			slot = key_hash % num_slots
+			while slots[slot][1] != 0:
+				slot = (slot + 1) % num_slots
+			slots[slot] = (key_hash, out.tell())
+			out.write(RECORD.pack(len(key), len(value)))
+			out.write(key)
+			out.write(value)
+		end = out.tell()
+		out.seek(slots_offset)
+		for slot in slots:
+			out.write(SLOT.pack(*slot))
+		out.seek(end)
+		directory.append(TABLE.pack(name.encode("utf8"), slots_offset, num_slots, len(table)))
+	out.seek(0)
+	out.write(HEADER.pack(MAGIC, store_key.encode("ascii"), len(names)))
+	for entry in directory:
+		out.write(entry)
+
+	temp_file = path + "." + str(os.getpid())
+	with open(temp_file, 'wb') as f:
+		f.write(out.getvalue())
+	if PY2:
+		if os.path.exists(path):
+			os.remove(path)
+		os.rename(temp_file, path)
+	else:
+		os.replace(temp_file, path)  # Processes which already mapped an older store keep their own copy
+
+
+def read_store_key(path):
+	"""
+	:param path: path of a store file
+	:return: the key of the model data the store was written from, or None if there is no valid store at path
+	"""
+	if not os.path.isfile(path):
+		return None
+	with open(path, 'rb') as f:
+		header = f.read(HEADER.size)
+	if len(header) < HEADER.size:
+		return None
+	magic, store_key, num_tables = HEADER.unpack(header)
+	if magic != MAGIC:
+		return None
+	return store_key.decode("ascii")
+
+
+def open_store(path):
+	"""
+	Maps a store file into memory, reusing an existing map of the same file
+
+	:param path: path of the store file
+	:return: tuple of the memory map, the store key and a dictionary from table names to table directory entries
+	"""
+	if path not in _stores:
+		with open(path, 'rb') as f:
+			data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+		magic, store_key, num_tables = HEADER.unpack_from(data, 0)
+		if magic != MAGIC:
+			raise IOError("Invalid lexicon store file: " + path)
+		directory = {}
+		for i in range(num_tables):
+			name, slots_offset, num_slots, count = TABLE.unpack_from(data, HEADER.size + i * TABLE.size)
+			directory[name.rstrip(b"\0").decode("utf8")] = (slots_offset, num_slots, count)
+		_stores[path] = (data, store_key.decode("ascii"), directory)
+	return _stores[path]
+
+
+class MappedTable(Mapping):
+	"""
+	Read-only dictionary view of one table in a memory-mapped store file. Values are unmarshalled on each
+	access (with a small bounded cache of recently decoded values) and can optionally be passed through a
+	wrapper function, e.g. to restore defaultdict behavior.
+	Missing keys raise KeyError, unless a default factory is given, in which case a new default value is
+	returned (but not stored, unlike a defaultdict).
+	"""
+
+	def __init__(self, path, name, store_key, wrapper=None, default_factory=None):
+		self.path = path
+		self.name = name
+		self.store_key = store_key
+		self.wrapper = wrapper
+		self.default_factory = default_factory
+		self.data, mapped_key, directory = open_store(path)
+		if mapped_key != store_key:
+			raise IOError("Lexicon store " + path + " does not match the current model")
+		self.slots_offset, self.num_slots, self.count = directory[name]
+		self.decoded = {}
+
+	def __reduce__(self):
+		# Pickle as a reference to the store file, e.g. inside the compiled model cache
+		return (MappedTable, (self.path, self.name, self.store_key, self.wrapper, self.default_factory))
+
+	def find(self, key):
+		"""
+		:param key: string key to look up
+		:return: tuple of start offset and length of the marshalled value, or None if the key is not in the table
+		"""
+		try:
+			key = encode_key(key)
+		except AttributeError:  # Not a string, cannot be in the table
+			return None
+		data = self.data
+		key_hash = crc32(key) & 0xffffffff
+		slot = key_hash % self.num_slots
+		while True:
+			slot_hash, offset = SLOT.unpack_from(data, self.slots_offset + slot * SLOT.size)
+			if offset == 0:
+				return None
+			if slot_hash == key_hash:
+				key_length, value_length = RECORD.unpack_from(data, offset)
+				start = offset + RECORD.size
+				if data[start:start + key_length] == key:
+					return start + key_length, value_length
+			slot += 1
+			if slot == self.num_slots:
+				slot = 0
+
+	def records(self):
+		"""
+		Generates the raw key and value bytes of all records in the table in slot order
+		"""
+		data = self.data
+		for slot in range(self.num_slots):
+			slot_hash, offset = SLOT.unpack_from(data, self.slots_offset + slot * SLOT.size)
+			if offset != 0:
+				key_length, value_length = RECORD.unpack_from(data, offset)
+				start = offset + RECORD.size
+				yield data[start:start + key_length], data[start + key_length:start + key_length + value_length]
+
+	def __contains__(self, key):
+		if key in self.decoded:
+			return True
+		return self.find(key) is not None
+
+	def __getitem__(self, key):
+		if key in self.decoded:
+			return self.decoded[key]
+		found = self.find(key)
+		if found is None:
+			if self.default_factory is not None:
+				return self.default_factory()
+			raise KeyError(key)
+		start, length = found
+		value = marshal.loads(self.data[start:start + length])
+		if self.wrapper is not None:
+			value = self.wrapper(value)
+		if len(self.decoded) >= DECODED_CACHE_SIZE:
+			self.decoded.clear()
+		self.decoded[key] = value
+		return value
+
+	def get(self, key, default=None):
+		if key in self:
+			return self[key]
+		return default
+
+	def __iter__(self):
+		for key, value in self.records():
+			yield key.decode("utf8")
+
+	def __len__(self):
+		return self.count
+
+	def __repr__(self):
+		return "MappedTable(" + self.name + ", " + str(self.count) + " entries)"
@@ -2,8 +2,9 @@
 # -*- coding: utf-8 -*-
 
 import re
-from collections import defaultdict, OrderedDict
-from .xrenner_classes import Markable
+from collections import defaultdict
+from .xrenner_classes import Markable, PRONOUN_POS, NON_EXTEND_POS, STOP_FUNC, COORD_FUNC, POSSESSIVE_FUNC, \
+	NON_ESSENTIAL_MOD_FUNC
 from six import iteritems, iterkeys
 
 """
@@ -45,10 +46,11 @@ def is_atomic(mark, atoms, lex):
 	elif replace_head_with_lemma(mark) in atoms:
 		return True
 	# Dynamic generation of proper name pattern
-	elif 0 < marktext.strip().count(" ") < 3 and marktext.strip().split(" ")[0] in lex.first_names and marktext.strip().split(" ")[-1] in lex.last_names:
+	elif 0 < marktext.strip().count(" ") < 3 and lex.lookup(marktext.strip().split(" ")[0]).first_name is not None and \
+			lex.lookup(marktext.strip().split(" ")[-1]).last_name is not None:
 		return True
 	else:
-		non_essential_modifiers = list(mod.text for mod in mark.head.modifiers if lex.filters["non_essential_mod_func"].match(mod.func))
+		non_essential_modifiers = list(mod.text for mod in mark.head.modifiers if mod.flags & NON_ESSENTIAL_MOD_FUNC)
 		if len(non_essential_modifiers) > 0:
 			mark_unmod_text = mark.core_text
 			for mod in non_essential_modifiers:
@@ -72,13 +74,18 @@ def remove_suffix_tokens(marktext, lex):
 		return lex.filters["core_suffixes"].sub(" ", marktext)
 	else:
 		tokens = marktext.split(" ")
-		suffix_candidate = ""
-
-		for token in reversed(tokens):
-			suffix_candidate = token + " " + suffix_candidate
-			if suffix_candidate.strip() in lex.affix_tokens:
-				if lex.affix_tokens[suffix_candidate.strip()] == "prefix":
-					return re.sub(suffix_candidate + r'$', "", marktext)
+		trie = lex.affix_trie_rev
+		node = trie.root
+		last = len(tokens) - 1
+		while last >= 0 and tokens[last] == "":  # Trailing spaces do not count towards the suffix
+			last -= 1
+		for i in range(last, -1, -1):
+			node = trie.step(node, tokens[i])
+			if node is None:
+				break
+			if node.get(trie.END) == "prefix":
+				suffix_candidate = " ".join(tokens[i:]) + " "
+				return re.sub(suffix_candidate + r'$', "", marktext)
 	return marktext
 
 
@@ -95,12 +102,18 @@ def remove_prefix_tokens(marktext, lex):
 		return lex.filters["core_prefixes"].sub(" ", marktext)
 	else:
 		tokens = marktext.split(" ")
-		prefix_candidate = ""
-		for token in tokens:
-			prefix_candidate += token + " "
-			if prefix_candidate.strip() in lex.affix_tokens:
-				if lex.affix_tokens[prefix_candidate.strip()] == "prefix":
-					return re.sub(r'^' + prefix_candidate, "", marktext)
+		trie = lex.affix_trie
+		node = trie.root
+		first = 0
+		while first < len(tokens) and tokens[first] == "":  # Leading spaces do not count towards the prefix
+			first += 1
+		for i in range(first, len(tokens)):
+			node = trie.step(node, tokens[i])
+			if node is None:
+				break
+			if node.get(trie.END) == "prefix":
+				prefix_candidate = " ".join(tokens[:i + 1]) + " "
+				return re.sub(r'^' + prefix_candidate, "", marktext)
 	return marktext
 
 
@@ -223,9 +236,9 @@ def resolve_mark_entity(mark, lex):
 			if entity == "":
 				entity = recognize_entity_by_mod(mark, lex)
 			if entity == "" and mark.head.text.istitle():
-				if mark.head.text in lex.last_names:
+				if lex.lookup(mark.head.text).last_name is not None:
 					modifiers_match_article = (lex.filters["articles"].match(mod.text) is not None for mod in mark.head.modifiers)
-					modifiers_match_first_name = (mod.text in lex.first_names for mod in mark.head.modifiers)
+					modifiers_match_first_name = (lex.lookup(mod.text).first_name is not None for mod in mark.head.modifiers)
 					if any(modifiers_match_first_name) and not any(modifiers_match_article):
 						entity = lex.filters["person_def_entity"]
 			if entity == "" and mark.head.text.istitle():
@@ -244,10 +257,11 @@ def resolve_mark_entity(mark, lex):
 				entity = resolve_entity_cascade(mark.head.lemma, mark, lex)
 			if entity == "":
 				if (mark.head.text.istitle() or not lex.filters["cap_names"]):
-					if mark.head.text in lex.last_names or mark.head.text in lex.first_names:
+					head_entry = lex.lookup(mark.head.text)
+					if head_entry.last_name is not None or head_entry.first_name is not None:
 						modifiers_match_definite = (lex.filters["definite_articles"].match(mod.text) is not None for mod in mark.head.modifiers)
 						modifiers_match_article = (lex.filters["articles"].match(mod.text) is not None for mod in mark.head.modifiers)
-						modifiers_match_def_entity = (re.sub(r"\t.*","",lex.entity_heads[mod.text.strip().lower()][0]) == lex.filters["default_entity"] for mod in mark.head.modifiers if mod.text.strip().lower() in lex.entity_heads)
+						modifiers_match_def_entity = (lex.entity_heads[mod.text.strip().lower()][0].entity == lex.filters["default_entity"] for mod in mark.head.modifiers if mod.text.strip().lower() in lex.entity_heads)
 						if not (any(modifiers_match_article) or any(modifiers_match_definite) or any(modifiers_match_def_entity)):
 							entity = lex.filters["person_def_entity"]
 			if entity == "":
@@ -285,7 +299,7 @@ def resolve_mark_entity(mark, lex):
 						for similar_word in lex.similar[mark.head.text]:
 							if similar_word in lex.entity_heads:
 								for entity_type in lex.entity_heads[similar_word]:
-									entity_string = entity_type.split("\t")[0]
+									entity_string = entity_type.entity
 									if entity_string in sim_probs:
 										sim_probs[entity_string] += 1
 									else:
@@ -333,12 +347,12 @@ def resolve_mark_entity(mark, lex):
 		mark.subclass = mark.entity.split("\t")[1]
 		mark.entity = mark.entity.split("\t")[0]
 	if mark.entity == lex.filters["person_def_entity"] and mark.form != "pronoun":
-		if mark.text in lex.names:
-			mark.agree = lex.names[mark.text]
+		if lex.lookup(mark.text).name is not None:
+			mark.agree = lex.lookup(mark.text).name
 	if mark.entity == lex.filters["person_def_entity"] and mark.agree is None:
 		no_affix_mark = remove_suffix_tokens(remove_prefix_tokens(mark.text, lex), lex)
-		if no_affix_mark in lex.names:
-			mark.agree = lex.names[no_affix_mark]
+		if lex.lookup(no_affix_mark).name is not None:
+			mark.agree = lex.lookup(no_affix_mark).name
 	if mark.entity == lex.filters["person_def_entity"] and mark.agree is None:
 		mark.agree = lex.filters["person_def_agree"]
 		mark.agree_certainty = "uncertain"
@@ -357,58 +371,89 @@ def resolve_mark_entity(mark, lex):
 		mark.agree = lex.filters["default_agree"]
 
 
-def resolve_entity_cascade(entity_text, mark, lex):
+def lookup_entity_text(entity_text, mark, lex):
 	"""
-	Retrieve possible entity types for a given text fragment based on entities list, entity heads and names list.
+	Gets the entity options which resolve_entity_cascade derives from the gazetteers for a text fragment in the
+	dependency context of a markable. Results are memoized in lex.entity_cascade_cache by text, function and
+	parent text, since the same variant texts recur with the same heads for many markables.
 
-	:param entity_text: The text to determine the entity for
-	:param mark: The :class:`.Markable` hosting the text fragment to retrieve context information from (e.g. dependency)
+	:param entity_text: The text to look up
+	:param mark: The :class:`.Markable` hosting the text fragment, supplying its function and parent text
 	:param lex: the :class:`.LexData` object with gazetteer information and model settings
-	:return: entity type; note that this is used to decide whether to stop the search, but the Markable's entity is	already set during processing together with matching subclass and agree information
+	:return: tuple of (parsed entity options from entities and entity_heads in order, person option for a name with
+		a unique dependency cue or None, person option for a first name + last name sequence or None)
 	"""
-	options = {}
-	entity = ""
+	key = (entity_text, mark.func, mark.head.head_text)
+	cached = lex.entity_cascade_cache.get(key)
+	if cached is not None:
+		return cached
+
 	person_entity = lex.filters["person_def_entity"]
-	if entity_text in lex.entities:
-		for alt in lex.entities[entity_text]:
-			parsed_entity = parse_entity(alt, "entities_match")
-			if parsed_entity[0] not in mark.alt_entities:
-				mark.alt_entities.append(parsed_entity[0])
-				mark.alt_subclasses.append(parsed_entity[1])
-				options[parsed_entity[0]] = parsed_entity
-	if entity_text in lex.entity_heads:
-		for alt in lex.entity_heads[entity_text]:
-			parsed_entity = parse_entity(alt, "entity_heads_match")
-			if parsed_entity[0] not in mark.alt_entities:
-				mark.alt_entities.append(parsed_entity[0])
-				mark.alt_subclasses.append(parsed_entity[1])
-				options[parsed_entity[0]] = parsed_entity
+	entry = lex.lookup(entity_text)
+	candidates = []
+	for records, certainty in [(entry.entities, "entities_match"), (entry.entity_heads, "entity_heads_match")]:
+		if records is not None:
+			for alt in records:
+				candidates.append(parse_entity(alt, certainty))
 	# Add the person entity based on a possible name despite seeing alternative entities
 	# If and only if this is supported by a unique dependency cue (only person dependencies found, well attested)
-	if entity_text in lex.names or entity_text in lex.last_names or entity_text in lex.first_names:
-		if (entity_text[0].istitle() or not lex.filters["cap_names"]) and person_entity not in mark.alt_entities:
+	name_option = None
+	if entry.name is not None or entry.last_name is not None or entry.first_name is not None:
+		if entity_text[0].istitle() or not lex.filters["cap_names"]:
 			if mark.head.head_text in lex.entity_deps:
 				if mark.func in lex.entity_deps[mark.head.head_text]:
-					if lex.filters["person_def_entity"] in lex.entity_deps[mark.head.head_text][mark.func]:
+					if person_entity in lex.entity_deps[mark.head.head_text][mark.func]:
 						# Must be attested > 5 times; relaxing this can lower precision substantially
-						if lex.entity_deps[mark.head.head_text][mark.func][lex.filters["person_def_entity"]] > 5 and len(lex.entity_deps[mark.head.head_text][mark.func])==1:
-							mark.alt_entities.append(lex.filters["person_def_entity"])
-							mark.alt_subclasses.append(lex.filters["person_def_entity"])
+						if lex.entity_deps[mark.head.head_text][mark.func][person_entity] > 5 and len(lex.entity_deps[mark.head.head_text][mark.func])==1:
 							name_agree = ""
-							if entity_text in lex.names:
-								name_agree = lex.names[entity_text]
-							elif entity_text in lex.first_names and not entity_text in lex.last_names:
-								name_agree = lex.first_names[entity_text]
-							options[person_entity] = (person_entity, person_entity, name_agree,"names_match")
-	if len(mark.alt_entities) < 1 and 0 < entity_text.count(" ") < 3 and lex.filters["person_def_entity"] not in mark.alt_entities:
-		if entity_text.split(" ")[0] in lex.first_names and entity_text.split(" ")[-1] in lex.last_names:
+							if entry.name is not None:
+								name_agree = entry.name
+							elif entry.first_name is not None and entry.last_name is None:
+								name_agree = entry.first_name
+							name_option = (person_entity, person_entity, name_agree, "names_match")
+	full_name = None
+	if 0 < entity_text.count(" ") < 3:
+		first_name = lex.lookup(entity_text.split(" ")[0]).first_name
+		if first_name is not None and lex.lookup(entity_text.split(" ")[-1]).last_name is not None:
 			if entity_text[0].istitle() or not lex.filters["cap_names"]:
-				if lex.filters["articles"].match(mark.text.split(" ")[0]) is None:
-					mark.alt_entities.append(person_entity)
-					mark.alt_subclasses.append(person_entity)
-					options[person_entity] = (person_entity, person_entity, lex.first_names[entity_text.split(" ")[0]], "name_match")
+				full_name = (person_entity, person_entity, first_name, "name_match")
+
+	result = (tuple(candidates), name_option, full_name)
+	lex.entity_cascade_cache.put(key, result)
+	return result
+
 
-	if person_entity not in mark.alt_entities and (mark.text in lex.first_names or mark.text in lex.last_names):
+def resolve_entity_cascade(entity_text, mark, lex):
+	"""
+	Retrieve possible entity types for a given text fragment based on entities list, entity heads and names list.
+
+	:param entity_text: The text to determine the entity for
+	:param mark: The :class:`.Markable` hosting the text fragment to retrieve context information from (e.g. dependency)
+	:param lex: the :class:`.LexData` object with gazetteer information and model settings
+	:return: entity type; note that this is used to decide whether to stop the search, but the Markable's entity is	already set during processing together with matching subclass and agree information
+	"""
+	options = {}
+	entity = ""
+	person_entity = lex.filters["person_def_entity"]
+	candidates, name_option, full_name = lookup_entity_text(entity_text, mark, lex)
+	# Replay the options found for this text against the markable's alternatives, unless already present
+	for parsed_entity in candidates:
+		if parsed_entity[0] not in mark.alt_entities:
+			mark.alt_entities.append(parsed_entity[0])
+			mark.alt_subclasses.append(parsed_entity[1])
+			options[parsed_entity[0]] = parsed_entity
+	if name_option is not None and person_entity not in mark.alt_entities:
+		mark.alt_entities.append(person_entity)
+		mark.alt_subclasses.append(person_entity)
+		options[person_entity] = name_option
+	if full_name is not None and len(mark.alt_entities) < 1:
+		if lex.filters["articles"].match(mark.text.split(" ")[0]) is None:
+			mark.alt_entities.append(person_entity)
+			mark.alt_subclasses.append(person_entity)
+			options[person_entity] = full_name
+
+	mark_entry = lex.lookup(mark.text)
+	if person_entity not in mark.alt_entities and (mark_entry.first_name is not None or mark_entry.last_name is not None):
 		mark.alt_entities.append(person_entity)
 		options[person_entity] = (person_entity,person_entity,'','name_match')
 	if len(mark.alt_entities) > 1:
@@ -425,20 +470,15 @@ def resolve_entity_cascade(entity_text, mark, lex):
 	return entity if len(options) > 0 else ""
 
 
-def parse_entity(entity_text, certainty="uncertain"):
+def parse_entity(entity_record, certainty="uncertain"):
 	"""
-	Parses: entity -tab- subclass(/agree) + certainty into a tuple
+	Converts a gazetteer EntityRecord (entity, subclass, agree, freq) + certainty into a tuple
 
-	:param entity_text: the string to parse, must contain excatly two tabs
+	:param entity_record: the EntityRecord from lex.entities or lex.entity_heads
 	:param certainty: the certainty string at end of tuple, default 'uncertain'
 	:return: quadruple of (entity, subclass, agree, certainty)
 	"""
-	entity, subclass, freq = entity_text.split("\t")
-	if "/" in subclass:
-		subclass, agree = subclass.split("/")
-	else:
-		agree = ""
-	return (entity, subclass, agree, certainty)
+	return (entity_record.entity, entity_record.subclass, entity_record.agree, certainty)
 
 
 def resolve_mark_agree(mark, lex):
@@ -463,28 +503,27 @@ def resolve_mark_agree(mark, lex):
 				return lex.pronouns[mark.text]
 			elif mark.text.lower() in lex.pronouns:
 				return lex.pronouns[mark.text.lower()]
+		core_entry = lex.lookup(mark.core_text)
 		if mark.form == "proper":
-			if mark.core_text in lex.names:
-				return [lex.names[mark.core_text]]
-			elif mark.core_text in lex.first_names and mark.core_text not in lex.entities and mark.core_text not in lex.entity_heads:  # Single name component core text
-				return [lex.first_names[mark.core_text]]
+			if core_entry.name is not None:
+				return [core_entry.name]
+			elif core_entry.first_name is not None and core_entry.entities is None and core_entry.entity_heads is None:  # Single name component core text
+				return [core_entry.first_name]
 		if mark.head.pos in lex.pos_agree_mappings:
 			mark.agree_certainty = "pos_agree_mappings"
 			return [lex.pos_agree_mappings[mark.head.pos]]
-		elif mark.core_text in lex.entities:
-			for full_entry in lex.entities[mark.core_text]:
-				entry = full_entry.split("\t")[1]
-				if "/" in entry:
+		elif core_entry.entities is not None:
+			for entry in core_entry.entities:
+				if entry.agree != "":
 					if mark.agree == "":
-						mark.agree = entry[entry.find("/") + 1:]
-					mark.alt_agree.append(entry[entry.find("/") + 1:])
-		elif mark.head.text in lex.entity_heads:
-			for full_entry in lex.entity_heads[mark.head.text]:
-				entry = full_entry.split("\t")[1]
-				if "/" in entry:
+						mark.agree = entry.agree
+					mark.alt_agree.append(entry.agree)
+		elif lex.lookup(mark.head.text).entity_heads is not None:
+			for entry in lex.lookup(mark.head.text).entity_heads:
+				if entry.agree != "":
 					if mark.agree == "":
-						mark.agree = entry[entry.find("/") + 1:]
-					mark.alt_agree.append(entry[entry.find("/") + 1:])
+						mark.agree = entry.agree
+					mark.alt_agree.append(entry.agree)
 
 
 def resolve_cardinality(mark,lex):
@@ -532,82 +571,83 @@ def resolve_cardinality(mark,lex):
 
 def recognize_entity_by_mod(mark, lex, mark_atoms=False):
 	"""
-	Attempt to recognize entity type based on modifiers
+	Attempt to recognize entity type based on modifiers. The result is stored on the markable, since it is needed both
+	for the atomicity check and for entity resolution.
 	
 	:param mark: :class:`.Markable` for which to identify the entity type
-	:param modifier_lexicon: The :class:`.LexData` object's modifier list
+	:param lex: the :class:`.LexData` object with gazetteer information and model settings
+	:param mark_atoms: whether to append '@' to the entity if the matching modifier is in the modifier atom list
 	:return: String (entity type, possibly including subtype and agreement)
 	"""
-	modifier_lexicon = lex.entity_mods
-	mod_atoms = lex.mod_atoms
-	for mod in mark.head.modifiers:
-		modifier_tokens = [mod.text] + [construct_modifier_substring(mod)]
-		while len(modifier_tokens) > 0:
-			identifying_substr = ""
-			for token in modifier_tokens:
-				identifying_substr += token + " "
-				if identifying_substr.strip() in modifier_lexicon:
-					if identifying_substr.strip() in mod_atoms and mark_atoms:
-						return modifier_lexicon[identifying_substr.strip()][0] + "@"
-					else:
-						return modifier_lexicon[identifying_substr.strip()][0]
-				elif identifying_substr.lower().strip() in modifier_lexicon:
-					if identifying_substr.lower().strip() in mod_atoms and mark_atoms:
-						return modifier_lexicon[identifying_substr.lower().strip()][0] + "@"
-					else:
-						return modifier_lexicon[identifying_substr.lower().strip()][0]
-			modifier_tokens.pop(0)
-	return ""
-
-
-def construct_modifier_substring(modifier):
-	"""
-	Creates a list of tokens representing a modifier and all of its submodifiers in sequence
-	
-	:param modifier: A ParsedToken object from the modifier list of the head of some markable
-	:return: Text of that modifier together with its modifiers in sequence
-	"""
-	candidate_prefix = ""
-	mod_dict = get_mod_ordered_dict(modifier)
-	for mod_member in mod_dict:
-		candidate_prefix += mod_dict[mod_member].text + " "
-	return candidate_prefix.strip()
+	if mark.mod_entity is None:
+		mark.mod_entity = ("", False)
+		modifier_lexicon = lex.entity_mods
+		for mod in mark.head.modifiers:
+			subtree_text = " ".join(member.text for member in get_mod_subtree(mod)).strip()
+			for candidate in [mod.text.strip(), (mod.text + " " + subtree_text).strip(), subtree_text]:
+				if candidate not in modifier_lexicon:
+					candidate = candidate.lower()
+				if candidate in modifier_lexicon:
+					mark.mod_entity = (modifier_lexicon[candidate][0], candidate in lex.mod_atoms)
+					break
+			if mark.mod_entity[0] != "":
+				break
+	entity, is_atom = mark.mod_entity
+	return entity + "@" if is_atom and mark_atoms else entity
 
 
-def stoplist_prefix_tokens(mark, prefix_dict, keys_to_pop):
+def stoplist_prefix_tokens(mark, prefix_dict, keys_to_pop, prefix_trie=None):
+	"""
+	Adds the ids of modifier tokens covered by a stop listed prefix of the markable's modifiers to keys_to_pop
+
+	:param mark: the :class:`.Markable` whose modifiers are checked
+	:param prefix_dict: dictionary of modifier phrases, usually lex.entity_mods
+	:param keys_to_pop: list of markable candidate ids to remove
+	:param prefix_trie: optional :class:`.PhraseTrie` over prefix_dict, used to stop once no phrase can match
+	:return: void
+	"""
 	substr = ""
 	candidate_prefix = ""
+	node = None if prefix_trie is None else prefix_trie.root
+	started = False
 	for mod in mark.head.modifiers:
-		mod_dict = get_mod_ordered_dict(mod)
-		for mod_member in mod_dict:
-			candidate_prefix += mod_dict[mod_member].text + " "
+		subtree = get_mod_subtree(mod)
+		for member in subtree:
+			candidate_prefix += member.text + " "
 		tokens = candidate_prefix.strip().split(" ")
 		for token in tokens:
 			substr += token + " "
+			if prefix_trie is not None:
+				if token != "":
+					started = True
+				if started and node is not None:
+					node = node.get(token)
+				if node is None and token != "":  # No phrase starts with the text so far, which only grows from here
+					return
 			if substr.strip() in prefix_dict:
 				tokens_affected_count = substr.count(" ")
-				i = 0
-				for mod_token in mod_dict:
-					if i < tokens_affected_count and not mod_dict[mod_token].id == mark.head.id:
-						keys_to_pop.append(mod_dict[mod_token].id)
-					i += 1
+				for i, member in enumerate(subtree):
+					if i < tokens_affected_count and not member.id == mark.head.id:
+						keys_to_pop.append(member.id)
 
 
-def get_mod_ordered_dict(mod):
+def get_mod_subtree(mod):
 	"""
-	Retrieves the (sub)modifiers of a modifier token
+	Retrieves a modifier token together with its (sub)modifiers
 	
 	:param mod: A :class:`.ParsedToken` object representing a modifier of the head of some markable
-	:return: Recursive ordered dictionary of that modifier's own modifiers
+	:return: list of the modifier and all tokens it dominates via modifiers, sorted by token index
 	"""
-	mod_dict = OrderedDict()
-	mod_dict[int(mod.id)] = mod
-	if len(mod.modifiers) > 0:
-		for mod2 in mod.modifiers:
-			mod_dict.update(get_mod_ordered_dict(mod2))
-	else:
-		return mod_dict
-	return OrderedDict(sorted(mod_dict.items()))
+	if len(mod.modifiers) == 0:
+		return [mod]
+	subtree = {mod.index: mod}
+	stack = list(mod.modifiers)
+	while len(stack) > 0:
+		member = stack.pop()
+		if member.index not in subtree:
+			subtree[member.index] = member
+			stack.extend(member.modifiers)
+	return [subtree[index] for index in sorted(subtree)]
 
 
 def markable_extend_punctuation(marktext, adjacent_token, punct_dict, direction):
@@ -635,9 +675,9 @@ def markables_overlap(mark1, mark2, lex=None):
 	:return: bool
 	"""
 	if lex is not None:
-		if lex.filters["possessive_func"].match(mark1.func) is not None and mark1.form == "pronoun" and mark1.start > mark2.start:
+		if mark1.flags & POSSESSIVE_FUNC and mark1.form == "pronoun" and mark1.start > mark2.start:
 			return False
-		elif lex.filters["possessive_func"].match(mark2.func) is not None and mark2.form == "pronoun" and mark2.start > mark1.start:
+		elif mark2.flags & POSSESSIVE_FUNC and mark2.form == "pronoun" and mark2.start > mark1.start:
 			return False
 	if mark2.end >= mark1.start >= mark2.start:
 		return True
@@ -648,67 +688,65 @@ def markables_overlap(mark1, mark2, lex=None):
 
 
 def markable_extend_affixes(start, end, conll_tokens, sent_start, lex):
-	candidate_affix = ""
-	for tok in reversed(conll_tokens[sent_start:start]):
-		candidate_affix = tok.text + " " + candidate_affix
-		if candidate_affix.lower().strip() in lex.affix_tokens:
-			if lex.affix_tokens[candidate_affix.lower().strip()] == "prefix":
-				return [int(tok.id), int(tok.id) + candidate_affix.count(" ")]
-		elif candidate_affix.strip() in lex.affix_tokens:
-			if lex.affix_tokens[candidate_affix.strip()] == "prefix":
-				return [int(tok.id), int(tok.id) + candidate_affix.count(" ")]
-	candidate_affix = ""
-	for tok in conll_tokens[end+1:]:
-		candidate_affix += tok.text + " "
-		if candidate_affix.lower().strip() in lex.affix_tokens:
-			if lex.affix_tokens[candidate_affix.lower().strip()] == "suffix":
-				return [int(tok.id) - candidate_affix.strip().count(" "), int(tok.id) + 1]
-		elif candidate_affix.strip() in lex.affix_tokens:
-			if lex.affix_tokens[candidate_affix.strip()] == "suffix":
-				return [int(tok.id) - candidate_affix.strip().count(" "), int(tok.id) + 1]
-	return [0,0]
-
+	"""
+	Finds the nearest affix token phrase directly before or after a markable span, matching token texts
+	lower cased first and as is if the lower cased text is not an affix phrase
 
-def get_entity_by_affix(head_text, lex):
-	affix_max = int(lex.filters["max_suffix_length"])
-	score = 0
-	entity = ""
-	probs = {}
-	for i in range(1, len(head_text) - 1):
-		if i > affix_max:
+	:param start: index of the first token of the markable
+	:param end: index of the last token of the markable
+	:param conll_tokens: the document tokens up to the current sentence
+	:param sent_start: index of the first token of the sentence
+	:param lex: the :class:`.LexData` object with gazetteer information and model settings
+	:return: list of the start index and the end index (exclusive) of the affix phrase, or [0,0] if there is none
+	"""
+	trie = lex.affix_trie_rev
+	folded = exact = trie.root
+	length = 0  # Length in spaces of the candidate affix text
+	for i in range(start - 1, sent_start - 1, -1):
+		tok = conll_tokens[i]
+		length += tok.text.count(" ") + 1
+		folded = None if folded is None else trie.step(folded, tok.text.lower())
+		exact = None if exact is None else trie.step(exact, tok.text)
+		if folded is None and exact is None:
 			break
-		candidates = 0
-		if lex.filters["morph_direction"] == "prefix":
-			substr = head_text[:i]
-		else:
-			substr = head_text[i:]
-		if substr in lex.morph:
-			options = lex.morph[substr]
-			for key, value in options.items():
-				candidates += value
-				entity = key.split("/")[0]
-				probs[entity] = float(value)
-			for entity in probs:
-				probs[entity] = probs[entity] / candidates
-		if entity != "":
-			return probs
-	return probs
+		if folded is not None and trie.END in folded:
+			if folded[trie.END] == "prefix":
+				return [tok.index, tok.index + length]
+		elif exact is not None and trie.END in exact:
+			if exact[trie.END] == "prefix":
+				return [tok.index, tok.index + length]
+	trie = lex.affix_trie
+	folded = exact = trie.root
+	length = -1
+	for i in range(end + 1, len(conll_tokens)):
+		tok = conll_tokens[i]
+		length += tok.text.count(" ") + 1
+		folded = None if folded is None else trie.step(folded, tok.text.lower())
+		exact = None if exact is None else trie.step(exact, tok.text)
+		if folded is None and exact is None:
+			break
+		if folded is not None and trie.END in folded:
+			if folded[trie.END] == "suffix":
+				return [tok.index - length, tok.index + 1]
+		elif exact is not None and trie.END in exact:
+			if exact[trie.END] == "suffix":
+				return [tok.index - length, tok.index + 1]
+	return [0,0]
 
 
-def pos_func_combo(pos, func, pos_func_heads_string):
+def get_entity_by_affix(head_text, lex):
 	"""
-	:return: bool
+	Predicts entity probabilities for a head based on the affixes of known entity heads, see :class:`.AffixTrie`
+
+	:param head_text: text or lemma of the markable head
+	:param lex: the :class:`.LexData` object with gazetteer information and model settings
+	:return: dictionary from entity classes to probabilities, which must not be modified
 	"""
-	pos_func_heads = pos_func_heads_string.split(";")
-	if pos + "+" + func in pos_func_heads:
-		return True
-	elif pos + "!" + func in pos_func_heads:
-		return False
-	else:
-		if pos_func_heads_string.find(";" + pos + "!") > -1 or pos_func_heads_string.startswith(pos + "!"):
-			return True
-		else:
-			return False
+	probs = lex.affix_entity_cache.get(head_text)
+	if probs is None:
+		probs = lex.morph_trie.lookup(head_text, int(lex.filters["max_suffix_length"]))
+		lex.affix_entity_cache.put(head_text, probs)
+	return probs
 
 
 def replace_head_with_lemma(mark):
@@ -718,20 +756,18 @@ def replace_head_with_lemma(mark):
 
 
 def make_markable(tok, conll_tokens, descendants, tokoffset, sentence, keys_to_pop, lex):
-	if tok.id in descendants and lex.filters["non_extend_pos"].match(tok.pos) is None:
-		tokenspan = descendants[tok.id] + [tok.id]
-		tokenspan = list(map(int, tokenspan))
-		tokenspan.sort()
+	if tok.id in descendants and not tok.flags & NON_EXTEND_POS:
+		span = descendants.span(tok.id)
+		start = tok.index if span is None else min(span[0], tok.index)
+		end = tok.index if span is None else max(span[1], tok.index)
 		marktext = ""
-		start = min(tokenspan)
-		end = max(tokenspan)
 		for span_token in conll_tokens[start:end + 1]:
 			marktext += span_token.text + " "
 		marktext = marktext.strip()
 	else:
 		marktext = tok.text
-		start = int(tok.id)
-		end = int(tok.id)
+		start = tok.index
+		end = tok.index
 	# Check for a trailing coordinating conjunction on a descendant of the head and re-connect if necessary
 	if end < len(conll_tokens) - 1:
 		coord = conll_tokens[end + 1]
@@ -739,24 +775,23 @@ def make_markable(tok, conll_tokens, descendants, tokoffset, sentence, keys_to_p
 			not_head_child = coord.head != tok.id
 		else:
 			coord_grand_head = 0
-			if int(conll_tokens[int(coord.head)].head) != 0:
-				coord_grand_head = int(conll_tokens[int(coord.head)].head)
-			not_head_child = (conll_tokens[int(coord.head)].head != tok.id
-									and coord_grand_head == int(tok.id)
-									and conll_tokens[int(coord.head)].head != '0'
-									and int(conll_tokens[int(coord.head)].head) > int(tok.id))
-
-		if lex.filters["coord_func"].match(coord.func) is not None and not_head_child and int(coord.head) >= start:
-			conjunct1 = conll_tokens[int(conll_tokens[end + 1].head)]
+			if conll_tokens[coord.head_index].head_index != 0:
+				coord_grand_head = conll_tokens[coord.head_index].head_index
+			not_head_child = (conll_tokens[coord.head_index].head != tok.id
+									and coord_grand_head == tok.index
+									and conll_tokens[coord.head_index].head != '0'
+									and conll_tokens[coord.head_index].head_index > tok.index)
+
+		if coord.flags & COORD_FUNC and not_head_child and coord.head_index >= start:
+			conjunct1 = conll_tokens[conll_tokens[end + 1].head_index]
 			for tok2 in conll_tokens[end + 1:]:
 				if (tok2.head == conjunct1.head and tok2.func == conjunct1.func) or tok2.head == coord.id:
 					conjunct2 = tok2
-					tokenspan = [conjunct2.id, str(end)]
+					end = max(conjunct2.index, end)
 					if conjunct2.id in descendants:
-						tokenspan += descendants[conjunct2.id]
-					tokenspan = map(int, tokenspan)
-					tokenspan = sorted(tokenspan)
-					end = max(tokenspan)
+						span = descendants.span(conjunct2.id)
+						if span is not None:
+							end = max(span[1], end)
 					marktext = ""
 					for span_token in conll_tokens[start:end + 1]:
 						marktext += span_token.text + " "
@@ -768,7 +803,7 @@ def make_markable(tok, conll_tokens, descendants, tokoffset, sentence, keys_to_p
 		pass
 	# Extend markable to 'affix tokens'
 	# Do not extend pronouns or stop functions
-	if lex.filters["stop_func"].match(tok.func) is None and lex.filters["pronoun_pos"].match(tok.pos) is None:
+	if not tok.flags & STOP_FUNC and not tok.flags & PRONOUN_POS:
 		extend_affixes = markable_extend_affixes(start, end, conll_tokens, tokoffset + 1, lex)
 		if not extend_affixes[0] == 0:
 			if extend_affixes[0] < start:
@@ -820,16 +855,18 @@ def lookup_has_entity(text, lemma, entity, lex):
 	:param lex: the :class:`.LexData` object with gazetteer information and model settings
 	:return: bool
 	"""
-	found = []
-	if text in lex.entities:
-		found = [i for i, x in enumerate(lex.entities[text]) if re.search(entity + '\t', x)]
-	elif lemma in lex.entities:
-		found = [i for i, x in enumerate(lex.entities[lemma]) if re.search(entity + '\t', x)]
-	elif text in lex.entity_heads:
-		found = [i for i, x in enumerate(lex.entity_heads[text]) if re.search(entity + '\t', x)]
-	elif lemma in lex.entity_heads:
-		found = [i for i, x in enumerate(lex.entity_heads[lemma]) if re.search(entity + '\t', x)]
-	return len(found) > 0
+	text_entry = lex.lookup(text)
+	lemma_entry = lex.lookup(lemma)
+	entries = []
+	if text_entry.entities is not None:
+		entries = text_entry.entities
+	elif lemma_entry.entities is not None:
+		entries = lemma_entry.entities
+	elif text_entry.entity_heads is not None:
+		entries = text_entry.entity_heads
+	elif lemma_entry.entity_heads is not None:
+		entries = lemma_entry.entity_heads
+	return any(entry.entity == entity for entry in entries)
 
 
 def assign_coordinate_entity(mark,markables_by_head):
@@ -904,17 +941,13 @@ def disambiguate_entity(mark,lex):
 	if len(entity_freqs) == 0 or break_tie:  # No similar dependencies, get frequency information from entities if available
 		if mark.text in lex.entities:
 			for entity_entry in lex.entities[mark.text]:
-				entity_type, entity_subtype, freq = entity_entry.split("\t")
-				freq = int(freq)
-				if freq > 0:
-					entity_freqs[entity_type] += freq
+				if entity_entry.freq > 0:
+					entity_freqs[entity_entry.entity] += entity_entry.freq
 	if len(entity_freqs) == 0 or break_tie:  # No similar dependencies, get frequency information from heads if available
 		if mark.head.text in lex.entity_heads:
 			for entity_entry in lex.entity_heads[mark.head.text]:
-				entity_type, entity_subtype, freq = entity_entry.split("\t")
-				freq = int(freq)
-				if freq > 0:
-					entity_freqs[entity_type] += freq
+				if entity_entry.freq > 0:
+					entity_freqs[entity_entry.entity] += entity_entry.freq
 
 	if len(entity_freqs) == 0:  # No dependency info, use entity sum proportions
 		entity_freqs = lex.entity_sums
@@ -4,7 +4,6 @@ import operator
 import re
 import os
 import platform
-import xmltodict
 from collections import defaultdict
 
 """
@@ -40,18 +39,18 @@ def output_onto(conll_tokens, markstart_dict, markend_dict, file_name):
 
 	output_string = '<DOC DOCNO="' + file_name + '">\n<TEXT PARTNO="000">\n'
 	for out_tok in conll_tokens:
-		if int(out_tok.id) in markstart_dict:
-			for out_mark in sorted(markstart_dict[int(out_tok.id)], key=operator.attrgetter('end'), reverse=True):
+		if out_tok.index in markstart_dict:
+			for out_mark in sorted(markstart_dict[out_tok.index], key=operator.attrgetter('end'), reverse=True):
 				output_string += '<COREF ID="' + str(out_mark.group) + '" ENTITY="' + out_mark.entity + '" INFSTAT="' + out_mark.infstat
 				if not out_mark.antecedent == "none":
 					output_string += '" TYPE="' + out_mark.coref_type
 				output_string += '">'
-		if int(out_tok.id) > 0:
+		if out_tok.index > 0:
 			output_string += re.sub("&","&amp;",out_tok.text) if ";" not in out_tok.text else out_tok.text
-		if int(out_tok.id) in markend_dict:
-			for out_mark in markend_dict[int(out_tok.id)]:
+		if out_tok.index in markend_dict:
+			for out_mark in markend_dict[out_tok.index]:
 				output_string += "</COREF>"
-		if int(out_tok.id) > 0:
+		if out_tok.index > 0:
 			output_string += ' '
 
 
@@ -70,16 +69,16 @@ def output_SGML(conll_tokens, markstart_dict, markend_dict):
 
 	output_string = ""
 	for out_tok in conll_tokens:
-		if int(out_tok.id) in markstart_dict:
-			for out_mark in sorted(markstart_dict[int(out_tok.id)], key=operator.attrgetter('end'), reverse=True):
+		if out_tok.index in markstart_dict:
+			for out_mark in sorted(markstart_dict[out_tok.index], key=operator.attrgetter('end'), reverse=True):
 				output_string += '<referent id="' + str(out_mark.id) + '" entity="' + out_mark.entity + '" group="' + str(out_mark.group)
 				if not out_mark.antecedent == "none":
 					output_string += '" antecedent="' + str(out_mark.antecedent.id) + '" type="' + out_mark.coref_type
 				output_string += '">\n'
-		if int(out_tok.id) > 0:
+		if out_tok.index > 0:
 			output_string += out_tok.text + "\n"
-		if int(out_tok.id) in markend_dict:
-			for out_mark in markend_dict[int(out_tok.id)]:
+		if out_tok.index in markend_dict:
+			for out_mark in markend_dict[out_tok.index]:
 				output_string += "</referent>\n"
 
 	return output_string
@@ -106,25 +105,25 @@ def output_conll(conll_tokens, markstart_dict, markend_dict, file_name, output_i
 		infstat_col = ""
 		if output_infstat:
 			infstat_col = "_\t"
-		if int(out_tok.id) in markstart_dict:
-			for out_mark in sorted(markstart_dict[int(out_tok.id)], key=operator.attrgetter('end'), reverse=True):
+		if out_tok.index in markstart_dict:
+			for out_mark in sorted(markstart_dict[out_tok.index], key=operator.attrgetter('end'), reverse=True):
 				coref_col += "(" + str(out_mark.group)
 				if output_infstat:
 					infstat_col = out_mark.infstat + "\t"
-				if int(out_tok.id) in markend_dict:
-					if out_mark in markend_dict[int(out_tok.id)]:
+				if out_tok.index in markend_dict:
+					if out_mark in markend_dict[out_tok.index]:
 						coref_col += ")"
-						markend_dict[int(out_tok.id)].remove(out_mark)
-		if int(out_tok.id) in markend_dict:
-			for out_mark in markend_dict[int(out_tok.id)]:
-				if out_mark in markstart_dict[int(out_tok.id)]:
+						markend_dict[out_tok.index].remove(out_mark)
+		if out_tok.index in markend_dict:
+			for out_mark in markend_dict[out_tok.index]:
+				if out_mark in markstart_dict[out_tok.index]:
 					coref_col += ")"
 				else:
 					if len(coref_col) > 0:
 						if coref_col[-1].isdigit():
 							coref_col += "|"  # Use pipe to separate group 1 opening and 2 closing leading to (12) -> (1|2)
 					coref_col += str(out_mark.group) + ")"
-		if int(out_tok.id) not in markstart_dict and int(out_tok.id) not in markend_dict:
+		if out_tok.index not in markstart_dict and out_tok.index not in markend_dict:
 			coref_col = "_"
 
 		line += infstat_col + coref_col
@@ -159,20 +158,20 @@ def output_conll_sent(conll_tokens, markstart_dict, markend_dict, file_name, out
 		coref_col = ""
 		line = str(i) + "\t" + out_tok.text + "\t"
 		infstat_col = ""
-		if int(out_tok.id) in markstart_dict:
-			for out_mark in sorted(markstart_dict[int(out_tok.id)], key=operator.attrgetter('end'), reverse=True):
+		if out_tok.index in markstart_dict:
+			for out_mark in sorted(markstart_dict[out_tok.index], key=operator.attrgetter('end'), reverse=True):
 				coref_col += "(" + str(out_mark.group)
 				if output_entity:
 					coref_col += "-" + out_mark.entity
 				if output_infstat:
 					infstat_col = out_mark.infstat
-				if int(out_tok.id) in markend_dict:
-					if out_mark in markend_dict[int(out_tok.id)]:
+				if out_tok.index in markend_dict:
+					if out_mark in markend_dict[out_tok.index]:
 						coref_col += ")"
-						markend_dict[int(out_tok.id)].remove(out_mark)
-		if int(out_tok.id) in markend_dict:
-			for out_mark in markend_dict[int(out_tok.id)]:
-				if out_mark in markstart_dict[int(out_tok.id)]:
+						markend_dict[out_tok.index].remove(out_mark)
+		if out_tok.index in markend_dict:
+			for out_mark in markend_dict[out_tok.index]:
+				if out_mark in markstart_dict[out_tok.index]:
 					coref_col += ")"
 				else:
 					if len(coref_col) > 0:
@@ -182,7 +181,7 @@ def output_conll_sent(conll_tokens, markstart_dict, markend_dict, file_name, out
 					if output_entity:
 						coref_col += "-" + out_mark.entity
 					coref_col += ")"
-		if int(out_tok.id) not in markstart_dict and int(out_tok.id) not in markend_dict:
+		if out_tok.index not in markstart_dict and out_tok.index not in markend_dict:
 			coref_col = "_"
 		if coref_col == "":
 			coref_col = "_"
@@ -221,8 +220,8 @@ def output_HTML(conll_tokens, markstart_dict, markend_dict, rtl=False):
 <script src="http://corpling.uis.georgetown.edu/xrenner/script/xrenner.js"></script>
 '''
 	for out_tok in conll_tokens:
-		if int(out_tok.id) in markstart_dict:
-			for out_mark in sorted(markstart_dict[int(out_tok.id)], key=operator.attrgetter('end'), reverse=True):
+		if out_tok.index in markstart_dict:
+			for out_mark in sorted(markstart_dict[out_tok.index], key=operator.attrgetter('end'), reverse=True):
 				info_string = "class: " + str(out_mark.entity) + " | subclass: " + str(out_mark.subclass) + \
 				              "&#10;definiteness: " + str(out_mark.definiteness) + " | agree: " + str(out_mark.agree) + \
 				              "&#10;cardinality: " + str(out_mark.cardinality) + " | form: "+ str(out_mark.form) + \
@@ -232,17 +231,17 @@ def output_HTML(conll_tokens, markstart_dict, markend_dict, rtl=False):
 					info_string += "&#10;speaker: " + out_mark.speaker
 				if not out_mark.antecedent == "none":
 					info_string += '&#10;coref_type: ' + out_mark.coref_type
-				if "matching_rule" in out_mark.__dict__:
+				if hasattr(out_mark, "matching_rule"):
 					info_string += "&#10;coref_rule: " + out_mark.matching_rule
 				output_string += '<div id="' + out_mark.id + '" head="' + out_mark.head.id + '" onmouseover="highlight_group(' + \
 				"'" + str(out_mark.group) + "'" + ')" onmouseout="unhighlight_group(' + "'" + str(out_mark.group) + "'" + ')" class="referent" group="' + str(out_mark.group) + '" title="' + info_string
 				if not out_mark.antecedent == "none":
 					output_string += '" antecedent="' + out_mark.antecedent.id
 				output_string += '"><span class="entity_type">' + get_glyph(out_mark.entity) + '</span>\n'
-		if int(out_tok.id) > 0:
+		if out_tok.index > 0:
 			output_string += out_tok.text.replace("-RRB-", ")").replace("-LRB-", "(").replace("-LSB-", "[").replace("-RSB-", "]") + "\n"
-		if int(out_tok.id) in markend_dict:
-			for out_mark in markend_dict[int(out_tok.id)]:
+		if out_tok.index in markend_dict:
+			for out_mark in markend_dict[out_tok.index]:
 				output_string += "</div>\n"
 	output_string += '<script>colorize();</script>\n'
 	output_string += '''</body>
@@ -347,8 +346,8 @@ def output_PAULA(conll_tokens, markstart_dict, markend_dict, docname, docpath):
 	del conll_tokens[0]
 	for out_tok in conll_tokens:
 		paula_text += out_tok.text + " "
-		if int(out_tok.id) in markstart_dict:
-			for out_mark in markstart_dict[int(out_tok.id)]:
+		if out_tok.index in markstart_dict:
+			for out_mark in markstart_dict[out_tok.index]:
 				if out_mark.end > out_mark.start:
 					paula_markables += '<mark id="' + out_mark.id + '"  xlink:href="#xpointer(id(' + "'tok_" + str(out_mark.start) + "')/range-to(id('tok_" + str(out_mark.end) + "')))" + '"><!-- ' + out_mark.text + " -->\n"
 				else:
@@ -452,8 +451,8 @@ def output_webanno(conll_tokens, markables):
 			token_text = token.text.decode("utf-8")
 
 
-		output += '\t<type4:Token xmi:id="' + str(int(token.id) + 1) + '" sofa="12000" begin="' + str(cursor) + '" end="' + str(cursor + len(token_text)) + '"/>\n'
-		all_ids_string += str(int(token.id) + 1) + " "
+		output += '\t<type4:Token xmi:id="' + str(token.index + 1) + '" sofa="12000" begin="' + str(cursor) + '" end="' + str(cursor + len(token_text)) + '"/>\n'
+		all_ids_string += str(token.index + 1) + " "
 		tok_starts.append(cursor)
 		tok_ends.append(cursor + len(token_text))
 
@@ -505,6 +504,7 @@ def output_webanno(conll_tokens, markables):
 
 
 def output_webannotsv(conll_tokens, markables, output_infstat=True):
+	import xmltodict  # Only needed for this output format, slow to import
 	webannoxmi = xmltodict.parse(output_webanno(conll_tokens, markables))
 
 	if not output_infstat:
@@ -7,43 +7,100 @@ Author: Amir Zeldes
 """
 
 from .xrenner_marker import lookup_has_entity
+from .xrenner_classes import MARK_HEAD_POS, PROPER_POS, APPOSITION_FUNC, NON_LINK_FUNC, CONJUNCT_FUNC
+
+def iter_lines(text):
+	"""
+	Generates the lines of a string one at a time, without splitting the whole string into a list
+
+	:param text: string containing a parse
+	:return: generator of lines without line breaks
+	"""
+	start = 0
+	length = len(text)
+	while start < length:
+		end = text.find("\n", start)
+		if end < 0:
+			end = length
+		yield text[start:end]
+		start = end + 1
+
+
+def read_conll_sentences(lines):
+	"""
+	Reads conll10/conllu input in a single pass, generating one sentence at a time. Speaker and s_type
+	comments do not interrupt a sentence, while any other non-token line ends a sentence which
+	already has at least one regular token (not a multiword token range or decimal empty node).
+
+	:param lines: iterable of input lines, e.g. an open file, a list of strings or a generator
+	:return: generator of tuples of the sentence's comment lines and its token rows, each split into columns
+	"""
+	comments = []
+	rows = []
+	has_tokens = False
+	for line in lines:
+		line = line.replace("\r", "").rstrip("\n")
+		if line.startswith("#") and "=" in line and ("speaker" in line or "s_type" in line):
+			comments.append(line)
+		elif line.find("\t") > 0:  # Only lines that contain tabs are conll tokens
+			cols = line.split("\t")
+			rows.append(cols)
+			if not has_tokens and "." not in cols[0] and "-" not in cols[0]:
+				has_tokens = True
+		elif has_tokens:
+			yield comments, rows
+			comments = [line] if line.startswith("#") else []
+			rows = []
+			has_tokens = False
+		elif line.startswith("#"):
+			comments.append(line)
+	if rows or comments:
+		yield comments, rows
+
 
 def add_negated_parents(conll_tokens, offset):
 	"""
 	Sets the neg_parent property on tokens whose head dominates a negation
 
 	:param conll_tokens: token list for this document
-	:param offset: token ID reached in last sentence
+	:param offset: index of the first token which has not been checked yet
 	:return: None
 	"""
 
 	for token in conll_tokens[offset:]:
-		parent_id = token.head
-		if parent_id != "0":
-			if conll_tokens[int(parent_id)].negated:
+		parent_index = token.head_index
+		if parent_index != 0:
+			if conll_tokens[parent_index].negated:
 				token.neg_parent = True
 
 
-def add_child_info(conll_tokens, child_funcs, child_strings, lex):
+def add_child_info(conll_tokens, child_funcs, child_strings, lex, offset=0):
 	"""
 	Adds a list of all dependent functions and token strings to each parent token
 	
 	:param conll_tokens: The ParsedToken list so far
 	:param child_funcs: Dictionary from ids to child functions
 	:param child_strings: Dictionary from ids to child strings
+	:param offset: index of the first token which has not received its child information yet
 	:return: void
 	"""
-	for child_id in child_funcs:
-		if child_id > len(conll_tokens)-1:
+	neg_func = lex.filters["neg_func"]
+	for child_id in range(offset, len(conll_tokens)):
+		if child_id not in child_funcs:
 			continue
+		token = conll_tokens[child_id]
+		known = set(token.child_funcs)
 		for func in child_funcs[child_id]:
-			if func not in conll_tokens[child_id].child_funcs:
-				conll_tokens[child_id].child_funcs.append(func)
-				if lex.filters["neg_func"].match(func):
-					conll_tokens[child_id].negated = True
+			if func not in known:
+				known.add(func)
+				token.child_funcs.append(func)
+				if neg_func.match(func):
+					token.negated = True
+		known = set(token.child_strings)
 		for tok_text in child_strings[child_id]:
-			if tok_text not in conll_tokens[child_id].child_strings:
-				conll_tokens[child_id].child_strings.append(tok_text)
+			if tok_text not in known:
+				known.add(tok_text)
+				token.child_strings.append(tok_text)
 
 
 def postprocess_parser(conll_tokens, tokoffset, children, stop_ids, lex):
@@ -52,19 +109,19 @@ def postprocess_parser(conll_tokens, tokoffset, children, stop_ids, lex):
 			tok1.pos = tok1.text
 			tok1.func = "punct"
 			tok1.head = "0"
-		if lex.filters["mark_head_pos"].match(tok1.pos) is not None:
+		if tok1.flags & MARK_HEAD_POS:
 			entity_candidate = tok1.text + " "
-			for tok2 in conll_tokens[int(tok1.id) + 1:]:
-				if lex.filters["mark_head_pos"].match(tok2.pos) is not None:
+			for tok2 in conll_tokens[tok1.index + 1:]:
+				if tok2.flags & MARK_HEAD_POS:
 					entity_candidate += tok2.text + " "
 					### DEBUG BREAKPOINT ###
 					if entity_candidate.strip() == lex.debug["ana"]:
 						pass
 					if entity_candidate.strip() in lex.entities:  # Entity matched, check if all tokens are inter-connected
-						for tok3 in conll_tokens[int(tok1.id):int(tok2.id)]:
+						for tok3 in conll_tokens[tok1.index:tok2.index]:
 							# Ensure right most token has head outside entity:
-							if int(tok2.head) > int(tok2.id) or int(tok2.head) < int(tok1.id):
-								if (int(tok3.head) < int(tok1.id) or int(tok3.head) > int(tok2.id)) and tok3.id in children[tok3.head]:
+							if tok2.head_index > tok2.index or tok2.head_index < tok1.index:
+								if (tok3.head_index < tok1.index or tok3.head_index > tok2.index) and tok3.id in children[tok3.head]:
 									children[tok3.head].remove(tok3.id)
 									tok3.head = tok2.id
 									children[tok3.head].append(tok3.id)
@@ -73,22 +130,22 @@ def postprocess_parser(conll_tokens, tokoffset, children, stop_ids, lex):
 					break
 		# Check for apposition pointing back to immediately preceding proper noun token -
 		# typical (German model) MaltParser name behavior
-		if lex.filters["apposition_func"].match(tok1.func) is not None and not tok1.id == "1":
-			if lex.filters["proper_pos"].match(conll_tokens[int(tok1.id) - 1].pos) is not None and conll_tokens[
-						int(tok1.id) - 1].id == tok1.head:
+		if tok1.flags & APPOSITION_FUNC and not tok1.id == "1":
+			if conll_tokens[tok1.index - 1].flags & PROPER_POS and conll_tokens[
+						tok1.index - 1].id == tok1.head:
 				tok1.func = "xrenner_fix"
-				children[str(int(tok1.id) - 1)].append(tok1.id)
+				children[str(tok1.index - 1)].append(tok1.id)
 				stop_ids[tok1.id] = True
 
 		# Check for [city], [state/country] apposition -
 		# typical (English model) Stanford parser behavior
 		if tok1.text == lex.debug["ana"]:
 			a=5
-		if lex.filters["apposition_func"].match(tok1.func) is not None and not int(tok1.id) < 3:
-			if conll_tokens[int(tok1.id) - 1].text.strip() == ",":
-				tok_minus2 = conll_tokens[int(tok1.id) - 2]
-				tok1_head = conll_tokens[int(tok1.head)]
-				if lex.filters["proper_pos"].match(tok_minus2.pos) is not None:
+		if tok1.flags & APPOSITION_FUNC and not tok1.index < 3:
+			if conll_tokens[tok1.index - 1].text.strip() == ",":
+				tok_minus2 = conll_tokens[tok1.index - 2]
+				tok1_head = conll_tokens[tok1.head_index]
+				if tok_minus2.flags & PROPER_POS:
 					if (tok_minus2.id == tok1.head and (lookup_has_entity(tok1.text, tok1.lemma, "place", lex) and not lookup_has_entity(tok_minus2.text, tok_minus2.lemma, "place", lex) or \
 						lookup_has_entity(tok_minus2.text, tok_minus2.lemma, "place", lex))) or \
 						not lookup_has_entity(tok1_head.text, tok1_head.lemma, "place", lex) and lookup_has_entity(tok1.text, tok1.lemma, "place", lex):
@@ -98,9 +155,9 @@ def postprocess_parser(conll_tokens, tokoffset, children, stop_ids, lex):
 									children[tok_minus2.id].append(tok1.id)
 
 		# Check for markable projecting beyond an apposition to itself and remove from children on violation
-		if lex.filters["apposition_func"].match(tok1.func) is not None and not tok1.id == "1":
-			for tok2 in conll_tokens[int(tok1.id) + 1:]:
-				if tok2.head == tok1.head and lex.filters["non_link_func"].match(tok2.func) is None and tok2.id in children[tok2.head]:
+		if tok1.flags & APPOSITION_FUNC and not tok1.id == "1":
+			for tok2 in conll_tokens[tok1.index + 1:]:
+				if tok2.head == tok1.head and not tok2.flags & NON_LINK_FUNC and tok2.id in children[tok2.head]:
 					children[tok2.head].remove(tok2.id)
 
 
@@ -119,9 +176,9 @@ def replace_conj_func(conll_tokens, tokoffset, lex):
 		if token.text == lex.debug["ana"]:
 			pass
 
-		if lex.filters["conjunct_func"].match(token.func) is not None:
-			for child_func in conll_tokens[int(token.head)].child_funcs:
+		if token.flags & CONJUNCT_FUNC:
+			for child_func in conll_tokens[token.head_index].child_funcs:
 				token.child_funcs.append(child_func)
-			token.func = conll_tokens[int(token.head)].func
-			token.head = conll_tokens[int(token.head)].head
+			token.func = conll_tokens[token.head_index].func
+			token.head = conll_tokens[token.head_index].head
 			token.coordinate = True
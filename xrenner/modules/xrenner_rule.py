@@ -1,4 +1,6 @@
-import re, operator
+import re, operator, io, time
+from operator import attrgetter
+from .xrenner_classes import DET_FUNC, INDEXED_MARKABLE_PROPS
 
 class CorefRule:
 	def __init__(self,rule_string, rule_num):
@@ -23,13 +25,199 @@ class CorefRule:
 			self.ante_constraints.append(ConstraintMatcher(item))
 		# Make sure that group failure criteria are first to be checked
 		self.ante_constraints.sort(key=lambda x: x.group_failure, reverse=True)
+		# Antecedent constraints in their default order, which may be changed by order_constraints
+		self.base_constraints = list(self.ante_constraints)
+		# Property which antecedents must share with the anaphor, allowing candidates to be retrieved from the
+		# document's MarkableIndex. Not used if any constraint has group failure, which must be checked for every
+		# markable in the search window.
+		self.index_prop = None
+		if not any(constraint.group_failure for constraint in self.ante_constraints):
+			for constraint in self.ante_constraints:
+				if constraint.match_type == "dollar" and constraint.key in INDEXED_MARKABLE_PROPS and constraint.negative is operator.truth:
+					self.index_prop = constraint.key
+					break
 		self.rule_num = rule_num
 
+	def order_constraints(self, order):
+		"""
+		Sets the order in which antecedent constraints are checked. Group failure constraints are always checked
+		first in their default order, since a failure of any of them rules out the anaphor's group.
+
+		:param order: list of positions in the default order of antecedent constraints
+		:return: bool - whether the order was applied, i.e. it contains each constraint exactly once
+		"""
+		if sorted(order) != list(range(len(self.base_constraints))):
+			return False
+		constraints = self.base_constraints
+		order = [i for i in range(len(constraints)) if constraints[i].group_failure] + \
+				[i for i in order if not constraints[i].group_failure]
+		self.ante_constraints = [constraints[i] for i in order]
+		return True
+
 	def __repr__(self):
 		return self.ana_spec + " -> " + self.ante_spec + " (" + str(self.max_distance) + ", " + self.propagation + ", "+ self.clf_name + ")"
 
 
+class ConstraintProfile:
+	"""
+	Records how often each antecedent constraint of a set of coref rules is checked, how often it matches and the
+	time spent matching it, in order to find the cheapest order in which to check each rule's constraints.
+	"""
+
+	timer = getattr(time, "perf_counter", time.time)
+
+	def __init__(self, rules):
+		"""
+		:param rules: list of CorefRule objects whose antecedent constraints are profiled; rules with the same
+			rule number (e.g. in speaker and non-speaker rule lists) share their statistics
+		"""
+		self.rules = {}
+		self.stats = {}  # Rule number to list of [checks, matches, seconds] per constraint in the default order
+		for rule in rules:
+			if rule.rule_num not in self.stats:
+				self.rules[rule.rule_num] = rule
+				self.stats[rule.rule_num] = [[0, 0, 0.0] for _ in rule.base_constraints]
+			for constraint, stats in zip(rule.base_constraints, self.stats[rule.rule_num]):
+				constraint.match = self.profiled(constraint.match, stats)
+
+	def profiled(self, match, stats):
+		timer = self.timer
+
+		def profiled_match(mark, lex, anaphor=None):
+			start = timer()
+			retval = match(mark, lex, anaphor)
+			stats[2] += timer() - start
+			stats[0] += 1
+			if retval:
+				stats[1] += 1
+			return retval
+		return profiled_match
+
+	def best_order(self, rule_num):
+		"""
+		Orders constraints by expected cost per rejected candidate, so that cheap constraints which often fail are
+		checked first. Constraints which always matched come last, and unchecked ones keep their current position
+		relative to each other. Group failure constraints stay first, as in CorefRule.order_constraints.
+
+		:param rule_num: the number of a profiled rule
+		:return: list of positions in the rule's default order of antecedent constraints
+		"""
+		rule = self.rules[rule_num]
+		stats = self.stats[rule_num]
+		current = [rule.base_constraints.index(constraint) for constraint in rule.ante_constraints]
+
+		def rank(i):
+			checks, matches, seconds = stats[i]
+			if rule.base_constraints[i].group_failure:
+				return (0, 0, i)
+			elif checks == 0:
+				return (3, 0, current.index(i))
+			elif matches == checks:
+				return (2, 0, current.index(i))
+			return (1, (seconds / checks) / (1 - float(matches) / checks), current.index(i))
+
+		return sorted(current, key=rank)
+
+	def write(self, filename):
+		"""
+		Writes the best constraint order of each profiled rule to a file, which LexData reads when the model is loaded
+
+		:param filename: path of the .xro file
+		:return: void
+		"""
+		with io.open(filename, 'w', encoding="utf8", newline="\n") as f:
+			f.write(u"# Antecedent constraint order for coref_rules.tab, generated by profiling\n")
+			f.write(u"# rule number\tantecedent spec\tconstraint order\tchecks,matches,microseconds per constraint\n")
+			for rule_num in sorted(self.stats):
+				stats = ";".join(str(checks) + "," + str(matches) + "," + str(int(seconds * 1000000)) for checks, matches, seconds in self.stats[rule_num])
+				order = ",".join(str(i) for i in self.best_order(rule_num))
+				f.write(u"\t".join([str(rule_num), self.rules[rule_num].ante_spec, order, stats]) + u"\n")
+
+
+class CorefRuleSet(list):
+	"""
+	Ordered list of CorefRule objects, compiled into a table of the distinct anaphor constraints used by the rules.
+	Rules sharing a constraint share one ConstraintMatcher, and each constraint is evaluated at most once per
+	anaphor, so that a failed constraint eliminates every rule containing it.
+	"""
+
+	# Anaphor properties which can change while antecedents are sought, e.g. by merging entities with a candidate
+	volatile_keys = {"entity", "subclass", "agree", "cardinality", "LAST"}
+
+	def __init__(self, rules=()):
+		list.__init__(self, rules)
+		self.constraints = []  # Distinct anaphor ConstraintMatcher objects
+		self.rule_constraints = []  # Indices into self.constraints for each rule, in the order they are checked
+		self.volatile = []  # Indices of constraints on volatile_keys, which are rechecked after each search
+		constraint_indices = {}
+		for rule in self:
+			indices = []
+			for constraint in rule.ana_constraints:
+				signature = (constraint.key, constraint.negative, constraint.match_type, str(constraint.value), constraint.group_failure)
+				if signature not in constraint_indices:
+					constraint_indices[signature] = len(self.constraints)
+					if constraint.key in self.volatile_keys:
+						self.volatile.append(len(self.constraints))
+					self.constraints.append(constraint)
+				indices.append(constraint_indices[signature])
+			rule.ana_constraints = [self.constraints[index] for index in indices]
+			# Constraints which always match are not checked
+			self.rule_constraints.append([index for index in indices if self.constraints[index].match_type != "none"])
+
+	def applicable_rules(self, markable, lex, restrict_rule=""):
+		"""
+		Generates the rules whose anaphor constraints match a markable, in order
+
+		:param markable: the Markable object to find an antecedent for
+		:param lex: the LexData object with gazetteer information and model settings
+		:param restrict_rule: a string specifying a subset of rules that should be checked (e.g. only rules with 'appos')
+		:return: generator of CorefRule objects
+		"""
+		results = {}
+		for rule, indices in zip(self, self.rule_constraints):
+			if restrict_rule != "" and restrict_rule not in rule.ana_spec:
+				continue
+			for index in indices:
+				if index not in results:
+					results[index] = self.constraints[index].match(markable, lex)
+				if not results[index]:
+					break
+			else:
+				yield rule
+				# Searching with the rule may have changed the markable, e.g. by merging entities
+				for index in self.volatile:
+					results.pop(index, None)
+
+	def eliminating_constraints(self, markable, lex, restrict_rule=""):
+		"""
+		Finds the first anaphor constraint which fails for a markable in each rule, for debugging rule order
+
+		:param markable: the Markable object to find an antecedent for
+		:param lex: the LexData object with gazetteer information and model settings
+		:param restrict_rule: a string specifying a subset of rules that should be checked (e.g. only rules with 'appos')
+		:return: list of (CorefRule, ConstraintMatcher) tuples in rule order, with None for rules which apply
+		"""
+		results = {}
+		eliminated = []
+		for rule, indices in zip(self, self.rule_constraints):
+			if restrict_rule != "" and restrict_rule not in rule.ana_spec:
+				continue
+			failed = None
+			for index in indices:
+				if index not in results:
+					results[index] = self.constraints[index].match(markable, lex)
+				if not results[index]:
+					failed = self.constraints[index]
+					break
+			eliminated.append((rule, failed))
+		return eliminated
+
+
 class ConstraintMatcher:
+
+	props = {"form", "text", "agree", "entity", "subclass", "cardinality","text_lower","lemma","pos","func","quoted","mood","speaker","sentence"}
+	string_props = {"form", "text", "text_lower", "lemma", "pos", "func"}  # Properties which are always strings
+
 	def __init__(self,constraint):
 		self.group_failure = False
 		self.negative = operator.truth
@@ -37,7 +225,6 @@ class ConstraintMatcher:
 		self.value = ""
 		self.key = ""
 		self.compiled_re = None
-		self.props = {"form", "text", "agree", "entity", "subclass", "cardinality","text_lower","lemma","pos","func","quoted","mood","speaker","sentence"}
 
 		if constraint.endswith("*"):
 			self.group_failure = True
@@ -111,108 +298,135 @@ class ConstraintMatcher:
 			self.key = "LAST"
 			self.value = constraint[constraint.find("[")+1:-1]
 
+		self.match = self.compile()
+
 	def __repr__(self):
 		if self.negative == operator.truth:
 			op = ""
 		else:
 			op = "!"
-		return self.key + " " + op + self.match_type + " '" + self.value + "'"
+		return self.key + " " + op + self.match_type + " '" + str(self.value) + "'"
 
-	def match(self,mark,lex,anaphor=None):
-		test_val = ""
+	def __getstate__(self):
+		# The compiled predicate is a closure which cannot be pickled, and is rebuilt from the other attributes
+		state = self.__dict__.copy()
+		del state["match"]
+		return state
+
+	def __setstate__(self, state):
+		self.__dict__.update(state)
+		self.match = self.compile()
+
+	def compile(self):
+		"""
+		Compiles this constraint into a predicate specialized for its key and match type, which is stored as
+		self.match(mark, lex, anaphor=None). The predicate does not modify the matcher, so rules can be shared.
+
+		:return: function taking the Markable to check, the LexData object and the anaphor for $1-style constraints
+		"""
 		op = self.negative
+		key = self.key
+		value = self.value
+		match_type = self.match_type
 
-		if self.match_type == "none":
-			return True
-		elif self.match_type == "dollar":
-			if self.key in self.props:
-				self.value = str(getattr(anaphor, self.key))
-				test_val = str(getattr(mark, self.key))
-			elif self.key == "head":
-				return op(anaphor.head.id == mark.head.head)
-			elif self.key == "child":
-				return op(anaphor.head.head == mark.head.id)
-			elif self.key == "hasa":
-				return op(anaphor.head.head_text in lex.hasa[mark.lemma])
-			elif self.key == "parent":
-				if mark.head.head == "0":  # Root token, by definition not same parent as another token
-					retval = op(False)
-				elif mark.sentence.sent_num != anaphor.sentence.sent_num:
-					retval = op(False)
-				else:
-					retval = op(anaphor.head.head == mark.head.head)
-				if retval is False and self.group_failure and anaphor is not None:
-					mark.non_antecdent_groups.add(anaphor.group)
-					anaphor.non_antecdent_groups.add(mark.group)
-				return retval
-			elif self.key == "has_child_func":
-				raise Exception("coref rule 'has_child_func=$' : $ identity not implemented for has_child_func")
-			elif self.key == "mod":
-				mods = getattr(anaphor.head, "modifiers")
-				found_mod = False
-				for mod1 in mark.head.modifiers:
-					for mod2 in mods:
-						if mod1.lemma == mod2.lemma and lex.filters["det_func"].match(mod1.func) is None and \
-						lex.filters["det_func"].match(mod2.func) is None:
-							found_mod = True
-				if not found_mod:
-					if self.group_failure and anaphor is not None:
-						mark.non_antecdent_groups.add(anaphor.group)
+		test = None
+		if match_type == "none":
+			return lambda mark, lex, anaphor=None: True
+		elif match_type == "dollar":
+			if key in self.props:
+				get = attribute_accessor(key)
+				test = lambda mark, lex, anaphor=None: op(get(mark) == get(anaphor))
+			elif key == "head":
+				return lambda mark, lex, anaphor=None: op(anaphor.head.id == mark.head.head)
+			elif key == "child":
+				return lambda mark, lex, anaphor=None: op(anaphor.head.head == mark.head.id)
+			elif key == "hasa":
+				return lambda mark, lex, anaphor=None: op(anaphor.head.head_text in lex.hasa[mark.lemma])
+			elif key == "parent":
+				def test(mark, lex, anaphor=None):
+					if mark.head.head == "0":  # Root token, by definition not same parent as another token
+						return op(False)
+					elif mark.sentence.sent_num != anaphor.sentence.sent_num:
+						return op(False)
+					return op(anaphor.head.head == mark.head.head)
+			elif key == "has_child_func":
+				def test(mark, lex, anaphor=None):
+					raise Exception("coref rule 'has_child_func=$' : $ identity not implemented for has_child_func")
+			elif key == "mod":
+				def test(mark, lex, anaphor=None):
+					for mod1 in mark.head.modifiers:
+						if not mod1.flags & DET_FUNC:
+							for mod2 in anaphor.head.modifiers:
+								if mod1.lemma == mod2.lemma and not mod2.flags & DET_FUNC:
+									return True
 					return False
-				else:
-					return True
+			else:
+				test = lambda mark, lex, anaphor=None: op(value == "")
 		else:
-			if self.key in self.props:
-				if self.match_type == "bool":
-					test_val = getattr(mark, self.key)
-				else:
-					test_val = str(getattr(mark, self.key))
-			elif self.key == "LAST":
-				if self.value in lex.last:
-					return op(lex.last[self.value].entity==mark.entity)
-				else:
+			if key in self.props:
+				get = attrgetter(key) if match_type == "bool" else attribute_accessor(key)
+			elif key == "LAST":
+				def last_test(mark, lex, anaphor=None):
+					if value in lex.last:
+						return op(lex.last[value].entity == mark.entity)
 					return False
-			elif self.key == "has_child_func":
-				test_val = mark.child_func_string
-				self.match_type = "substring"
-				if self.value[0] != ";":
-					self.value = ";"+self.value+";"
-			elif self.key == "mod":
-				mods = [self.value]
-				found_mod = False
-				for mod1 in mark.head.modifiers:
-					for mod2 in mods:
-						# Note that mod2 is just a string - not a ParsedToken
-						if mod1.lemma == mod2 and lex.filters["det_func"].match(mod1.func) is None:
-							found_mod = True
-				if not found_mod:
-					if self.group_failure and anaphor is not None:
-						mark.non_antecdent_groups.add(anaphor.group)
+				return last_test
+			elif key == "has_child_func":
+				get = attrgetter("child_func_string")
+				match_type = "substring"
+				if not value.startswith(";"):
+					value = ";" + value + ";"
+			elif key == "mod":
+				def test(mark, lex, anaphor=None):
+					# Note that value is just a string - not a ParsedToken
+					for mod1 in mark.head.modifiers:
+						if mod1.lemma == value and not mod1.flags & DET_FUNC:
+							return True
 					return False
-				else:
-					return True
-			elif self.key == "head":
-				raise Exception("coref rule 'head=VAL' : value match not implemented for head")
-			elif self.key == "child":
-				raise Exception("coref rule 'child=VAL' : value match not implemented for child")
-
-		if self.match_type == "exact":
-			retval = op(test_val == self.value)
-		elif self.match_type == "substring":
-			retval = op(self.value in test_val)
-		elif self.match_type == "regex":
-			retval = op(self.compiled_re.search(test_val) is not None)
-		elif self.match_type == "startswith":
-			retval = op(test_val.startswith(self.value))
-		elif self.match_type == "endswith":
-			retval = op(test_val.endswith(self.value))
-		elif self.match_type == "dollar":
-			retval = op(test_val == self.value)
-		elif self.match_type == "bool":
-			retval = op(test_val == self.value)
-
-		if retval is False and self.group_failure and anaphor is not None:
-			mark.non_antecdent_groups.add(anaphor.group)
-
-		return retval
+			elif key == "head":
+				def test(mark, lex, anaphor=None):
+					raise Exception("coref rule 'head=VAL' : value match not implemented for head")
+			elif key == "child":
+				def test(mark, lex, anaphor=None):
+					raise Exception("coref rule 'child=VAL' : value match not implemented for child")
+			else:
+				get = lambda mark: ""
+
+			if test is None:  # Compare the accessed property to the value
+				if match_type == "substring":
+					test = lambda mark, lex, anaphor=None: op(value in get(mark))
+				elif match_type == "regex":
+					search = self.compiled_re.search
+					test = lambda mark, lex, anaphor=None: op(search(get(mark)) is not None)
+				elif match_type == "startswith":
+					test = lambda mark, lex, anaphor=None: op(get(mark).startswith(value))
+				elif match_type == "endswith":
+					test = lambda mark, lex, anaphor=None: op(get(mark).endswith(value))
+				else:  # exact and bool
+					test = lambda mark, lex, anaphor=None: op(get(mark) == value)
+
+		if not self.group_failure:
+			return test
+
+		# Record failed antecedent groups for the anaphor, and for sameparent also the reverse
+		mutual = key == "parent"
+
+		def group_failure_test(mark, lex, anaphor=None):
+			retval = test(mark, lex, anaphor)
+			if retval is False and anaphor is not None:
+				mark.non_antecdent_groups.add(anaphor.group)
+				if mutual:
+					anaphor.non_antecdent_groups.add(mark.group)
+			return retval
+		return group_failure_test
+
 
+def attribute_accessor(key):
+	"""
+	:param key: name of a Markable property in ConstraintMatcher.props
+	:return: function returning the property of a Markable as a string, as compared by constraints
+	"""
+	if key in ConstraintMatcher.string_props:
+		return attrgetter(key)
+	get = attrgetter(key)
+	return lambda mark: str(get(mark))
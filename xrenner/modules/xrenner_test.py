@@ -4,11 +4,14 @@ Module to generate and run unit tests
 Author: Amir Zeldes
 """
 
-from collections import defaultdict
+from collections import defaultdict, namedtuple
 import unittest
-import re, os, sys
+import re, os, io, sys, subprocess, pickle
 from .xrenner_xrenner import Xrenner
 from .xrenner_coref import find_antecedent
+from .xrenner_marker import lookup_entity_text
+from .xrenner_rule import CorefRule, CorefRuleSet, ConstraintMatcher, ConstraintProfile
+from .xrenner_classes import MarkHeadTable, LRUCache, MarkableIndex, POS_FLAG_FILTERS, FUNC_FLAG_FILTERS
 
 if sys.version_info[0] < 3:
 	python_version = 2
@@ -126,6 +129,7 @@ class Test1Model(unittest.TestCase):
 		self.assertTrue(len(self.xrenner.lex.coref_rules),"check that coref_rules is full")
 		self.assertTrue(len(self.xrenner.lex.entities),"check that entities is full")
 		self.assertTrue(len(self.xrenner.lex.entity_heads),"check that entity_heads is full")
+		self.assertIsInstance(list(self.xrenner.lex.entities.values())[0][0].freq, int, "check that entity records are pre-parsed")
 		self.assertTrue(len(self.xrenner.lex.pronouns),"check that pronouns is full")
 		self.assertTrue(len(self.xrenner.lex.filters),"check that filters is full")
 
@@ -143,6 +147,175 @@ class Test1Model(unittest.TestCase):
 		self.assertTrue(len(self.xrenner.lex.antonyms),"check that antonyms is full")
 		self.assertTrue(len(self.xrenner.lex.isa),"check that isa is full")
 
+	def test_model_cache(self):
+		print("\nChecking model cache:  ")
+		# A model read from the compiled cache should be identical to one compiled from the model files
+		cached = Xrenner("eng", override="TEST")
+		compiled = Xrenner("eng", override="TEST", no_cache=True)
+		self.assertEqual(cached.lex.cache_key, Xrenner("eng", override="TEST").lex.cache_key, "check that cache key is stable")
+		self.assertIsNone(compiled.lex.cache_key, "check that no cache key is computed without the cache")
+		self.assertEqual(cached.lex.entities, compiled.lex.entities, "check that cached entities match")
+		self.assertEqual(cached.lex.atoms, compiled.lex.atoms, "check that cached atoms match")
+		self.assertEqual(cached.lex.morph, compiled.lex.morph, "check that cached morph matches")
+		self.assertEqual(len(cached.lex.coref_rules), len(compiled.lex.coref_rules), "check that cached coref rules match")
+
+	def test_lazy_files(self):
+		print("\nChecking lazy model files:  ")
+		# Optional gazetteers should only be read from the model when first accessed
+		lazy = Xrenner("eng", override="TEST", no_cache=True)
+		self.assertNotIn("nominalizations", lazy.lex.__dict__, "check that nominalizations is not read on load")
+		self.assertIn("nominalizations.tab", lazy.lex.get_load_report().split("\n")[1], "check that unread files are reported")
+		self.assertTrue(len(lazy.lex.nominalizations), "check that nominalizations is read on access")
+		self.assertIn("nominalizations.tab", lazy.lex.get_load_report().split("\n")[0], "check that read files are reported")
+
+	def test_lazy_file_cache(self):
+		print("\nChecking lazy model file cache:  ")
+		# Optional gazetteers read once should be served from their table cache files by later loads
+		Xrenner("eng", override="TEST").lex.read_lazy_files()
+		warm = Xrenner("eng", override="TEST")
+		compiled = Xrenner("eng", override="TEST", no_cache=True)
+
+		def read_model_file(*args, **kwargs):
+			raise AssertionError("optional model file read despite warm cache")
+
+		warm.lex.read_delim = warm.lex.read_isa = warm.lex.read_antonyms = read_model_file
+		for name in sorted(warm.lex.lazy_files):
+			self.assertEqual(getattr(warm.lex, name), getattr(compiled.lex, name), "check that cached " + name + " matches")
+
+	def test_mmap_lex(self):
+		print("\nChecking memory-mapped lexicon store:  ")
+		# Gazetteers served from the lexicon store should give the same lookups as in-memory gazetteers
+		mapped = Xrenner("eng", override="TEST", mmap_lex=True)
+		compiled = Xrenner("eng", override="TEST", no_cache=True)
+		self.assertEqual(mapped.lex.entities, compiled.lex.entities, "check that mapped entities match")
+		self.assertEqual(mapped.lex.isa, compiled.lex.isa, "check that mapped isa entries match")
+		self.assertNotIn("xrenner_no_such_entity", mapped.lex.entities, "check that missing keys are not found")
+		for parent in list(compiled.lex.entity_deps)[:100]:
+			self.assertEqual(mapped.lex.entity_deps[parent], compiled.lex.entity_deps[parent], "check that mapped entity_deps match")
+
+	def test_entity_freqs(self):
+		print("\nChecking entity frequencies:  ")
+		lex = self.xrenner.lex
+		table = io.StringIO(u"house\tplace\tbuilding/inanim\t12\nhome\tplace\tbuilding/inanim\tM \ncity\tplace\tcity/inanim\n")
+		entities = lex.read_delim(table, "quadruple")
+		self.assertEqual(entities["house"][0].freq, 12, "check numeric frequency")
+		self.assertEqual(entities["home"][0].freq, 0, "check that a non-numeric frequency is read as 0")
+		self.assertEqual(entities["city"][0].freq, 0, "check that a missing frequency is read as 0")
+
+	def test_phrase_tries(self):
+		print("\nChecking phrase tries:  ")
+		# Walking the tokens of each phrase through a trie should reach the phrase's value
+		lex = self.xrenner.lex
+		for trie, phrases in [(lex.stop_trie, lex.stop_list), (lex.affix_trie, lex.affix_tokens), (lex.affix_trie_rev, lex.affix_tokens)]:
+			for phrase in [phrase for phrase in phrases if len(phrase) > 0 and phrase == phrase.strip()][:100]:
+				tokens = phrase.split(" ")
+				if trie.reverse:
+					tokens.reverse()
+				node = trie.root
+				for token in tokens:
+					node = trie.step(node, token)
+				value = phrases[phrase] if isinstance(phrases, dict) else True
+				self.assertEqual(node[trie.END], value, "check that phrase trie matches " + phrase)
+
+	def test_label_flags(self):
+		print("\nChecking filter flags:  ")
+		# Memoized flags should agree with matching the filter regexes directly
+		lex = self.xrenner.lex
+		for flags, flag_filters in [(lex.pos_flags, POS_FLAG_FILTERS), (lex.func_flags, FUNC_FLAG_FILTERS)]:
+			for label in ["NN", "NNP", "PRP", "VBD", "nsubj", "det", "appos", "conj", "_", ""]:
+				for name, flag in flag_filters.items():
+					self.assertEqual(bool(flags[label] & flag), lex.filters[name].match(label) is not None, "check flag " + name + " for " + label)
+
+	def test_mark_heads(self):
+		print("\nChecking pos_func_heads table:  ")
+		lex = self.xrenner.lex
+		table = MarkHeadTable("CD!nummod;CD!dep;VBG+nsubj", lex.pos_flags, lex.func_flags)
+		self.assertFalse(table.pos_func_combo("CD", "nummod"), "check that negated pos+func combination is excluded")
+		self.assertTrue(table.pos_func_combo("CD", "obj"), "check that other functions of negated pos are allowed")
+		self.assertTrue(table.pos_func_combo("VBG", "nsubj"), "check positive pos+func combination")
+		self.assertFalse(table.pos_func_combo("VBG", "obj"), "check unlisted pos+func combination")
+
+	def test_gazetteer_index(self):
+		print("\nChecking gazetteer index:  ")
+		lex = self.xrenner.lex
+		cache = LRUCache(2)
+		cache.put("a", 1)
+		cache.put("b", 2)
+		cache.get("a")
+		cache.put("c", 3)  # Evicts b, the least recently used entry
+		self.assertEqual((cache.get("a"), cache.get("b"), cache.get("c")), (1, None, 3), "check LRU eviction")
+		for text in ["Peter", "New Zealand", "house"]:
+			entry = lex.lookup(text)
+			self.assertEqual(entry.entities is not None, text in lex.entities, "check merged entities entry for " + text)
+			self.assertEqual(entry.entity_heads is not None, text in lex.entity_heads, "check merged entity_heads entry for " + text)
+			self.assertEqual(entry.first_name is not None, text in lex.first_names, "check merged first_names entry for " + text)
+			self.assertEqual(entry.last_name is not None, text in lex.last_names, "check merged last_names entry for " + text)
+			self.assertEqual(entry.atom is not None, text in lex.atoms, "check merged atoms entry for " + text)
+		self.assertEqual(lex.lookup("xyzzy plugh"), (None,) * 6, "check empty entry for unknown strings")
+
+	def test_entity_lookup_cache(self):
+		print("\nChecking entity lookup cache:  ")
+		lex = self.xrenner.lex
+		Head = namedtuple("Head", ["head_text"])
+		Mark = namedtuple("Mark", ["func", "head"])
+		mark = Mark("nsubj", Head("said"))
+		hits = lex.entity_cascade_cache.hits
+		first = lookup_entity_text("Peter", mark, lex)
+		self.assertEqual(lookup_entity_text("Peter", Mark("nsubj", Head("said")), lex), first, "check cached entity lookup")
+		self.assertEqual(lex.entity_cascade_cache.hits, hits + 1, "check entity lookup cache hit count")
+		lookup_entity_text("Peter", Mark("obj", Head("said")), lex)
+		self.assertEqual(lex.entity_cascade_cache.hits, hits + 1, "check that the cache is keyed on function")
+
+	def test_markable_index(self):
+		print("\nChecking markable index:  ")
+		index = MarkableIndex()
+		Mark = namedtuple("Mark", ["text", "text_lower", "lemma"])
+		for text in ["The house", "a house", "The House", "The house"]:
+			index.add_markable(Mark(text, text.lower(), "house"))
+		self.assertEqual(index.lookup("text", "The house"), [0, 3], "check markable positions by text")
+		self.assertEqual(index.lookup("text_lower", "the house", 1), [2, 3], "check window start")
+		self.assertEqual(index.lookup("lemma", "house", 4), [], "check empty window")
+		self.assertEqual(index.lookup("text", "home"), [], "check unindexed text")
+
+	def test_coref_rule_set(self):
+		print("\nChecking compiled coref rules:  ")
+		lex = self.xrenner.lex
+		rules = CorefRuleSet([CorefRule(rule, num) for num, rule in enumerate(['form="pronoun";text=$1;0;propagate',
+									'form="pronoun"&func=/nsubj/;none;1;propagate', 'form!="pronoun";none;10;propagate'])])
+		self.assertEqual(len(rules.constraints), 3, "check that shared anaphor constraints are compiled once")
+		Mark = namedtuple("Mark", ["text", "form", "func"])
+		applicable = [rule.rule_num for rule in rules.applicable_rules(Mark("he", "pronoun", "nsubj"), lex)]
+		self.assertEqual(applicable, [0, 1], "check rules applicable to a pronoun")
+		applicable = [rule.rule_num for rule in rules.applicable_rules(Mark("the house", "common", "obj"), lex)]
+		self.assertEqual(applicable, [2], "check rules applicable to a common noun")
+		eliminated = [(rule.rule_num, str(constraint) if constraint is not None else None)
+					  for rule, constraint in rules.eliminating_constraints(Mark("he", "pronoun", "obj"), lex)]
+		self.assertEqual([(num, constraint is None) for num, constraint in eliminated], [(0, True), (1, False), (2, False)],
+						 "check constraints eliminating rules for a pronoun object")
+		self.assertIn("func", eliminated[1][1], "check that the failed function constraint is reported")
+
+	def test_constraint_predicates(self):
+		print("\nChecking compiled constraints:  ")
+		lex = self.xrenner.lex
+		Mark = namedtuple("Mark", ["text", "func"])
+		constraint = ConstraintMatcher("text=$1")
+		self.assertTrue(constraint.match(Mark("Peter", "nsubj"), lex, Mark("Peter", "obj")), "check $1 match")
+		self.assertFalse(constraint.match(Mark("Peter", "nsubj"), lex, Mark("Paul", "obj")), "check $1 mismatch")
+		self.assertEqual(constraint.value, "$1", "check that matching does not modify the constraint")
+		constraint = pickle.loads(pickle.dumps(ConstraintMatcher("func=/^nsubj/"), 2))
+		self.assertTrue(constraint.match(Mark("Peter", "nsubj:pass"), lex), "check predicate compiled after unpickling")
+
+	def test_constraint_order(self):
+		print("\nChecking constraint order:  ")
+		rule = CorefRule('form!="pronoun";text=$1&!sameparent*&form="proper";0;propagate', 1)
+		self.assertTrue(rule.order_constraints([2, 1, 0]), "check valid constraint order")
+		self.assertEqual([str(constraint) for constraint in rule.ante_constraints],
+						 ["parent !dollar '$1'", "form exact 'proper'", "text dollar '$1'"], "check that group failure constraints stay first")
+		self.assertFalse(rule.order_constraints([0, 1]), "check incomplete constraint order")
+		profile = ConstraintProfile([rule])
+		profile.stats[1] = [[10, 5, 0.001], [10, 1, 0.001], [4, 4, 0.0001]]
+		self.assertEqual(profile.best_order(1), [0, 1, 2], "check order by cost per rejected candidate")
+
 
 class Test2MarkableMethods(unittest.TestCase):
 
@@ -253,6 +426,34 @@ class Test3CorefMethods(unittest.TestCase):
 		self.assertEqual(target.chains,result.chains,"verbal event stemming (visited <- the visit	)")
 
 
+class Test4Startup(unittest.TestCase):
+
+	# Heavy optional dependencies which should only be imported once their feature is used
+	heavy_modules = ["xmltodict", "numpy", "flair", "torch", "dill", "joblib", "modules.depedit"]
+
+	def run_startup(self, code):
+		# Run code in a fresh interpreter, so that modules imported by other tests are not counted
+		xrenner_dir = os.path.dirname(os.path.realpath(__file__)) + os.sep + ".."
+		proc = subprocess.Popen([sys.executable, "-c", code], cwd=xrenner_dir, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+		out, err = proc.communicate()
+		self.assertEqual(proc.returncode, 0, "check that startup code runs: " + err.decode("utf8"))
+		return out.decode("utf8").split()
+
+	def test_startup_imports(self):
+		print("\nChecking startup imports:  ")
+		imported = self.run_startup("import sys, modules.xrenner_xrenner; print(' '.join(sys.modules))")
+		self.assertIn("modules.xrenner_xrenner", imported, "check that xrenner modules can be imported")
+		for module in self.heavy_modules:
+			self.assertNotIn(module, imported, "check that " + module + " is not imported at startup")
+
+	def test_startup_lazy_files(self):
+		print("\nChecking startup model loading:  ")
+		code = "from modules.xrenner_xrenner import Xrenner; lex = Xrenner('eng', rule_based=True, no_seq=True, no_cache=True).lex; " \
+			   "print(' '.join(name for name in lex.lazy_files if name in lex.__dict__) + ' |')"
+		read = self.run_startup(code)
+		self.assertEqual(read, ["|"], "check that no optional gazetteers are read when the model is loaded")
+
+
 class Case:
 
 	def __init__(self, case_string):
@@ -292,6 +493,7 @@ def suite():
 	test_suite.addTest(unittest.makeSuite(Test1Model))
 	test_suite.addTest(unittest.makeSuite(Test2MarkableMethods))
 	test_suite.addTest(unittest.makeSuite(Test3CorefMethods))
+	test_suite.addTest(unittest.makeSuite(Test4Startup))
 
 	return test_suite
 
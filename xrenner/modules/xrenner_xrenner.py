@@ -15,14 +15,13 @@ from .xrenner_preprocess import *
 from .xrenner_marker import make_markable
 from .xrenner_lex import *
 from .xrenner_postprocess import postprocess_coref
-from .depedit import DepEdit
 import ntpath, os, io, decimal
 
 decimal.getcontext().rounding = decimal.ROUND_DOWN
 
 class Xrenner:
 
-	def __init__(self, model="eng", override=None, rule_based=False, no_seq=False):
+	def __init__(self, model="eng", override=None, rule_based=False, no_seq=False, no_cache=False, mmap_lex=False):
 		"""
 		Main class for xrenner coreferencer. Invokes the load method to read model data.
 		
@@ -30,13 +29,18 @@ class Xrenner:
 		:param override: name of a section in models/override.ini if configuration overrides should be applied
 		:param rule_based: do not use machine learning classifiers for coreference resolution
 		:param no_seq: do not use machine learning sequence taggers for entity resolution
+		:param no_cache: do not use the compiled model cache, always read model data from model files
+		:param mmap_lex: serve large gazetteers from a memory-mapped lexicon store shared between processes
 		"""
 
 		self.docname = "untitled"
 		self.rule_based = rule_based
 		self.no_seq = no_seq
+		self.no_cache = no_cache
+		self.mmap_lex = mmap_lex
 		self.load(model, override)
 		if "depedit.ini" in self.lex.model_files:
+			from .depedit import DepEdit
 			depedit_config = self.lex.model_files["depedit.ini"]
 			self.depedit = DepEdit(depedit_config, options=type('', (), {"kill":"supertoks", "quiet":True})())
 		else:
@@ -55,7 +59,7 @@ class Xrenner:
 
 		self.model = model
 		self.override = override
-		self.lex = LexData(self.model, self, self.override, self.rule_based, self.no_seq)
+		self.lex = LexData(self.model, self, self.override, self.rule_based, self.no_seq, self.no_cache, self.mmap_lex)
 
 	def set_doc_name(self, name):
 		"""
@@ -82,199 +86,223 @@ class Xrenner:
 		:return: output based on requested format
 		"""
 
+		# Unittest output repeats the input parse, so only that format holds on to a list of all input lines
+		keep_parse = out_format == "unittest"
+
 		# Check if this is a file name from the main script or a parse delivered in an import or unittest scenario
 		if "\t" in infile or isinstance(infile,list):  # This is a raw parse as string or list, not a file name
 			self.docpath = os.path.dirname(os.path.abspath("."))
 			if self.lex.docname is None:
 				self.set_doc_name("untitled")
 			if not isinstance(infile,list):
-				infile = infile.replace("\r","").split("\n")
-		else:  # This is a file name, extract document name and path, then read the file
+				infile = infile.replace("\r","").split("\n") if keep_parse else iter_lines(infile)
+			parse = self.read_parse(infile)
+		else:  # This is a file name, extract document name and path, then stream the file
 			self.docpath = os.path.dirname(os.path.abspath(infile))
 			self.set_doc_name(clean_filename(ntpath.basename(infile)))
+			for encoding in ["utf8", "ISO 8859-1"]:
+				try:
+					with io.open(infile, encoding=encoding) as f:
+						parse = self.read_parse(f.read().replace("\r","").split("\n") if keep_parse else f)
+					break
+				except UnicodeDecodeError:  # Start over with legacy encoding
+					continue
+
+		lex = self.lex
+		conll_tokens = self.conll_tokens
+		markstart_dict = self.markstart_dict
+		markend_dict = self.markend_dict
+		sentences = self.sentences
+
+		self.tokoffset = 0
+		for sentence in sentences:
+			self.tokoffset += sentence.start_offset - self.tokoffset
+			self.process_sentence(sentence.start_offset,sentence)
+
+		marks_to_add = []
+		dump = "" ###
+		if lex.filters["seek_verb_for_defs"]:
+			for mark in self.markables:
+				if mark.definiteness == "def" and mark.antecedent == "none" and mark.form == "common" and \
+				(lex.filters["event_def_entity"] == mark.entity or lex.filters["abstract_def_entity"] == mark.entity):
+					for tok in conll_tokens[0:mark.start]:
+						if tok.flags & VERB_HEAD_POS:
+							dump += str(mark.start)+"-"+str(mark.end) + ";"+tok.id+"-"+tok.id+"\t"+str(lex.docname)+"\t"+tok.text+"\t"+mark.head.text+"\t"+str(mark.sent_num-tok.sentence.sent_num)+"\t"
+							if stems_compatible(tok,mark.head,lex):
+								comp = "T"
+								dump += comp + "\n"
+								v_antecedent = make_markable(tok,conll_tokens,SubtreeIndex(),tok.sentence.start_offset,tok.sentence,[],lex)
+								mark.antecedent = v_antecedent
+								mark.coref_type = "coref"
+								v_antecedent.entity = mark.entity
+								v_antecedent.subclass = mark.subclass
+								v_antecedent.definiteness = "none"
+								v_antecedent.form = "verbal"
+								v_antecedent.infstat = "new"
+								v_antecedent.group = mark.group
+								v_antecedent.id = "referent_" + v_antecedent.head.id
+								marks_to_add.append(v_antecedent)
+							else:
+								comp = "F"
+
+
+		for mark in marks_to_add:
+			markstart_dict[mark.start].append(mark)
+			markend_dict[mark.end].append(mark)
+			self.markables_by_head[mark.head.id] = mark
+			self.markables.append(mark)
+
+
+		postprocess_coref(self.markables, lex, markstart_dict, markend_dict, self.markables_by_head, conll_tokens)
+
+		if out_format == "paula":
 			try:
-				temp = io.open(infile, encoding="utf8")
-				temp = temp.read()
-			except UnicodeDecodeError:
-				temp = io.open(infile, encoding="ISO 8859-1")
-				temp = temp.read()
-			infile = temp.replace("\r","").split("\n")
+				self.serialize_output(out_format)
+				return True
+			except:
+				return False
+		else:
+			return self.serialize_output(out_format, parse)
+
+	def read_parse(self, lines):
+		"""
+		Reads a parse in a single streaming pass, creating the document's ParsedToken and Sentence objects,
+		collecting sentence texts and lemma frequencies and running the sequence tagger if one is loaded
+
+		:param lines: iterable of conll10/conllu lines, such as an open file, a list or a generator
+		:return: the lines which were parsed, after any DepEdit transformations (a list if lines was a list)
+		"""
 
 		# Empty cached lists of incompatible pairs
 		self.lex.incompatible_mod_pairs = set([])
 		self.lex.incompatible_isa_pairs = set([])
 
-
 		if self.depedit is not None:
-			infile = self.depedit.run_depedit(infile, self.docname)
-		if not isinstance(infile,list):
-			infile = infile.split("\n")
-		# Count non-comment, non-empty lines to get token count
-		self.token_count = len(list([tok for tok in infile if not (tok.startswith("#") or len(tok)==0)]))
-		self.sentence_count = len(list([tok for tok in infile if tok.startswith("1\t")]))
+			transformed = self.depedit.run_depedit(lines, self.docname)
+			lines = transformed.split("\n") if isinstance(lines, list) else iter_lines(transformed)
 
 		# Lists and dictionaries to hold tokens and markables
+		self.token_table = TokenTable()
 		self.conll_tokens = []
-		self.conll_tokens.append(ParsedToken(0, "ROOT", "--", "XX", "", -1, "NONE", Sentence(1, 0, ""), [], [], [], self.lex))
+		self.conll_tokens.append(ParsedToken(0, "ROOT", "--", "XX", "", -1, "NONE", Sentence(1, 0, ""), [], [], [], self.lex, table=self.token_table))
 		self.markables = []
 		self.markables_by_head = OrderedDict()
 		self.markstart_dict = defaultdict(list)
 		self.markend_dict = defaultdict(list)
+		self.sentences = []
 
+		self.token_count = 0
+		self.sentence_count = 0
 		self.tokoffset = 0
 		self.sentlength = 0
+		self.enriched_offset = 0  # Tokens before this index already have child and negation information
 		self.markcounter = 1
 		self.groupcounter = 1
 
 		self.children = defaultdict(list)
-		self.descendants = {}
+		self.descendants = SubtreeIndex()
 		self.child_funcs = defaultdict(list)
 		self.child_strings = defaultdict(list)
 
 		# Dereference object classes to method globals for convenience
 		lex = self.lex
 		conll_tokens = self.conll_tokens
-		markstart_dict = self.markstart_dict
-		markend_dict = self.markend_dict
+		token_table = self.token_table
+		sentences = self.sentences
+		filters = lex.filters
 
-		sentences = []
 		self.sent_num = 1
 		quoted = False
-		current_sentence = Sentence(self.sent_num, self.tokoffset, "")
 
 		lex.coref_rules = lex.non_speaker_rules
 
-		seq_preds = None
-		text = "\n".join(infile).strip()
-		sents = text.split("\n\n")
 		s_texts = []
-		lemmas = []
-		lemma_freqs = defaultdict(float)
-		for s in sents:
-			tablines = [line.split("\t") for line in s.split("\n") if "\t" in line]
-			no_super = [line[1] for line in tablines if "-" not in line[0]]
-			lemmas += [line[2] for line in tablines if "-" not in line[0]]
-			s_texts.append(" ".join(no_super))
-
-		if lex.sequencer is not None:  # Sequence label all tokens before reading sentences
-			if lex.sequencer.model_type == "crfsuite":
-				seq_preds = lex.sequencer.predict_proba(text)
-			else:
-				seq_preds = lex.sequencer.predict_proba(s_texts)
-
-		for myline in infile:
-			if "speaker" in myline and "=" in myline and myline.startswith("#"):  # speaker annotation
-				current_sentence.speaker = myline.split("=")[1].strip()
-				lex.coref_rules = lex.speaker_rules
-			elif "s_type" in myline and "=" in myline and myline.startswith("#"):  # s_type annotation
-				current_sentence.s_type = myline.split("=")[1].strip()
-			elif myline.find("\t") > 0:  # Only process lines that contain tabs (i.e. conll tokens)
+		doc_stats = DocStats()
+		lemma_counts = doc_stats.lemma_counts
+		# The CRF sequencer featurizes the conllu lines themselves, so only keep them if it is used
+		keep_lines = lex.sequencer is not None and lex.sequencer.model_type == "crfsuite"
+		sequencer_lines = []
+
+		for comments, rows in read_conll_sentences(lines):
+			current_sentence = Sentence(self.sent_num, self.tokoffset, "")
+			for comment in comments:
+				if "=" not in comment:
+					continue
+				if "speaker" in comment:  # speaker annotation
+					current_sentence.speaker = comment.split("=")[1].strip()
+					lex.coref_rules = lex.speaker_rules
+				elif "s_type" in comment:  # s_type annotation
+					current_sentence.s_type = comment.split("=")[1].strip()
+			words = []
+			for cols in rows:
 				current_sentence.token_count += 1
-				cols = myline.split("\t")
+				if "-" not in cols[0]:
+					words.append(cols[1])
+					lemma_counts[cols[2]] += 1
+					doc_stats.token_count += 1
 				if "." in cols[0] or "-" in cols[0]:  # conllu multi-token line or decimal ID virtual token
 					continue  # Not currently supported
-				if lex.filters["open_quote"].match(cols[1]) is not None and quoted is False:
+				if cols[0] == "1":
+					self.sentence_count += 1
+				if filters["open_quote"].match(cols[1]) is not None and quoted is False:
 					quoted = True
-				elif lex.filters["close_quote"].match(cols[1]) is not None and quoted is True:
+				elif filters["close_quote"].match(cols[1]) is not None and quoted is True:
 					quoted = False
-				if lex.filters["question_mark"].match(cols[1]) is not None:
+				if filters["question_mark"].match(cols[1]) is not None:
 					current_sentence.mood = "question"
-				if cols[3] in lex.func_substitutes_forward and int(cols[6]) > int(cols[0]):
+				sent_tok_id = int(cols[0])
+				sent_head_id = int(cols[6])
+				if cols[3] in lex.func_substitutes_forward and sent_head_id > sent_tok_id:
 					tok_func = re.sub(lex.func_substitutes_forward[cols[3]][0],lex.func_substitutes_forward[cols[3]][1],cols[7])
-				elif cols[3] in lex.func_substitutes_backward and int(cols[6]) < int(cols[0]):
+				elif cols[3] in lex.func_substitutes_backward and sent_head_id < sent_tok_id:
 					tok_func = re.sub(lex.func_substitutes_backward[cols[3]][0],lex.func_substitutes_backward[cols[3]][1],cols[7])
 				else:
 					tok_func = cols[7]
-				head_id = "0" if cols[6] == "0" else str(int(cols[6]) + self.tokoffset)
-				this_tok = ParsedToken(str(int(cols[0]) + self.tokoffset), cols[1], cols[2], cols[3], cols[5],
-												head_id, tok_func, current_sentence, [], [], [], lex, quoted, cols[8], cols[9])
-				if seq_preds is not None:
-					this_tok.seq_pred = seq_preds[int(cols[0]) + self.tokoffset -1]
+				# Convert sentence level ids to document level ids once, the token table keeps integer versions
+				tok_index = sent_tok_id + self.tokoffset
+				head_index = sent_head_id + self.tokoffset
+				tok_id = str(tok_index)
+				head_id = "0" if sent_head_id == 0 else str(head_index)
+				this_tok = ParsedToken(tok_id, cols[1], cols[2], cols[3], cols[5],
+												head_id, tok_func, current_sentence, [], [], [], lex, quoted, cols[8], cols[9], table=token_table)
 				conll_tokens.append(this_tok)
 				self.sentlength += 1
 				# Check not to add a child if this is a function which discontinues the markable span
-				if not (lex.filters["non_link_func"].match(tok_func) is not None or lex.filters["non_link_tok"].match(cols[1]) is not None):
-					if cols[6] != "0":  # Do not add children to the 'zero' token
-						self.children[str(int(cols[6]) + self.tokoffset)].append(str(int(cols[0]) + self.tokoffset))
-				self.child_funcs[(int(cols[6]) + self.tokoffset)].append(tok_func)
-				self.child_strings[(int(cols[6]) + self.tokoffset)].append(cols[1])
-			elif self.sentlength > 0:
-				#self.process_sentence(self.tokoffset, current_sentence)
-				self.sent_num += 1
-				if self.sentlength > 0:
-					self.tokoffset += self.sentlength
+				if not (lex.func_flags[tok_func] & NON_LINK_FUNC or filters["non_link_tok"].match(cols[1]) is not None):
+					if sent_head_id != 0:  # Do not add children to the 'zero' token
+						self.children[head_id].append(tok_id)
+				self.child_funcs[head_index].append(tok_func)
+				self.child_strings[head_index].append(cols[1])
+			self.token_count += len(rows)
+			if keep_lines:
+				sequencer_lines += comments
+				sequencer_lines += ["\t".join(cols) for cols in rows]
+				sequencer_lines.append("")
+			if self.sentlength > 0:
+				current_sentence.text = " ".join(words)
 				current_sentence.length = self.sentlength
+				doc_stats.sentence_lengths.append(self.sentlength)
+				s_texts.append(current_sentence.text)
 				sentences.append(current_sentence)
-				current_sentence = Sentence(self.sent_num, self.tokoffset, "")
-
+				self.sent_num += 1
+				self.tokoffset += self.sentlength
 				self.sentlength = 0
 
-		# Handle leftover sentence which did not have trailing newline
-		if self.sentlength > 0:
-			#self.process_sentence(self.tokoffset, current_sentence)
-			current_sentence.length = self.sentlength
-			sentences.append(current_sentence)
+		if lex.sequencer is not None:  # Sequence label all tokens after reading sentences
+			if keep_lines:
+				seq_preds = lex.sequencer.predict_proba("\n".join(sequencer_lines).strip())
+			else:
+				seq_preds = lex.sequencer.predict_proba(s_texts)
+			for tok in conll_tokens[1:]:
+				tok.seq_pred = seq_preds[tok.index - 1]
 
 		# Get lemma frequencies for this document
-		token_count = float(len(lemmas))
-		lex.token_count = token_count
-		for lemma in set(lemmas):
-			###lemma_freqs[lemma] = float(round(decimal.Decimal(lemmas.count(lemma)/token_count),4))
-			lemma_freqs[lemma] = lemmas.count(lemma)
-		lex.lemma_freqs = lemma_freqs
+		lex.doc_stats = doc_stats
+		lex.markable_index = MarkableIndex()
 		for tok in conll_tokens:
-			tok.lemma_freq = lemma_freqs[tok.lemma]
-
-		self.tokoffset = 0
-		for snum, sentence in enumerate(sentences):
-			sentence.text = s_texts[snum]
-			self.tokoffset += sentence.start_offset - self.tokoffset
-			self.process_sentence(sentence.start_offset,sentence)
-
-		marks_to_add = []
-		dump = "" ###
-		if lex.filters["seek_verb_for_defs"]:
-			for mark in self.markables:
-				if mark.definiteness == "def" and mark.antecedent == "none" and mark.form == "common" and \
-				(lex.filters["event_def_entity"] == mark.entity or lex.filters["abstract_def_entity"] == mark.entity):
-					for tok in conll_tokens[0:mark.start]:
-						if lex.filters["verb_head_pos"].match(tok.pos):
-							dump += str(mark.start)+"-"+str(mark.end) + ";"+tok.id+"-"+tok.id+"\t"+str(lex.docname)+"\t"+tok.text+"\t"+mark.head.text+"\t"+str(mark.sent_num-tok.sentence.sent_num)+"\t"
-							if stems_compatible(tok,mark.head,lex):
-								comp = "T"
-								dump += comp + "\n"
-								v_antecedent = make_markable(tok,conll_tokens,{},tok.sentence.start_offset,tok.sentence,[],lex)
-								mark.antecedent = v_antecedent
-								mark.coref_type = "coref"
-								v_antecedent.entity = mark.entity
-								v_antecedent.subclass = mark.subclass
-								v_antecedent.definiteness = "none"
-								v_antecedent.form = "verbal"
-								v_antecedent.infstat = "new"
-								v_antecedent.group = mark.group
-								v_antecedent.id = "referent_" + v_antecedent.head.id
-								marks_to_add.append(v_antecedent)
-							else:
-								comp = "F"
-
-
-		for mark in marks_to_add:
-			markstart_dict[mark.start].append(mark)
-			markend_dict[mark.end].append(mark)
-			self.markables_by_head[mark.head.id] = mark
-			self.markables.append(mark)
-
-
-		postprocess_coref(self.markables, lex, markstart_dict, markend_dict, self.markables_by_head, conll_tokens)
+			tok.lemma_freq = doc_stats.lemma_freq(tok.lemma)
 
-		if out_format == "paula":
-			try:
-				self.serialize_output(out_format)
-				return True
-			except:
-				return False
-		else:
-			return self.serialize_output(out_format, infile)
+		return lines
 
 	def analyze_markable(self, mark, lex):
 		"""
@@ -290,10 +318,10 @@ class Xrenner:
 		if mark.text == lex.debug["ana"]:
 			a=5
 		tok = mark.head
-		if lex.filters["proper_pos"].match(tok.pos) is not None:
+		if tok.flags & PROPER_POS:
 			mark.form = "proper"
 			mark.definiteness = "def"
-		elif lex.filters["pronoun_pos"].match(tok.pos) is not None:
+		elif tok.flags & PRONOUN_POS:
 			mark.form = "pronoun"
 			# Check for explicit indefinite morphology in morph feature of head token
 			if "indef" in mark.head.morph.lower():
@@ -404,8 +432,8 @@ class Xrenner:
 		"""
 		def is_eligible_submark_head(head_tok):
 			# Note this function ignores pos_func_heads combos
-			if lex.filters["mark_head_pos"].match(head_tok.pos) is not None:
-				if lex.filters["mark_forbidden_func"].match(head_tok.func) is None:
+			if head_tok.flags & MARK_HEAD_POS:
+				if not head_tok.flags & MARK_FORBIDDEN_FUNC:
 					return True
 			return False
 
@@ -413,28 +441,28 @@ class Xrenner:
 		markables_by_head = self.markables_by_head
 
 		lex = self.lex
-		conll_tokens = self.conll_tokens[:tokoffset+sentence.token_count+1]
+		conll_tokens = TokenWindow(self.conll_tokens, tokoffset+sentence.token_count+1)  # Document tokens up to this sentence
 		child_funcs = self.child_funcs
 		child_strings = self.child_strings
 		children = self.children
-		descendants = self.descendants
 		markstart_dict = self.markstart_dict
 		markend_dict = self.markend_dict
 
 		use_sequencer = True if lex.sequencer is not None else False
 
-		# Add list of all dependent funcs and strings to each token
-		add_child_info(conll_tokens, child_funcs, child_strings, lex)
-		add_negated_parents(conll_tokens, tokoffset)
+		# Add list of all dependent funcs and strings to each token not covered by a previous sentence
+		add_child_info(conll_tokens, child_funcs, child_strings, lex, self.enriched_offset)
+		add_negated_parents(conll_tokens, self.enriched_offset)
+		self.enriched_offset = max(self.enriched_offset, len(conll_tokens))
 
 		mark_candidates_by_head = OrderedDict()
 		stop_ids = {}
 		for tok1 in conll_tokens[tokoffset + 1:]:
 			stop_ids[tok1.id] = False  # Assume all tokens are head candidates
-			tok1.sent_position = float(int(tok1.id) - tokoffset) / sentence.token_count # Add relative token positions at sentence as percentages
-			tok1.doc_position = float(int(tok1.id)) / self.token_count # Add relative token positions at document as percentages
-			tok1.head_text = conll_tokens[int(tok1.head)].text  # Save parent text for later dependency checks
-			tok1.head_pos = conll_tokens[int(tok1.head)].pos  # Save parent POS for later dependency checks
+			tok1.sent_position = float(tok1.index - tokoffset) / sentence.token_count # Add relative token positions at sentence as percentages
+			tok1.doc_position = float(tok1.index) / self.token_count # Add relative token positions at document as percentages
+			tok1.head_text = conll_tokens[tok1.head_index].text  # Save parent text for later dependency checks
+			tok1.head_pos = conll_tokens[tok1.head_index].pos  # Save parent POS for later dependency checks
 
 		# Post-process parser input based on entity list if desired
 		if lex.filters["postprocess_parser"]:
@@ -446,23 +474,24 @@ class Xrenner:
 		# Enrich tokens with modifiers and parent head text
 		for token in conll_tokens[tokoffset:]:
 			for child in children[token.id]:
-				if lex.filters["mod_func"].match(conll_tokens[int(child)].func) is not None:
+				if conll_tokens[int(child)].flags & MOD_FUNC:
 					token.modifiers.append(conll_tokens[int(child)])
-			token.head_text = conll_tokens[int(token.head)].text
+			token.head_text = conll_tokens[token.head_index].text
 			# Check for lexical possessives to dynamically enhance hasa information
-			if lex.filters["possessive_func"].match(token.func) is not None:
+			if token.flags & POSSESSIVE_FUNC:
 				# Check that neither possessor nor possessed is a pronoun
-				if lex.filters["pronoun_pos"].match(token.pos) is None and lex.filters["pronoun_pos"].match(conll_tokens[int(token.head)].pos) is None:
-					lex.hasa[token.text][conll_tokens[int(token.head)].text] += 2  # Increase by 2: 1 for attestation, 1 for pertinence in this document
-					lex.hasa[token.lemma][conll_tokens[int(token.head)].text] += 1
+				if not token.flags & PRONOUN_POS and not conll_tokens[token.head_index].flags & PRONOUN_POS:
+					lex.hasa[token.text][conll_tokens[token.head_index].text] += 2  # Increase by 2: 1 for attestation, 1 for pertinence in this document
+					lex.hasa[token.lemma][conll_tokens[token.head_index].text] += 1
 			# Check if func2 has additional possessor information
 			if token.func2 != "_":
-				if lex.filters["possessive_func"].match(token.func2) is not None:
-					if lex.filters["pronoun_pos"].match(token.pos) is None and lex.filters["pronoun_pos"].match(conll_tokens[int(token.head2)+tokoffset].pos) is None:
+				if lex.func_flags[token.func2] & POSSESSIVE_FUNC:
+					if not token.flags & PRONOUN_POS and not conll_tokens[int(token.head2)+tokoffset].flags & PRONOUN_POS:
 						lex.hasa[token.text][conll_tokens[int(token.head2)+tokoffset].text] += 2  # Increase by 2: 1 for attestation, 1 for pertinence in this document
 						lex.hasa[token.lemma][conll_tokens[int(token.head2)+tokoffset].text] += 1
 
 		# Find dead areas
+		stop_trie = lex.stop_trie
 		for tok1 in conll_tokens[tokoffset + 1:]:
 			# Affix tokens can't be markable heads - assume parser error and fix if desired
 			# DEBUG POINT
@@ -473,14 +502,12 @@ class Xrenner:
 					if not any([lex.filters["sequencer_nonref_forbidden_childfunc"].match(f) is not None for f in tok1.child_funcs]):
 						stop_ids[tok1.id] = True
 			if lex.filters["postprocess_parser"]:
-				if ((lex.filters["mark_head_pos"].match(tok1.pos) is not None and lex.filters["mark_forbidden_func"].match(tok1.func) is None) or
-				pos_func_combo(tok1.pos, tok1.func, lex.filters["pos_func_heads"])) and not (stop_ids[tok1.id]):
+				if lex.mark_heads[tok1.pos, tok1.func] and not (stop_ids[tok1.id]):
 					if tok1.text.strip() in lex.affix_tokens:
 						stop_ids[tok1.id] = True
 						for child_id in sorted(children[tok1.id], reverse=True):
 							child = conll_tokens[int(child_id)]
-							if ((lex.filters["mark_head_pos"].match(child.pos) is not None and lex.filters["mark_forbidden_func"].match(child.func) is None) or
-							pos_func_combo(child.pos, child.func, lex.filters["pos_func_heads"])) and not (stop_ids[child.id]):
+							if lex.mark_heads[child.pos, child.func] and not (stop_ids[child.id]):
 								child.head = tok1.head
 								tok1.head = child.id
 								# Make the new head be the head of all children of the affix token
@@ -507,7 +534,7 @@ class Xrenner:
 										if tok_to_rewire.func not in child.child_funcs:
 											child.child_funcs.append(tok_to_rewire.func)
 										# Rewire modifiers
-										if tok_to_rewire not in child.modifiers and lex.filters["mod_func"].match(tok_to_rewire.func) is not None:
+										if tok_to_rewire not in child.modifiers and tok_to_rewire.flags & MOD_FUNC:
 											child.modifiers.append(tok_to_rewire)
 										if child in tok_to_rewire.modifiers:
 											tok_to_rewire.modifiers.remove(child)
@@ -515,17 +542,19 @@ class Xrenner:
 								# Only do this for the first subordinate markable head found by traversing right to left
 								break
 
-			# Try to construct a longer stop candidate starting with each token in the sentence, max length 5 tokens
-			stop_candidate = ""
-			for tok2 in conll_tokens[int(tok1.id):min(len(conll_tokens),int(tok1.id)+4)]:
-				stop_candidate += tok2.text + " "
-				if stop_candidate.strip().lower() in lex.stop_list:  # Stop list matched, flag tokens as impossible markable heads
-					for tok3 in conll_tokens[int(tok1.id):int(tok2.id) + 1]:
+			# Try to match a stop list phrase starting with each token in the sentence, max length 4 tokens
+			stop_node = stop_trie.root
+			for tok2 in conll_tokens[tok1.index:min(len(conll_tokens),tok1.index+4)]:
+				stop_node = stop_trie.step(stop_node, tok2.text.lower())
+				if stop_node is None:
+					break
+				if stop_trie.END in stop_node:  # Stop list matched, flag tokens as impossible markable heads
+					for tok3 in conll_tokens[tok1.index:tok2.index + 1]:
 						stop_ids[tok3.id] = True
 
 		# Find last-first name combinations
 		for tok1 in conll_tokens[tokoffset + 1:-1]:
-			tok2 = conll_tokens[int(tok1.id) + 1]
+			tok2 = conll_tokens[tok1.index + 1]
 			first_name_candidate = tok1.text.title() if tok1.text.isupper() else tok1.text
 			last_name_candidate = tok2.text.title() if tok2.text.isupper() else tok2.text
 			if not lex.filters["cap_names"] or (first_name_candidate[0].isupper() and last_name_candidate[0].isupper()):
@@ -533,18 +562,17 @@ class Xrenner:
 					stop_ids[tok1.id] = True
 		# Allow one intervening token, e.g. for middle initial
 		for tok1 in conll_tokens[tokoffset + 1:-2]:
-			tok2 = conll_tokens[int(tok1.id) + 2]
+			tok2 = conll_tokens[tok1.index + 2]
 			first_name_candidate = tok1.text.title() if tok1.text.isupper() else tok1.text
-			middle_name_candidate = conll_tokens[int(tok1.id) + 1].text.title() if tok1.text.isupper() else conll_tokens[int(tok1.id) + 1].text
+			middle_name_candidate = conll_tokens[tok1.index + 1].text.title() if tok1.text.isupper() else conll_tokens[tok1.index + 1].text
 			last_name_candidate = tok2.text.title() if tok2.text.isupper() else tok2.text
 			if not lex.filters["cap_names"] or (first_name_candidate[0].isupper() and last_name_candidate[0].isupper()):
 				if first_name_candidate in lex.first_names and last_name_candidate in lex.last_names and tok1.head == tok2.id and (re.match(r'^[A-Z]\.$',middle_name_candidate) or middle_name_candidate in lex.first_names):
 					stop_ids[tok1.id] = True
 
-		# Expand children list recursively into descendants for this sentence
-		for parent_key in children:
-			if int(parent_key) > tokoffset and int(parent_key) <= int(conll_tokens[-1].id):
-				descendants[parent_key] = get_descendants(parent_key, children, [], self.sent_num, conll_tokens)
+		# Index the descendants of all heads in this sentence
+		descendants = SubtreeIndex(children, [tok.id for tok in conll_tokens[tokoffset + 1:] if tok.id in children], sentence.sent_num, conll_tokens)
+		self.descendants = descendants
 
 		keys_to_pop = []
 
@@ -554,9 +582,8 @@ class Xrenner:
 			# ruling out stop list items with appropriate functions
 			if tok.text == lex.debug["ana"]:
 				a=5
-			# TODO: consider switch for lex.filters["stop_func"].match(tok.func)
-			if ((lex.filters["mark_head_pos"].match(tok.pos) is not None and lex.filters["mark_forbidden_func"].match(tok.func) is None) or
-					pos_func_combo(tok.pos, tok.func, lex.filters["pos_func_heads"])) and not (stop_ids[tok.id]):
+			# TODO: consider switch for tok.flags & STOP_FUNC
+			if lex.mark_heads[tok.pos, tok.func] and not (stop_ids[tok.id]):
 				this_markable = make_markable(tok, conll_tokens, descendants, tokoffset, sentence, keys_to_pop, lex)
 				if this_markable is not None:
 					mark_candidates_by_head[tok.id] = this_markable
@@ -572,14 +599,7 @@ class Xrenner:
 						# Coordination found - make a small markable for just this first head without coordinates
 						make_submark = True
 						# Remove the coordinate children from descendants of small markable head
-						if child.id in descendants:
-							for sub_descendant in descendants[child.id]:
-								if tok.id in descendants:
-									if sub_descendant in descendants[tok.id]:
-										descendants[tok.id].remove(sub_descendant)
-						if tok.id in descendants:
-							if child.id in descendants[tok.id]:
-								descendants[tok.id].remove(child.id)
+						descendants.exclude(tok.id, child.id, subtree=True)
 						# Build a composite id for the large head from coordinate children IDs separated by underscore
 						submark_id += "_" + child.id
 						cardi+=1
@@ -590,9 +610,8 @@ class Xrenner:
 					# Remove coordination tokens, such as 'and', 'or' based on coord_func setting
 					for child_id in children[tok.id]:
 						child = conll_tokens[int(child_id)]
-						if lex.filters["coord_func"].match(child.func):
-							if child.id in descendants[tok.id]:
-								descendants[tok.id].remove(child.id)
+						if child.flags & COORD_FUNC:
+							descendants.exclude(tok.id, child.id)
 
 					# Make the small markable and recall the big markable
 					mark_candidates_by_head[tok.id].cardinality=cardi+1
@@ -625,10 +644,10 @@ class Xrenner:
 						key = index[1]
 						# Note that the key may contain underscores if it's a composite, but those can't be atomic
 						if key != mark.head.id and mark.start <= int(re.sub('_.*','',key)) <= mark.end and '_' not in key:
-							if lex.filters["pronoun_pos"].match(conll_tokens[int(re.sub('_.*','',key))].pos) is None:  # Make sure we're not removing a pronoun
+							if not conll_tokens[int(re.sub('_.*','',key))].flags & PRONOUN_POS:  # Make sure we're not removing a pronoun
 								keys_to_pop.append(key)
 				elif len(modifier_based_entity) > 1:
-					stoplist_prefix_tokens(mark, lex.entity_mods, keys_to_pop)
+					stoplist_prefix_tokens(mark, lex.entity_mods, keys_to_pop, lex.mod_trie)
 			# Check for whole markable only exclusion
 			if mark.text + "@" in lex.stop_list:
 				keys_to_pop.append(mark_id)
@@ -648,6 +667,8 @@ class Xrenner:
 									 mark.subclass, "new", mark.agree, mark.sentence, "none", "none", self.groupcounter,
 									 mark.alt_entities, mark.alt_subclasses, mark.alt_agree,mark.cardinality,mark.submarks,mark.coordinate,mark.agree_certainty)
 			this_markable.get_dep_freqs(lex)
+			lex.doc_stats.add_markable(this_markable)
+			lex.markable_index.add_markable(this_markable)
 
 			markables.append(this_markable)
 			markables_by_head[mark_id] = this_markable
@@ -663,14 +684,14 @@ class Xrenner:
 			# Revise coordinate markable entities now that we have resolved all of their constituents
 			if len(current_markable.submarks) > 0:
 				assign_coordinate_entity(current_markable,markables_by_head)
-			if antecedent_prohibited(current_markable, conll_tokens, lex) or (current_markable.definiteness == "indef" and lex.filters["apposition_func"].match(current_markable.head.func) is None and not lex.filters["allow_indef_anaphor"]):
+			if antecedent_prohibited(current_markable, conll_tokens, lex) or (current_markable.definiteness == "indef" and not current_markable.head.flags & APPOSITION_FUNC and not lex.filters["allow_indef_anaphor"]):
 				antecedent = None
-			elif (current_markable.definiteness == "indef" and lex.filters["apposition_func"].match(current_markable.head.func) is not None and not lex.filters["allow_indef_anaphor"]):
+			elif (current_markable.definiteness == "indef" and current_markable.head.flags & APPOSITION_FUNC and not lex.filters["allow_indef_anaphor"]):
 				antecedent, propagation = find_antecedent(current_markable, markables, lex, "appos")
 			else:
 				antecedent, propagation = find_antecedent(current_markable, markables, lex)
 			if antecedent is not None:
-				if int(antecedent.head.id) < int(current_markable.head.id) or 'invert' in propagation:
+				if antecedent.head.index < current_markable.head.index or 'invert' in propagation:
 					# If the rule specifies to invert
 					if 'invert' in propagation:
 						temp = antecedent
@@ -680,7 +701,7 @@ class Xrenner:
 					current_markable.group = antecedent.group
 
 					# Check for apposition function if both markables are in the same sentence
-					if lex.filters["apposition_func"].match(current_markable.head.func) is not None and \
+					if current_markable.head.flags & APPOSITION_FUNC and \
 							current_markable.sentence.sent_num == antecedent.sentence.sent_num:
 						current_markable.coref_type = "appos"
 					elif current_markable.form == "pronoun":
@@ -8,12 +8,17 @@ Main controller script for entity recognition and coreference resolution
 Author: Amir Zeldes
 """
 
-import argparse, sys, io, os
+import argparse, sys, io, os, gc
 from modules.xrenner_xrenner import Xrenner
 from glob import glob
 from multiprocessing import Process, Value, Lock, current_process, Array
 import ctypes
 from math import ceil
+try:
+	from multiprocessing import get_context, get_all_start_methods
+	FORK = "fork" in get_all_start_methods()
+except ImportError:  # Python 2
+	FORK = False
 
 __version__ = "2.2.1"
 xrenner_version = "xrenner V" + __version__
@@ -89,13 +94,19 @@ def rreplace(s, old, new, occurrence):
 	li = s.rsplit(old, occurrence)
 	return new.join(li)
 
-def xrenner_worker(data,options,total_docs,counter):
+def xrenner_worker(data,options,total_docs,counter,xrenner=None):
+	"""
+	Processes a list of documents, or documents taken from a shared queue until None is received.
+	If an Xrenner object is supplied (e.g. loaded in the parent before forking), it is used instead of loading
+	the model again in this process.
+	"""
 	tokens = 0
 	sentences = 0
 
-	model = options.model
-	override = options.override
-	xrenner = Xrenner(model, override, options.rulebased, options.noseq)
+	if xrenner is None:
+		model = options.model
+		override = options.override
+		xrenner = Xrenner(model, override, options.rulebased, options.noseq, options.nocache, options.mmap)
 
 	if options.dump is not None:
 		xrenner.lex.procid = str(current_process().ident)
@@ -107,7 +118,15 @@ def xrenner_worker(data,options,total_docs,counter):
 	if options.oracle is not None:
 		xrenner.lex.read_oracle(options.oracle)
 
-	for file_ in data:
+	if options.profile:
+		xrenner.lex.profile_constraints()
+
+	if isinstance(data, list):
+		doc_source = data
+	else:
+		doc_source = iter(data.get, None)
+
+	for file_ in doc_source:
 
 		xrenner.lex.dump_types = set([])  # Empty set of dump rows to avoid duplicates
 		output = xrenner.analyze(file_, options.format)
@@ -117,7 +136,7 @@ def xrenner_worker(data,options,total_docs,counter):
 		if options.format == "none":
 			pass
 		elif options.format != "paula":
-			if len(data) > 1:
+			if total_docs > 1:
 				if options.format == "webanno":
 					extension = "xmi"
 				elif options.format == "webannotsv":
@@ -135,14 +154,20 @@ def xrenner_worker(data,options,total_docs,counter):
 					print(output.encode("utf8"))
 
 		counter.increment(1,xrenner.sent_num-1,len(xrenner.conll_tokens)-1)
-		docs, sents, toks = counter.value()
+		done_docs, done_sents, done_toks = counter.value()
 		if options.verbose and options.oracle is not None:
 			sys.stderr.write("Used oracle for " + str(xrenner.lex.oracle_counters[2]) + " entities, of which " + str(xrenner.lex.oracle_counters[0]) + " had spans in oracle and " + str(xrenner.lex.oracle_counters[1]) + " were different types than xrenner pred\n")
 
-		if options.verbose and len(data) > 1:
-			sys.stderr.write("Document " + str(docs) + "/" + str(total_docs) + ": " +
+		if options.verbose and total_docs > 1:
+			sys.stderr.write("Document " + str(done_docs) + "/" + str(total_docs) + ": " +
 								 "Processed " + str(len(xrenner.conll_tokens)-1) + " tokens in " + str(xrenner.sent_num-1) + " sentences.\n")
 
+	if options.verbose:
+		sys.stderr.write(xrenner.lex.get_load_report())
+
+	if options.profile:
+		sys.stderr.write("Constraint order written to " + xrenner.lex.write_constraint_order() + "\n")
+
 	if options.dump is not None:
 		xrenner.lex.dump.close()
 		if PY3:
@@ -166,6 +191,9 @@ if __name__ == "__main__":
 	parser.add_argument('file', action="store", help="input file name to process")
 	parser.add_argument('--oracle', action='store', help="file with oracle entity predictions")
 	parser.add_argument('--noseq', action='store_true', help="do not use sequence tagger for entity classification")
+	parser.add_argument('--nocache', action='store_true', help="do not read or write the compiled model cache (.xrc and .xrt files next to the model)")
+	parser.add_argument('--mmap', action='store_true', help="share large gazetteers between processes using a memory-mapped lexicon store (.xrl file next to the model)")
+	parser.add_argument('--profile', action='store_true', help="profile antecedent constraints of coref rules on the input and save their best order for the model (.xro file next to the model)")
 	parser.add_argument('--version', action='version', version=xrenner_version, help="show xrenner version number and quit")
 
 	total_docs = 0
@@ -180,6 +208,8 @@ if __name__ == "__main__":
 	else:
 		options = parser.parse_args()
 		procs = options.procs
+		if options.profile:
+			procs = 1  # Constraint statistics are collected in a single process
 		if options.verbose:
 			import modules.timing
 			sys.stderr.write("\nReading language model...\n")
@@ -208,12 +238,31 @@ if __name__ == "__main__":
 			if "." not in options.dump:
 				options.dump += ".tab"
 
-		for sublist in split_data:
-			p = Process(target=xrenner_worker, args=(sublist,options,len(data), counter))
-			jobs.append(p)
-			p.start()
-			if options.dump is not None:
-				dump_files.append(rreplace(options.dump, ".", str(p.ident)+".",1))
+		if procs > 1 and FORK:
+			# Load the model once and fork workers which share its memory copy-on-write, taking documents from a queue
+			xrenner = Xrenner(options.model, options.override, options.rulebased, options.noseq, options.nocache, options.mmap)
+			xrenner.lex.read_lazy_files()  # Read optional gazetteers once in the parent rather than in every worker
+			if hasattr(gc, "freeze"):
+				gc.freeze()  # Keep the garbage collector from touching (and thereby copying) the shared model pages
+			fork_context = get_context("fork")
+			queue = fork_context.Queue()
+			for file_ in data:
+				queue.put(file_)
+			for i in range(procs):
+				queue.put(None)  # One stop signal per worker
+			for i in range(procs):
+				p = fork_context.Process(target=xrenner_worker, args=(queue, options, len(data), counter, xrenner))
+				jobs.append(p)
+				p.start()
+				if options.dump is not None:
+					dump_files.append(rreplace(options.dump, ".", str(p.ident)+".",1))
+		else:
+			for sublist in split_data:
+				p = Process(target=xrenner_worker, args=(sublist,options,len(data), counter))
+				jobs.append(p)
+				p.start()
+				if options.dump is not None:
+					dump_files.append(rreplace(options.dump, ".", str(p.ident)+".",1))
 		for j in jobs:
 			j.join()
 